@@ -0,0 +1,266 @@
+"""
+Benchmark offline del pipeline OMR con hojas sintéticas (sintetico.py).
+
+Mide el tiempo de cada etapa (omr.ETAPAS), el throughput y la precisión
+frente a las respuestas conocidas. No necesita escaneos reales.
+
+    python bench_omr.py --hojas 40
+    python bench_omr.py --hojas 200 --procesos 4 --escala 1.6 --debug
+    python bench_omr.py --hojas 40 --detector componentes
+    python bench_omr.py --hojas 40 --comparar-detectores   # velocidad y recall de cada detector
+    python bench_omr.py --hojas 40 --comparar-qr           # tasa y coste de cada decodificador QR
+    python bench_omr.py --hojas 20 --memoria --max-rss-mb 300  # pico de RSS por hoja (sale 1 si se pasa)
+    OMR_RAPIDO_ESCALA=0.5 python bench_omr.py --hojas 40   # pase rápido a media resolución
+"""
+import argparse
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import omr
+import qr_omr
+import sintetico
+
+
+def _generar(args):
+    i, semilla, examenes, foto_kw = args
+    rng = np.random.default_rng([semilla, i])
+    if not examenes:
+        return sintetico.hoja_aleatoria(rng, **foto_kw)
+    # hojas repetidas de pocos exámenes (misma plantilla => rejilla cacheada)
+    id_examen = 1 + i % examenes
+    num_preguntas = int(np.random.default_rng([semilla, id_examen]).integers(10, 31))
+    return sintetico.hoja_aleatoria(rng, num_preguntas=num_preguntas, id_examen=id_examen, **foto_kw)
+
+
+def _medir(binario, debug, detector=None):
+    res = omr.procesar_omr(binario, debug, detector)
+    res.pop("_debug", None)
+    return res, res.pop("_metricas")["tiempos"]
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for linea in f:
+            if linea.startswith("VmRSS:"):
+                return int(linea.split()[1]) / 1024.0
+    return 0.0
+
+
+def _medir_memoria(binario, debug, detector=None):
+    """
+    Pico de RSS (MB) que añade UNA hoja, en un proceso recién creado
+    (ru_maxrss no baja nunca: una hoja por proceso).
+    """
+    base = _rss_mb()
+    res, _ = _medir(binario, debug, detector)
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB en Linux
+    return res, max(0.0, pico - base)
+
+
+def _informe_memoria(picos, max_rss_mb):
+    print(f"pico RSS por hoja: p50 {np.percentile(picos, 50):.1f} MB, p95 {np.percentile(picos, 95):.1f} MB, "
+          f"máx {max(picos):.1f} MB (OMR_MEMORIA_MB={omr.MEMORIA_MB:g})")
+    if max_rss_mb and max(picos) > max_rss_mb:
+        print(f"ERROR: {sum(p > max_rss_mb for p in picos)} hoja(s) por encima de {max_rss_mb:g} MB")
+        return False
+    return True
+
+
+def _zona_normalizada(binario):
+    """
+    (gris, tinta) de la zona OMR enderezada, como la ve el detector en el pipeline.
+    """
+    img = omr.decodificar_imagen(binario)
+    foto = omr.ContextoHoja(img)
+    marcas = omr.localizar_marcas(foto)
+    if marcas is None:
+        return None, None
+    r = omr.OMR_REGION
+    zona = omr.ContextoHoja(omr.warp_zona_a4(foto.gris, marcas, 0, r["x0"], r["y0"], r["x1"], r["y1"]))
+    return zona.gris, omr.binarizar_tinta_pro(zona)
+
+
+def _medir_detectores(binario, tolerancia=8.0):
+    """
+    Por detector: (segundos, burbujas encontradas, falsos positivos) de una hoja.
+    """
+    zona_gray, zona_bin = _zona_normalizada(binario)
+    verdad = sintetico.centros_burbujas() - [omr.OMR_REGION["x0"], omr.OMR_REGION["y0"]]
+    out = {}
+    for nombre, detector in omr.DETECTORES.items():
+        if zona_gray is None:
+            out[nombre] = (0.0, 0, 0)
+            continue
+        t0 = time.perf_counter()
+        circulos = detector(zona_gray, zona_bin)
+        seg = time.perf_counter() - t0
+        if not circulos:
+            out[nombre] = (seg, 0, 0)
+            continue
+        d = np.linalg.norm(verdad[:, None, :] - np.array(circulos)[None, :, :2], axis=2)
+        out[nombre] = (seg, int((d.min(axis=1) <= tolerancia).sum()), int((d.min(axis=0) > tolerancia).sum()))
+    return out
+
+
+def _informe_detectores(medidas, n_hojas):
+    total = n_hojas * len(sintetico.centros_burbujas())
+    print(f"{'detector':<14}{'media ms':>10}{'p95 ms':>9}{'recall':>9}{'falsos/hoja':>13}")
+    for nombre in omr.DETECTORES:
+        segs = [m[nombre][0] for m in medidas]
+        encontradas = sum(m[nombre][1] for m in medidas)
+        falsos = sum(m[nombre][2] for m in medidas)
+        print(f"{nombre:<14}{np.mean(segs) * 1000:>10.1f}{_percentil(segs, 95):>9.1f}"
+              f"{100.0 * encontradas / max(1, total):>8.1f}%{falsos / float(max(1, n_hojas)):>13.1f}")
+
+
+def _medir_qr(binario, codigo):
+    """
+    Por decodificador QR y entrada ("zona" enderezada por las marcas, "foto" entera en gris):
+    (segundos, leído correctamente) de una hoja. Cada backend solo, sin respaldo.
+    """
+    foto = omr.ContextoHoja(omr.decodificar_imagen(binario))
+    marcas = omr.localizar_marcas(foto)
+    entradas = {"foto": foto.gris}
+    if marcas is not None:
+        entradas["zona"] = cv2.warpPerspective(foto.gris, omr.homografia_a4(marcas, 0), omr.QR_ZONA_A4)
+    out = {}
+    for nombre in qr_omr.DECODIFICADORES:
+        dec = qr_omr.DecodificadorQR([nombre])
+        for entrada in ("zona", "foto"):
+            if entrada not in entradas:
+                out[nombre, entrada] = (0.0, False)
+                continue
+            t0 = time.perf_counter()
+            s = dec(entradas[entrada])
+            out[nombre, entrada] = (time.perf_counter() - t0, s == codigo)
+    return out
+
+
+def _informe_qr(medidas, n_hojas):
+    print(f"principal {qr_omr.QR_PRINCIPAL}, respaldo {qr_omr.QR_RESPALDO or '-'}\n")
+    print(f"{'decodificador':<15}{'entrada':<9}{'leídos':>9}{'media ms':>10}{'p95 ms':>9}")
+    for nombre in qr_omr.DECODIFICADORES:
+        for entrada in ("zona", "foto"):
+            segs = [m[nombre, entrada][0] for m in medidas]
+            leidos = sum(m[nombre, entrada][1] for m in medidas)
+            print(f"{nombre:<15}{entrada:<9}{f'{leidos}/{n_hojas}':>9}{np.mean(segs) * 1000:>10.1f}"
+                  f"{_percentil(segs, 95):>9.1f}")
+
+
+def _comparar(res, verdad):
+    """
+    (qr_ok, aciertos, preguntas) de una hoja.
+    """
+    esperado = verdad["respuestas"]
+    if res.get("codigo") != verdad["codigo"]:
+        return False, 0, len(esperado)
+    leidas = res.get("respuestas") or {}
+    aciertos = sum(1 for k, v in esperado.items() if leidas.get(k) == v)
+    return True, aciertos, len(esperado)
+
+
+def _percentil(xs, p):
+    return float(np.percentile(xs, p)) * 1000.0 if xs else 0.0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--hojas", type=int, default=40)
+    ap.add_argument("--semilla", type=int, default=0)
+    ap.add_argument("--procesos", type=int, default=1, help="workers en paralelo (throughput)")
+    ap.add_argument("--examenes", type=int, default=0, help="repartir las hojas entre N exámenes (0 = todas distintas)")
+    ap.add_argument("--escala", type=float, default=1.0, help="resolución de la foto respecto a A4 300 dpi")
+    ap.add_argument("--perspectiva", type=float, default=0.03)
+    ap.add_argument("--angulo", type=float, default=3.0)
+    ap.add_argument("--desenfoque", type=float, default=1.0)
+    ap.add_argument("--ruido", type=float, default=6.0)
+    ap.add_argument("--luz", type=float, default=0.25)
+    ap.add_argument("--calidad-jpg", type=int, default=90)
+    ap.add_argument("--debug", action="store_true", help="medir también el render de debug")
+    ap.add_argument("--detector", choices=sorted(omr.DETECTORES), default=None,
+                    help=f"detector de burbujas (por defecto {omr.DETECTOR_CIRCULOS})")
+    ap.add_argument("--comparar-detectores", action="store_true",
+                    help="sólo la detección: velocidad y recall de cada detector sobre la zona enderezada")
+    ap.add_argument("--comparar-qr", action="store_true",
+                    help="sólo el QR: tasa de lectura y coste de cada decodificador sobre las mismas hojas")
+    ap.add_argument("--memoria", action="store_true",
+                    help="pico de RSS por hoja (cada hoja en un proceso nuevo)")
+    ap.add_argument("--max-rss-mb", type=float, default=0.0,
+                    help="con --memoria: salir con código 1 si alguna hoja pasa de este pico")
+    a = ap.parse_args()
+
+    foto_kw = dict(escala=a.escala, perspectiva=a.perspectiva, angulo=a.angulo, desenfoque=a.desenfoque,
+                   ruido=a.ruido, luz=a.luz, calidad_jpg=a.calidad_jpg)
+    debug = omr.opciones_debug("id") if a.debug else None
+
+    print(f"Generando {a.hojas} hojas sintéticas...")
+    trabajos = [(i, a.semilla, a.examenes, foto_kw) for i in range(a.hojas)]
+    with ProcessPoolExecutor(max_workers=a.procesos) as pool:
+        hojas = list(pool.map(_generar, trabajos))
+
+    if a.comparar_detectores:
+        with ProcessPoolExecutor(max_workers=a.procesos) as pool:
+            medidas = list(pool.map(_medir_detectores, [b for b, _ in hojas]))
+        print(f"\n{a.hojas} hojas, {len(sintetico.centros_burbujas())} burbujas impresas por hoja\n")
+        _informe_detectores(medidas, a.hojas)
+        return
+
+    if a.comparar_qr:
+        with ProcessPoolExecutor(max_workers=a.procesos) as pool:
+            medidas = list(pool.map(_medir_qr, [b for b, _ in hojas], [v["codigo"] for _, v in hojas]))
+        print(f"\n{a.hojas} hojas, decodificadores: {', '.join(qr_omr.DECODIFICADORES)}\n")
+        _informe_qr(medidas, a.hojas)
+        return
+
+    if a.memoria:
+        with ProcessPoolExecutor(max_workers=a.procesos, max_tasks_per_child=1) as pool:
+            medidas = list(pool.map(_medir_memoria, [b for b, _ in hojas], [debug] * len(hojas),
+                                    [a.detector] * len(hojas)))
+        qr_ok = sum(_comparar(res, verdad)[0] for (res, _), (_, verdad) in zip(medidas, hojas))
+        print(f"\n{a.hojas} hojas, QR leído {qr_ok}/{a.hojas}")
+        if not _informe_memoria([p for _, p in medidas], a.max_rss_mb):
+            sys.exit(1)
+        return
+
+    t0 = time.perf_counter()
+    if a.procesos > 1:
+        with ProcessPoolExecutor(max_workers=a.procesos) as pool:
+            # calentar los workers (import + cv2) fuera de la medida
+            list(pool.map(_medir, [hojas[0][0]] * a.procesos, [debug] * a.procesos, [a.detector] * a.procesos))
+            t0 = time.perf_counter()
+            medidas = list(pool.map(_medir, [b for b, _ in hojas], [debug] * len(hojas),
+                                    [a.detector] * len(hojas)))
+    else:
+        medidas = [_medir(b, debug, a.detector) for b, _ in hojas]
+    pared = time.perf_counter() - t0
+
+    por_etapa = {e: [] for e in omr.ETAPAS + ["total"]}
+    qr_ok = aciertos = preguntas = 0
+    for (res, tiempos), (_, verdad) in zip(medidas, hojas):
+        for e, s in tiempos.items():
+            por_etapa.setdefault(e, []).append(s)
+        q, ac, n = _comparar(res, verdad)
+        qr_ok += q
+        aciertos += ac
+        preguntas += n
+
+    mp = np.mean([len(b) for b, _ in hojas]) / 1e6
+    print(f"\n{a.hojas} hojas, JPEG medio {mp:.2f} MB, {a.procesos} proceso(s)\n")
+    print(f"{'etapa':<12}{'hojas':>7}{'media ms':>11}{'p50 ms':>9}{'p95 ms':>9}")
+    for e, xs in por_etapa.items():
+        if not xs:
+            continue
+        print(f"{e:<12}{len(xs):>7}{np.mean(xs) * 1000:>11.1f}{_percentil(xs, 50):>9.1f}{_percentil(xs, 95):>9.1f}")
+
+    print(f"\nthroughput : {a.hojas / pared:.2f} hojas/s ({pared:.1f} s)")
+    print(f"QR leído   : {qr_ok}/{a.hojas}")
+    print(f"respuestas : {aciertos}/{preguntas} ({100.0 * aciertos / max(1, preguntas):.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Caché de resultados por hash del fichero subido (reintentos / doble envío).
+
+- Memoria: LRU acotado con caducidad (TTL).
+- Disco opcional: SQLite (sobrevive a reinicios), misma caducidad.
+- Peticiones simultáneas con el mismo hash se agrupan: sólo una calcula.
+- La clave incluye una huella de versión del pipeline y de la configuración que cambia
+  resultados (fijar_huella): una caché SQLite de otra versión no devuelve resultados viejos.
+Sólo se guardan resultados ok (un fallo puede deberse a carga / presupuesto QR).
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import metricas
+
+CACHE_MAX = int(os.environ.get("OMR_CACHE_MAX", "512"))            # 0 = desactivada
+CACHE_TTL_S = float(os.environ.get("OMR_CACHE_TTL_S", "3600"))
+CACHE_SQLITE = os.environ.get("OMR_CACHE_SQLITE", "")              # ruta .sqlite; vacío = sólo memoria
+
+# claves internas del pipeline que no se guardan
+_CLAVES_INTERNAS = ("_debug", "_metricas")
+
+
+_huella = b""
+
+
+def fijar_huella(*partes):
+    """
+    Versión del pipeline + configuración que cambia resultados; entra en la clave de caché.
+    """
+    global _huella
+    _huella = hashlib.sha256(json.dumps(partes, default=str).encode()).digest()
+
+
+def hash_binario(binario):
+    return hashlib.sha256(_huella + binario).hexdigest()
+
+
+def _limpio(res):
+    return {k: v for k, v in res.items() if k not in _CLAVES_INTERNAS}
+
+
+class CacheResultados:
+    def __init__(self, max_items=CACHE_MAX, ttl_s=CACHE_TTL_S, ruta_sqlite=CACHE_SQLITE):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self._mem = OrderedDict()  # clave -> (instante, res)
+        self._en_vuelo = {}        # clave -> Future del que calcula
+        self._lock = threading.Lock()
+        self._ruta_sqlite = ruta_sqlite if max_items > 0 else ""
+        self._db = None
+        self._pid = None  # proceso que abrió self._db
+        self._escrituras = 0
+
+    def _conexion(self):
+        """
+        Conexión SQLite de ESTE proceso, abierta al primer uso (con self._lock).
+        servir.py importa omr en el maestro de gunicorn y una conexión SQLite
+        no se puede usar a través de fork(): cada worker abre la suya.
+        """
+        if not self._ruta_sqlite:
+            return None
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self._ruta_sqlite, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS resultados "
+                             "(clave TEXT PRIMARY KEY, instante REAL, json TEXT)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    @property
+    def activa(self):
+        return self.max_items > 0
+
+    def obtener(self, clave):
+        """
+        Copia del resultado guardado o None (caducado = no está).
+        """
+        ahora = time.time()
+        with self._lock:
+            item = self._mem.get(clave)
+            if item is not None:
+                if ahora - item[0] <= self.ttl_s:
+                    self._mem.move_to_end(clave)
+                    return copy.deepcopy(item[1])
+                del self._mem[clave]
+
+            db = self._conexion()
+            if db is None:
+                return None
+            fila = db.execute("SELECT instante, json FROM resultados WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                return None
+            if ahora - fila[0] > self.ttl_s:
+                db.execute("DELETE FROM resultados WHERE clave = ?", (clave,))
+                db.commit()
+                return None
+            res = json.loads(fila[1])
+            self._guardar_mem(clave, fila[0], res)
+            return copy.deepcopy(res)
+
+    def guardar(self, clave, res):
+        if not self.activa or not res.get("ok"):
+            return
+        res = _limpio(res)
+        ahora = time.time()
+        with self._lock:
+            self._guardar_mem(clave, ahora, copy.deepcopy(res))
+            db = self._conexion()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO resultados VALUES (?, ?, ?)", (clave, ahora, json.dumps(res)))
+                self._escrituras += 1
+                if self._escrituras % 100 == 0:
+                    db.execute("DELETE FROM resultados WHERE instante < ?", (ahora - self.ttl_s,))
+                db.commit()
+
+    def _guardar_mem(self, clave, instante, res):
+        self._mem[clave] = (instante, res)
+        self._mem.move_to_end(clave)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def _entrar(self, clave):
+        """
+        (resultado_cacheado, futuro, soy_lider)
+        """
+        res = self.obtener(clave)
+        if res is not None:
+            metricas.CACHE.incrementar("hit")
+            return res, None, False
+        with self._lock:
+            fut = self._en_vuelo.get(clave)
+            if fut is not None:
+                metricas.CACHE.incrementar("agrupada")
+                return None, fut, False
+            fut = self._en_vuelo[clave] = Future()
+        metricas.CACHE.incrementar("miss")
+        return None, fut, True
+
+    def _salir(self, clave, fut, res=None, error=None):
+        with self._lock:
+            self._en_vuelo.pop(clave, None)
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            self.guardar(clave, res)
+            fut.set_result(_limpio(res))
+
+    def calcular(self, clave, fn):
+        """
+        Resultado de `fn()` para esta clave, reutilizando caché o un cálculo en curso.
+        """
+        res, fut, lider = self._entrar(clave)
+        if res is not None:
+            return {**res, "cache": True}
+        if not lider:
+            return {**copy.deepcopy(fut.result()), "cache": True}
+        try:
+            res = fn()
+        except BaseException as e:
+            self._salir(clave, fut, error=e)
+            raise
+        self._salir(clave, fut, res)
+        return res
+
+    async def calcular_async(self, clave, corofn):
+        """
+        Igual que calcular() pero para el servidor asíncrono (corofn devuelve una corrutina).
+        """
+        res, fut, lider = self._entrar(clave)
+        if res is not None:
+            return {**res, "cache": True}
+        if not lider:
+            return {**copy.deepcopy(await asyncio.wrap_future(fut)), "cache": True}
+        try:
+            res = await corofn()
+        except BaseException as e:
+            self._salir(clave, fut, error=e)
+            raise
+        self._salir(clave, fut, res)
+        return res
+
+
+cache_resultados = CacheResultados()
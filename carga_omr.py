@@ -0,0 +1,548 @@
+"""
+Prueba de carga de los dos servidores HTTP (Flask en omr.py, FastAPI en main.py)
+contra POST /corregir_omr.
+
+    python carga_omr.py --arrancar flask --concurrencia 8 --duracion 30
+    python carga_omr.py --arrancar fastapi --tasa 6 --duracion 60 --salida fastapi_6rps.json
+    python carga_omr.py --url http://localhost:8080 --pid 1234 --concurrencia 4 --muestras escaneos/
+    python carga_omr.py --arrancar flask --concurrencia 8 --comparar flask_8.json   # sale 1 si empeora
+
+- Hojas: sintéticas (sintetico.py, --hojas/--semilla) o ficheros reales (--muestras), en bucle.
+  Cada petición lleva unos bytes distintos tras el final de la imagen: la caché por
+  hash no acierta nunca (--cache para permitirlo).
+- Lazo cerrado (--concurrencia N): N clientes, cada uno envía la siguiente al recibir respuesta.
+  Lazo abierto (--tasa R): llegadas de Poisson a R peticiones/s sin esperar respuestas;
+  la latencia cuenta desde la hora programada (sin omisión coordinada).
+- --arrancar lanza servir.py en un puerto libre y espera a GET /listo.
+- Informe: latencia p50/p95/p99, throughput, errores, y CPU (núcleos) y memoria (PSS)
+  del árbol de procesos del servidor (/proc; con --arrancar o --pid).
+- --salida guarda configuración + resultados en JSON; --comparar los contrasta con otro.
+"""
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import sintetico
+from corregir_carpeta import buscar_archivos
+from omr import EXTENSIONES_IMAGEN, nucleos
+
+PERCENTILES = (50, 95, 99)
+RETRASO_ENVIO_S = 0.1   # lazo abierto: envío más tarde que esto = el cliente no da abasto
+MUESTREO_S = 0.5        # periodo de muestreo de CPU/memoria del servidor
+ESPERA_LISTO_S = 180
+
+
+# ------------------------------------------------------------
+# Hojas
+# ------------------------------------------------------------
+def _generar(args):
+    i, semilla = args
+    binario, _ = sintetico.hoja_aleatoria(np.random.default_rng([semilla, i]))
+    return f"sintetica_{i}.jpg", binario
+
+
+def cargar_muestras(entradas, hojas, semilla, procesos):
+    """
+    [(nombre, bytes)]: los ficheros de imagen de `entradas` o `hojas` sintéticas.
+    """
+    if entradas:
+        rutas = [r for r in buscar_archivos(entradas) if r.lower().endswith(EXTENSIONES_IMAGEN)]
+        muestras = []
+        for r in rutas:
+            with open(r, "rb") as f:
+                muestras.append((os.path.basename(r), f.read()))
+        return muestras
+    with ProcessPoolExecutor(max_workers=procesos) as pool:
+        return list(pool.map(_generar, [(i, semilla) for i in range(hojas)]))
+
+
+def _multipart(nombre, binario, extra):
+    frontera = uuid.uuid4().hex
+    cabecera = (f"--{frontera}\r\nContent-Disposition: form-data; name=\"imagen\"; filename=\"{nombre}\"\r\n"
+                f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    cuerpo = cabecera + binario + extra + f"\r\n--{frontera}--\r\n".encode()
+    return cuerpo, f"multipart/form-data; boundary={frontera}"
+
+
+# ------------------------------------------------------------
+# Cliente HTTP (una conexión keep-alive por hilo)
+# ------------------------------------------------------------
+class Cliente:
+    def __init__(self, url, muestras, timeout, cache=False):
+        u = urllib.parse.urlsplit(url)
+        self.host, self.puerto = u.hostname, u.port or 80
+        self.ruta = (u.path.rstrip("/") or "") + "/corregir_omr"
+        self.muestras = muestras
+        self.timeout = timeout
+        self.cache = cache
+        self._siguiente = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _conexion(self, nueva=False):
+        con = getattr(self._local, "con", None)
+        if con is None or nueva:
+            if con is not None:
+                con.close()
+            con = self._local.con = http.client.HTTPConnection(self.host, self.puerto, timeout=self.timeout)
+        return con
+
+    def enviar(self, t_prog=None):
+        """
+        Una petición con la siguiente hoja. Registro: dict con tiempos (perf_counter),
+        status HTTP (0 = sin respuesta), ok del OMR y error.
+        """
+        with self._lock:
+            n = next(self._siguiente)
+        nombre, binario = self.muestras[n % len(self.muestras)]
+        cuerpo, tipo = _multipart(nombre, binario, b"" if self.cache else f"carga {n}".encode())
+        t_envio = time.perf_counter()
+        reg = {"t_prog": t_envio if t_prog is None else t_prog, "t_envio": t_envio,
+               "status": 0, "ok": None, "error": None}
+        for intento in range(2):
+            con = self._conexion(nueva=intento > 0)
+            try:
+                con.request("POST", self.ruta, body=cuerpo, headers={"Content-Type": tipo})
+                r = con.getresponse()
+                datos = r.read()
+                reg["status"] = r.status
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                # el servidor cerró la conexión keep-alive ociosa: se reintenta una vez en una nueva
+                reg["error"] = f"{type(e).__name__}: {e}"
+                datos = None
+            except (OSError, http.client.HTTPException) as e:
+                reg["error"] = f"{type(e).__name__}: {e}"
+                self._conexion(nueva=True)
+                datos = None
+                break
+        reg["t_fin"] = time.perf_counter()
+        if reg["status"]:
+            reg["error"] = None
+            try:
+                reg["ok"] = bool(json.loads(datos).get("ok"))
+            except ValueError:
+                reg["ok"] = False
+        return reg
+
+
+def lazo_cerrado(cliente, concurrencia, t_fin):
+    registros = []
+    lock = threading.Lock()
+
+    def bucle():
+        while time.perf_counter() < t_fin:
+            reg = cliente.enviar()
+            with lock:
+                registros.append(reg)
+
+    hilos = [threading.Thread(target=bucle, daemon=True) for _ in range(concurrencia)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    return registros
+
+
+def lazo_abierto(cliente, tasa, t_fin, max_en_vuelo, semilla):
+    rng = np.random.default_rng(semilla)
+    futuros = []
+    with ThreadPoolExecutor(max_workers=max_en_vuelo) as pool:
+        t = time.perf_counter()
+        while True:
+            t += rng.exponential(1.0 / tasa)
+            if t >= t_fin:
+                break
+            espera = t - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            futuros.append(pool.submit(cliente.enviar, t))
+    return [f.result() for f in futuros]
+
+
+# ------------------------------------------------------------
+# CPU y memoria del servidor (árbol de procesos, /proc)
+# ------------------------------------------------------------
+def _arbol(raiz):
+    hijos = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        hijos.setdefault(ppid, []).append(int(d))
+    pids, pendientes = [], [raiz]
+    while pendientes:
+        p = pendientes.pop()
+        pids.append(p)
+        pendientes.extend(hijos.get(p, ()))
+    return pids
+
+
+def _cpu_s(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        campos = f.read().rsplit(")", 1)[1].split()
+    return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+
+
+def _memoria_mb(pid):
+    # PSS: las páginas compartidas tras el fork de gunicorn no cuentan dos veces
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for linea in f:
+                if linea.startswith("Pss:"):
+                    return int(linea.split()[1]) / 1024.0
+    except OSError:
+        pass
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+
+
+class MonitorServidor:
+    """
+    Muestrea cada MUESTREO_S el árbol de procesos de `pid`: CPU acumulada
+    (suma de incrementos por proceso, también los que nacen o mueren) y memoria.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.muestras = []  # (t, cpu_s acumulada, memoria_mb)
+        self._ultimo = {}
+        self._cpu = 0.0
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+
+    def _muestrear(self):
+        memoria = 0.0
+        vistos = {}
+        for p in _arbol(self.pid):
+            try:
+                cpu = _cpu_s(p)
+                memoria += _memoria_mb(p)
+            except (OSError, IndexError, ValueError):
+                continue  # el proceso acaba de terminar
+            if p in self._ultimo or self.muestras:
+                self._cpu += max(0.0, cpu - self._ultimo.get(p, 0.0))
+            vistos[p] = cpu
+        self._ultimo = vistos
+        self.muestras.append((time.perf_counter(), self._cpu, memoria))
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            self._muestrear()
+            self._parar.wait(MUESTREO_S)
+
+    def arrancar(self):
+        self._hilo.start()
+
+    def parar(self):
+        self._parar.set()
+        self._hilo.join()
+
+    def resumen(self, t_ini, t_fin, peticiones):
+        ventana = [m for m in self.muestras if t_ini <= m[0] <= t_fin]
+        if len(ventana) < 2:
+            return None
+        (t0, c0, _), (t1, c1, _) = ventana[0], ventana[-1]
+        return {
+            "cpu_nucleos": round((c1 - c0) / (t1 - t0), 2),
+            "cpu_ms_por_peticion": round((c1 - c0) * 1000.0 / max(1, peticiones), 1),
+            "memoria_pico_mb": round(max(m[2] for m in ventana), 1),
+            "memoria_media_mb": round(float(np.mean([m[2] for m in ventana])), 1),
+        }
+
+
+# ------------------------------------------------------------
+# Servidor local (servir.py)
+# ------------------------------------------------------------
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _get_json(url, timeout=2.0):
+    u = urllib.parse.urlsplit(url)
+    con = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=timeout)
+    try:
+        con.request("GET", u.path)
+        r = con.getresponse()
+        return r.status, json.loads(r.read() or b"null")
+    finally:
+        con.close()
+
+
+def arrancar_servidor(app, perfil, workers, hilos_cv):
+    """
+    servir.py en un puerto libre. Devuelve (proceso, url, log, estado de /listo).
+    """
+    puerto = _puerto_libre()
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "servir.py"),
+           "--app", app, "--perfil", perfil, "--host", "127.0.0.1", "--port", str(puerto)]
+    if workers:
+        cmd += ["--workers", str(workers)]
+    if hilos_cv:
+        cmd += ["--hilos-cv", str(hilos_cv)]
+    log = tempfile.NamedTemporaryFile(prefix=f"carga_{app}_", suffix=".log", delete=False)
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{puerto}"
+    limite = time.monotonic() + ESPERA_LISTO_S
+    while time.monotonic() < limite:
+        if proc.poll() is not None:
+            break
+        try:
+            status, estado = _get_json(url + "/listo")
+            if status == 200:
+                return proc, url, log.name, estado
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        time.sleep(0.2)
+    parar_servidor(proc)
+    raise RuntimeError(f"El servidor no llegó a estar listo (log: {log.name})")
+
+
+def parar_servidor(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+# ------------------------------------------------------------
+# Resultados
+# ------------------------------------------------------------
+def resumir(registros, t_ini, t_fin):
+    """
+    Estadísticas de las peticiones enviadas dentro de [t_ini, t_fin]
+    (throughput: respuestas 200 recibidas dentro de la ventana).
+    """
+    duracion = t_fin - t_ini
+    dentro = [r for r in registros if t_ini <= r["t_prog"] < t_fin]
+    lat = [(r["t_fin"] - r["t_prog"]) * 1000.0 for r in dentro if r["status"] == 200]
+    n = len(dentro)
+    http_200 = sum(r["status"] == 200 for r in dentro)
+    fallos_omr = sum(r["status"] == 200 and not r["ok"] for r in dentro)
+    rechazadas = sum(r["status"] == 503 for r in dentro)
+    sin_respuesta = sum(r["status"] == 0 for r in dentro)
+    errores = n - http_200
+    return {
+        "peticiones": n,
+        "respuestas_200": http_200,
+        "errores": errores,
+        "rechazadas_503": rechazadas,
+        "sin_respuesta": sin_respuesta,
+        "fallos_omr": fallos_omr,
+        "tasa_error": round(errores / float(max(1, n)), 4),
+        "throughput_hojas_s": round(sum(r["status"] == 200 and t_ini <= r["t_fin"] <= t_fin for r in registros)
+                                    / duracion, 3),
+        "ofrecidas_s": round(n / duracion, 3),
+        "envios_retrasados": sum(r["t_envio"] - r["t_prog"] > RETRASO_ENVIO_S for r in dentro),
+        "latencia_ms": ({f"p{p}": round(float(np.percentile(lat, p)), 1) for p in PERCENTILES}
+                        | {"media": round(float(np.mean(lat)), 1), "max": round(max(lat), 1)}) if lat else None,
+        "errores_ejemplo": sorted({r["error"] or f"HTTP {r['status']}" for r in dentro if r["status"] != 200})[:5],
+    }
+
+
+def informe(cfg, res):
+    modo = f"tasa {cfg['tasa']:g}/s" if cfg["modo"] == "abierto" else f"concurrencia {cfg['concurrencia']}"
+    print(f"\n{cfg['servidor']}: {modo}, {cfg['duracion']:g} s, {cfg['hojas']} hojas "
+          f"(JPEG medio {cfg['jpeg_medio_mb']:.2f} MB)")
+    if cfg.get("segundos_hasta_listo") is not None:
+        print(f"listo en     : {cfg['segundos_hasta_listo']:.2f} s")
+    print(f"peticiones   : {res['peticiones']} ({res['ofrecidas_s']:.2f}/s ofrecidas)")
+    print(f"throughput   : {res['throughput_hojas_s']:.2f} hojas/s")
+    lat = res["latencia_ms"]
+    if lat:
+        print(f"latencia ms  : p50 {lat['p50']:.0f}  p95 {lat['p95']:.0f}  p99 {lat['p99']:.0f}  "
+              f"máx {lat['max']:.0f}  (media {lat['media']:.0f})")
+    print(f"errores      : {res['errores']} ({100.0 * res['tasa_error']:.1f}%: {res['rechazadas_503']} x 503, "
+          f"{res['sin_respuesta']} sin respuesta); hojas no leídas (ok=false): {res['fallos_omr']}")
+    for e in res["errores_ejemplo"]:
+        print(f"    {e}")
+    if res["envios_retrasados"]:
+        print(f"AVISO: {res['envios_retrasados']} envíos salieron >{RETRASO_ENVIO_S * 1000:.0f} ms tarde: "
+              f"el cliente no da abasto (--max-en-vuelo)")
+    srv = res.get("servidor")
+    if srv:
+        print(f"servidor     : {srv['cpu_nucleos']:.2f} núcleos ({srv['cpu_ms_por_peticion']:.0f} ms CPU/petición), "
+              f"memoria pico {srv['memoria_pico_mb']:.0f} MB (media {srv['memoria_media_mb']:.0f} MB)")
+
+
+# (clave, más es mejor)
+METRICAS_COMPARADAS = [
+    (("throughput_hojas_s",), True),
+    (("latencia_ms", "p50"), False),
+    (("latencia_ms", "p95"), False),
+    (("latencia_ms", "p99"), False),
+    (("tasa_error",), False),
+    (("servidor", "cpu_ms_por_peticion"), False),
+    (("servidor", "memoria_pico_mb"), False),
+]
+CONFIG_COMPARABLE = ("servidor", "app", "perfil", "workers", "modo", "concurrencia", "tasa", "hojas", "cpus")
+
+
+def _valor(d, clave):
+    for k in clave:
+        d = (d or {}).get(k)
+    return d
+
+
+def comparar(base, actual, tolerancia):
+    """
+    Tabla base -> actual. Devuelve False si el throughput baja, el p95 sube más de
+    `tolerancia` (fracción) o la tasa de error sube más de 1 punto.
+    """
+    distintas = [k for k in CONFIG_COMPARABLE if base["config"].get(k) != actual["config"].get(k)]
+    if distintas:
+        print(f"\nAVISO: configuración distinta en {', '.join(distintas)}: la comparación es orientativa")
+    print(f"\n{'métrica':<30}{'base':>10}{'actual':>10}{'cambio':>9}")
+    for clave, _ in METRICAS_COMPARADAS:
+        b, a = _valor(base["resultados"], clave), _valor(actual["resultados"], clave)
+        if b is None or a is None:
+            continue
+        cambio = f"{100.0 * (a - b) / b:+.1f}%" if b else "-"
+        print(f"{'.'.join(clave):<30}{b:>10g}{a:>10g}{cambio:>9}")
+
+    rb, ra = base["resultados"], actual["resultados"]
+    ok = True
+    if ra["throughput_hojas_s"] < rb["throughput_hojas_s"] * (1.0 - tolerancia):
+        print(f"REGRESIÓN: throughput {rb['throughput_hojas_s']:g} -> {ra['throughput_hojas_s']:g} hojas/s")
+        ok = False
+    p95b, p95a = _valor(rb, ("latencia_ms", "p95")), _valor(ra, ("latencia_ms", "p95"))
+    if p95b and (p95a is None or p95a > p95b * (1.0 + tolerancia)):
+        print(f"REGRESIÓN: latencia p95 {p95b:g} -> {p95a} ms")
+        ok = False
+    if ra["tasa_error"] > rb["tasa_error"] + 0.01:
+        print(f"REGRESIÓN: tasa de error {rb['tasa_error']:g} -> {ra['tasa_error']:g}")
+        ok = False
+    return ok
+
+
+def _commit_git():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    destino = ap.add_mutually_exclusive_group(required=True)
+    destino.add_argument("--url", help="servidor ya arrancado (p. ej. http://localhost:8080)")
+    destino.add_argument("--arrancar", choices=("flask", "fastapi"), help="lanzar servir.py con esta app")
+    ap.add_argument("--pid", type=int, default=0, help="con --url: PID del servidor para medir CPU/memoria")
+    ap.add_argument("--perfil", choices=("throughput", "latencia"), default="throughput",
+                    help="con --arrancar (servir.py)")
+    ap.add_argument("--workers", type=int, default=0, help="con --arrancar: procesos del servidor (0 = servir.py)")
+    ap.add_argument("--hilos-cv", type=int, default=0, help="con --arrancar: hilos OpenCV por proceso")
+
+    modo = ap.add_mutually_exclusive_group(required=True)
+    modo.add_argument("--concurrencia", type=int, help="lazo cerrado: clientes simultáneos")
+    modo.add_argument("--tasa", type=float, help="lazo abierto: peticiones/s (llegadas de Poisson)")
+    ap.add_argument("--duracion", type=float, default=30.0, help="segundos medidos")
+    ap.add_argument("--calentamiento", type=float, default=3.0, help="segundos iniciales que no se miden")
+    ap.add_argument("--max-en-vuelo", type=int, default=256, help="lazo abierto: peticiones abiertas a la vez")
+    ap.add_argument("--timeout", type=float, default=120.0, help="segundos máx. por petición")
+
+    ap.add_argument("--muestras", nargs="*", default=None, help="directorios, globs o imágenes a reenviar")
+    ap.add_argument("--hojas", type=int, default=12, help="sin --muestras: hojas sintéticas distintas")
+    ap.add_argument("--semilla", type=int, default=0)
+    ap.add_argument("--cache", action="store_true", help="no variar los bytes: deja acertar la caché por hash")
+
+    ap.add_argument("--salida", default="", help="guardar configuración + resultados en este JSON")
+    ap.add_argument("--comparar", default="", help="JSON de una ejecución anterior (sale 1 si empeora)")
+    ap.add_argument("--tolerancia", type=float, default=0.10, help="con --comparar: empeoramiento admitido")
+    a = ap.parse_args()
+
+    muestras = cargar_muestras(a.muestras, a.hojas, a.semilla, nucleos())
+    if not muestras:
+        ap.error("no hay imágenes que enviar")
+    print(f"{len(muestras)} hojas cargadas", file=sys.stderr, flush=True)
+
+    proc = log = None
+    estado_listo = {}
+    if a.arrancar:
+        proc, url, log, estado_listo = arrancar_servidor(a.arrancar, a.perfil, a.workers, a.hilos_cv)
+        pid = proc.pid
+        print(f"{a.arrancar} listo en {url} (log: {log})", file=sys.stderr, flush=True)
+    else:
+        url, pid = a.url.rstrip("/"), a.pid
+
+    monitor = None
+    if pid and os.path.isdir("/proc"):
+        monitor = MonitorServidor(pid)
+        monitor.arrancar()
+
+    cliente = Cliente(url, muestras, a.timeout, a.cache)
+    t0 = time.perf_counter()
+    t_ini, t_fin = t0 + a.calentamiento, t0 + a.calentamiento + a.duracion
+    try:
+        if a.concurrencia:
+            registros = lazo_cerrado(cliente, a.concurrencia, t_fin)
+        else:
+            registros = lazo_abierto(cliente, a.tasa, t_fin, a.max_en_vuelo, a.semilla)
+    finally:
+        if monitor:
+            monitor.parar()
+        if proc:
+            parar_servidor(proc)
+
+    res = resumir(registros, t_ini, t_fin)
+    res["servidor"] = monitor.resumen(t_ini, t_fin, res["peticiones"]) if monitor else None
+    cfg = {
+        "servidor": a.arrancar or url,
+        "app": a.arrancar,
+        "perfil": a.perfil if a.arrancar else None,
+        "workers": a.workers if a.arrancar else None,
+        "modo": "cerrado" if a.concurrencia else "abierto",
+        "concurrencia": a.concurrencia,
+        "tasa": a.tasa,
+        "duracion": a.duracion,
+        "hojas": len(muestras),
+        "sinteticas": not a.muestras,
+        "semilla": a.semilla,
+        "cache": a.cache,
+        "jpeg_medio_mb": round(float(np.mean([len(b) for _, b in muestras])) / 1e6, 3),
+        "segundos_hasta_listo": estado_listo.get("segundos_hasta_listo"),
+        "cpus": nucleos(),
+        "host": platform.node(),
+        "commit": _commit_git(),
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    informe(cfg, res)
+
+    resultado = {"config": cfg, "resultados": res}
+    if a.salida:
+        with open(a.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+        print(f"\nguardado en {a.salida}")
+    if a.comparar:
+        with open(a.comparar, encoding="utf-8") as f:
+            base = json.load(f)
+        if not comparar(base, resultado, a.tolerancia):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
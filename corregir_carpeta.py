@@ -0,0 +1,235 @@
+"""
+Corrección offline de las carpetas del escáner, sin servidor web.
+
+    python corregir_carpeta.py escaneos/ --salida notas.csv
+    python corregir_carpeta.py "escaneos/**/*.jpg" otro.pdf --salida notas.jsonl --procesos 8
+
+- Directorios (recursivo), globs y ficheros sueltos: imágenes y PDF/TIFF
+  multipágina (una fila por página, "hoja" desde 0).
+- Pool de procesos; cada resultado se escribe en cuanto sale (CSV o JSONL
+  según la extensión de --salida).
+- Reanudable: lo que ya está en la salida (archivo, hoja) no se vuelve a corregir;
+  un registro cortado a medias al final se recorta al empezar.
+- Si un proceso muere, el pool se rehace y las hojas que estaban en vuelo se
+  repiten de una en una: la que lo vuelve a tumbar queda como fallo.
+- Al final: hojas/s y cuántas fallaron.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import documento_omr
+import omr
+
+EXTENSIONES = omr.EXTENSIONES_IMAGEN + (".pdf",)
+COLUMNAS = ["archivo", "hoja", "ok", "error", "codigo", "id_examen", "id_alumno", "fecha",
+            "num_preguntas", "pagina", "respuestas", "ms"]
+
+
+def buscar_archivos(entradas):
+    """
+    Rutas (ordenadas, sin repetir) de directorios, globs y ficheros.
+    """
+    rutas = []
+    for e in entradas:
+        if os.path.isdir(e):
+            for raiz, _, nombres in os.walk(e):
+                rutas.extend(os.path.join(raiz, n) for n in nombres if n.lower().endswith(EXTENSIONES))
+        elif os.path.isfile(e):
+            rutas.append(e)
+        else:
+            rutas.extend(r for r in glob.glob(e, recursive=True) if os.path.isfile(r))
+    return sorted(set(rutas))
+
+
+def hojas_de(ruta):
+    """
+    [(ruta, hoja, tipo)]: una por imagen, una por página de PDF/TIFF.
+    """
+    with open(ruta, "rb") as f:
+        tipo = documento_omr.tipo_documento(f.read(8))
+    if tipo is None:
+        return [(ruta, 0, None)]
+    try:
+        paginas = documento_omr.contar_paginas(ruta, tipo)
+    except Exception:
+        paginas = 1  # ilegible: queda registrado como fallo de la hoja 0
+    return [(ruta, i, tipo) for i in range(max(1, paginas))]
+
+
+def recortar_incompleto(salida):
+    """
+    Trunca `salida` tras el último registro completo (un corte a mitad de
+    escritura deja el final a medias). En CSV un salto dentro de un campo
+    entrecomillado no cierra registro: se cuentan las comillas.
+    """
+    if not os.path.exists(salida):
+        return
+    with open(salida, "rb") as f:
+        datos = f.read()
+    if salida.lower().endswith(".csv"):
+        fin = comillas = 0
+        for i, c in enumerate(datos):
+            if c == 0x22:  # "
+                comillas ^= 1
+            elif c == 0x0A and not comillas:  # \n
+                fin = i + 1
+    else:
+        fin = datos.rfind(b"\n") + 1
+    if fin < len(datos):
+        with open(salida, "r+b") as f:
+            f.truncate(fin)
+
+
+def ya_corregidas(salida):
+    """
+    {(archivo, hoja)} ya escritas en `salida`.
+    """
+    hechas = set()
+    if not os.path.exists(salida):
+        return hechas
+    with open(salida, newline="", encoding="utf-8") as f:
+        if salida.lower().endswith(".csv"):
+            for fila in csv.DictReader(f):
+                if fila.get("ms") is not None:
+                    hechas.add((fila["archivo"], int(fila["hoja"])))
+        else:
+            for linea in f:
+                try:
+                    r = json.loads(linea)
+                except ValueError:
+                    continue
+                if isinstance(r, dict) and "archivo" in r:
+                    hechas.add((r["archivo"], int(r["hoja"])))
+    return hechas
+
+
+def _corregir(ruta, hoja, tipo, detector):
+    # en el worker: el fichero se lee aquí, no viaja por pickle
+    if tipo is None:
+        try:
+            with open(ruta, "rb") as f:
+                binario = f.read()
+        except OSError as e:
+            return {"ok": False, "error": str(e)}
+        res = omr._procesar_item(binario, None, detector)
+    else:
+        res = omr._procesar_pagina(ruta, tipo, hoja, None, detector)
+    medidas = res.pop("_metricas", None)
+    if medidas:
+        res["ms"] = round(medidas["tiempos"]["total"] * 1000.0, 1)
+    return res
+
+
+class Escritor:
+    def __init__(self, salida):
+        self.csv = salida.lower().endswith(".csv")
+        nuevo = not os.path.exists(salida) or os.path.getsize(salida) == 0
+        self.f = open(salida, "a", newline="", encoding="utf-8")
+        if self.csv:
+            self.w = csv.DictWriter(self.f, COLUMNAS, extrasaction="ignore")
+            if nuevo:
+                self.w.writeheader()
+
+    def escribir(self, ruta, hoja, res):
+        fila = {"archivo": ruta, "hoja": hoja, **res}
+        if self.csv:
+            if "respuestas" in fila:
+                fila["respuestas"] = json.dumps(fila["respuestas"], ensure_ascii=False)
+            fila.setdefault("ms", "")
+            self.w.writerow(fila)
+        else:
+            self.f.write(json.dumps(fila, ensure_ascii=False) + "\n")
+        self.f.flush()  # reanudable aunque se corte a mitad
+
+    def cerrar(self):
+        self.f.close()
+
+
+def _crear_pool(procesos):
+    return ProcessPoolExecutor(max_workers=procesos, initializer=omr.iniciar_proceso_pool,
+                               initargs=(omr.hilos_cv_pool(procesos),))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("entradas", nargs="+", help="directorios, globs o ficheros")
+    ap.add_argument("--salida", required=True, help="fichero .csv o .jsonl (se añade al final)")
+    ap.add_argument("--procesos", type=int, default=omr.LOTE_WORKERS)
+    ap.add_argument("--detector", choices=sorted(omr.DETECTORES), default=None,
+                    help=f"detector de burbujas (por defecto {omr.DETECTOR_CIRCULOS})")
+    a = ap.parse_args()
+
+    rutas = buscar_archivos(a.entradas)
+    recortar_incompleto(a.salida)
+    hechas = ya_corregidas(a.salida)
+    pendientes = [h for r in rutas for h in hojas_de(r) if (h[0], h[1]) not in hechas]
+    print(f"{len(rutas)} ficheros, {len(pendientes)} hojas por corregir "
+          f"({len(hechas)} ya en {a.salida})", file=sys.stderr, flush=True)
+
+    escritor = Escritor(a.salida)
+    ok = fallos = 0
+    t0 = time.perf_counter()
+    pool = _crear_pool(a.procesos)
+    try:
+        cola = iter(pendientes)
+        sospechosas = []  # en vuelo cuando murió un proceso: se repiten solas
+        en_vuelo = {}
+        while True:
+            if sospechosas:
+                if not en_vuelo:
+                    ruta, hoja, tipo = sospechosas.pop()
+                    en_vuelo[pool.submit(_corregir, ruta, hoja, tipo, a.detector)] = (ruta, hoja, tipo, True)
+            else:
+                # como mucho 2 por proceso en vuelo: no se encolan miles de futuros
+                for ruta, hoja, tipo in cola:
+                    en_vuelo[pool.submit(_corregir, ruta, hoja, tipo, a.detector)] = (ruta, hoja, tipo, False)
+                    if len(en_vuelo) >= 2 * a.procesos:
+                        break
+            if not en_vuelo:
+                break
+            hechos, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            roto = False
+            while hechos:
+                for fut in hechos:
+                    ruta, hoja, tipo, sola = en_vuelo.pop(fut)
+                    try:
+                        res = fut.result()
+                    except BrokenProcessPool:
+                        roto = True
+                        if not sola:
+                            sospechosas.append((ruta, hoja, tipo))
+                            continue
+                        res = {"ok": False, "error": "el proceso murió corrigiendo esta hoja"}
+                    except Exception as e:
+                        res = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                    escritor.escribir(ruta, hoja, res)
+                    if res.get("ok"):
+                        ok += 1
+                    else:
+                        fallos += 1
+                # roto: el resto de futuros ya falla también; se recogen antes de rehacer el pool
+                hechos = wait(en_vuelo)[0] if roto else ()
+            if roto:
+                print(f"un proceso murió: se rehace el pool ({len(sospechosas)} hojas a repetir)",
+                      file=sys.stderr, flush=True)
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = _crear_pool(a.procesos)
+    finally:
+        pool.shutdown()
+        escritor.cerrar()
+
+    seg = time.perf_counter() - t0
+    n = ok + fallos
+    print(f"{n} hojas en {seg:.1f} s ({n / seg if seg > 0 else 0.0:.2f} hojas/s): "
+          f"{ok} correctas, {fallos} con fallo", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
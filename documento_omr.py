@@ -0,0 +1,157 @@
+"""
+Documentos multipágina (PDF / TIFF) de los escáneres con alimentador.
+
+- Las páginas se leen de una en una desde el fichero en disco: nunca está
+  todo el documento decodificado en memoria.
+- PDF escaneado (una imagen por página): se decodifica la imagen embebida tal
+  cual; si no, se renderiza la página a OMR_DOC_DPI.
+- Límite de píxeles (OMR_IMAGEN_MAX_MPX, el mismo que las subidas) ANTES de
+  decodificar: tamaño de la página en puntos, ancho x alto de la imagen
+  embebida y cabecera (IFD) de la página TIFF. Una página que no cabe se
+  renderiza a menos dpi; si ni así, o si la imagen es mayor, la página falla
+  con ValueError (el mensaje sale como error de esa página).
+- PDF necesita PyMuPDF (opcional; su licencia es AGPL); TIFF va con OpenCV.
+"""
+import os
+import struct
+
+import cv2
+import numpy as np
+
+try:
+    import pymupdf
+except ImportError:  # sin PyMuPDF sólo TIFF
+    pymupdf = None
+
+DOC_DPI = int(os.environ.get("OMR_DOC_DPI", "300"))  # A4 a 300 dpi = 2480x3508, como la plantilla
+DOC_DPI_MIN = 72  # una página que sólo cabe por debajo no es una hoja
+DOC_COBERTURA_MIN = 0.5  # la imagen embebida debe ocupar al menos media página
+IMAGEN_MAX_MPX = float(os.environ.get("OMR_IMAGEN_MAX_MPX", "120"))  # como omr.IMAGEN_MAX_MPX
+
+
+def _comprobar_pixeles(ancho, alto):
+    if ancho * alto > IMAGEN_MAX_MPX * 1e6:
+        raise ValueError(f"Página de demasiados píxeles (máx {IMAGEN_MAX_MPX:g} Mpx)")
+
+
+def tipo_documento(cabecera):
+    """
+    "pdf", "tiff" o None según los primeros bytes del fichero.
+    """
+    if cabecera[:5] == b"%PDF-":
+        return "pdf"
+    if cabecera[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+        return "tiff"
+    return None
+
+
+def _requiere_pdf():
+    if pymupdf is None:
+        raise ValueError("Soporte PDF no disponible (pip install pymupdf)")
+
+
+def contar_paginas(ruta, tipo):
+    if tipo == "pdf":
+        _requiere_pdf()
+        with pymupdf.open(ruta) as doc:
+            return doc.page_count
+    return cv2.imcount(ruta)
+
+
+def leer_pagina(ruta, tipo, i):
+    """
+    BGR de la página i (desde 0) o None si no se puede leer.
+    """
+    if tipo == "pdf":
+        return _pagina_pdf(ruta, i)
+    dims = dimensiones_tiff(ruta, i)
+    if dims is None:
+        return None
+    _comprobar_pixeles(*dims)
+    ok, mats = cv2.imreadmulti(ruta, i, 1, flags=cv2.IMREAD_COLOR)
+    return mats[0] if ok and mats else None
+
+
+def dimensiones_tiff(ruta, i):
+    """
+    (ancho, alto) de la página i leyendo sólo los IFD del TIFF (o BigTIFF). None si no se sabe.
+    """
+    try:
+        return _dimensiones_tiff(ruta, i)
+    except struct.error:  # fichero truncado
+        return None
+
+
+def _dimensiones_tiff(ruta, i):
+    with open(ruta, "rb") as f:
+        cabecera = f.read(16)
+        orden = "<" if cabecera[:2] == b"II" else ">"
+        grande = struct.unpack(orden + "H", cabecera[2:4])[0] == 43
+        if grande:
+            ent, cuenta, tam, desplaz = 20, "Q", 8, struct.unpack(orden + "Q", cabecera[8:16])[0]
+        else:
+            ent, cuenta, tam, desplaz = 12, "H", 4, struct.unpack(orden + "I", cabecera[4:8])[0]
+        n_cuenta = struct.calcsize(cuenta)
+        for _ in range(i):
+            if not desplaz:
+                return None
+            f.seek(desplaz)
+            n = struct.unpack(orden + cuenta, f.read(n_cuenta))[0]
+            f.seek(desplaz + n_cuenta + n * ent)
+            desplaz = struct.unpack(orden + ("Q" if grande else "I"), f.read(tam))[0]
+        if not desplaz:
+            return None
+        f.seek(desplaz)
+        datos = f.read(n_cuenta)
+        if len(datos) < n_cuenta:
+            return None
+        n = struct.unpack(orden + cuenta, datos)[0]
+        entradas = f.read(n * ent)
+    dims = {}
+    for k in range(len(entradas) // ent):
+        e = entradas[k * ent:(k + 1) * ent]
+        etiqueta, tipo = struct.unpack(orden + "HH", e[:4])
+        if etiqueta in (256, 257):  # ImageWidth, ImageLength: SHORT, LONG o LONG8
+            fmt = {3: "H", 4: "I", 16: "Q"}.get(tipo)
+            if fmt is None:
+                return None
+            valor = e[12:] if grande else e[8:]  # tras etiqueta, tipo y número de valores
+            dims[etiqueta] = struct.unpack(orden + fmt, valor[:struct.calcsize(fmt)])[0]
+    if len(dims) != 2:
+        return None
+    return dims[256], dims[257]
+
+
+def _imagen_escaneada(doc, pagina):
+    imagenes = pagina.get_images(full=True)
+    if len(imagenes) != 1:
+        return None
+    xref, _, ancho, alto = imagenes[0][:4]
+    area = abs(pagina.rect)
+    rects = pagina.get_image_rects(xref)
+    if not rects or area <= 0 or abs(rects[0]) < DOC_COBERTURA_MIN * area:
+        return None
+    _comprobar_pixeles(ancho, alto)
+    datos = doc.extract_image(xref)
+    if not datos:
+        return None
+    return cv2.imdecode(np.frombuffer(datos["image"], np.uint8), cv2.IMREAD_COLOR)
+
+
+def _pagina_pdf(ruta, i):
+    _requiere_pdf()
+    with pymupdf.open(ruta) as doc:
+        pagina = doc.load_page(i)
+        img = _imagen_escaneada(doc, pagina)
+        if img is not None:
+            return img
+        # tamaño en puntos (1/72"): a DOC_DPI si cabe en el límite, si no a menos dpi
+        puntos = pagina.rect.width * pagina.rect.height
+        dpi = DOC_DPI
+        if puntos * (dpi / 72.0) ** 2 > IMAGEN_MAX_MPX * 1e6:
+            dpi = int(72.0 * (IMAGEN_MAX_MPX * 1e6 / puntos) ** 0.5)
+            if dpi < DOC_DPI_MIN:
+                raise ValueError(f"Página demasiado grande (máx {IMAGEN_MAX_MPX:g} Mpx a {DOC_DPI_MIN} dpi)")
+        pix = pagina.get_pixmap(dpi=dpi, colorspace=pymupdf.csRGB, alpha=False)
+        rgb = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, 3)
+        return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
@@ -1,26 +1,212 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
-from omr import procesar_omr
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import List
+
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import metricas
+from cache_omr import cache_resultados, hash_binario
+from omr import (abrir_documento, almacen_debug, borrar_documento, cola_trabajos, elegir_detector, enviar_trabajo,
+                 estado_arranque, marcar_listo, ndjson, opciones_debug, pedir_timings, procesar_documento,
+                 procesar_lote, publicar_debug, publicar_metricas, usar_pool_lote)
+from pool_omr import PoolOMR, PoolSaturado
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+pool = None
+
+
+async def _calentar_pool():
+    # en segundo plano: uvicorn ya acepta conexiones y /listo da 503 hasta que acabe
+    t0 = time.perf_counter()
+    try:
+        estados = await pool.calentar()
+    except Exception as e:  # p.ej. un worker no arrancó a tiempo: se sirve igual
+        logging.warning("OMR: calentamiento del pool fallido: %s", e)
+        marcar_listo(time.perf_counter() - t0, False)
+        return
+    oks = [e["calentamiento_ok"] for e in estados]
+    marcar_listo(time.perf_counter() - t0, None if None in oks else all(oks))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = PoolOMR()
+    usar_pool_lote(pool)  # lote y documentos en los mismos procesos: no más que OMR_WORKERS
+    cola_trabajos.arrancar()  # retoma los trabajos que quedaron a medias
+    calentamiento = asyncio.create_task(_calentar_pool())
+    yield
+    calentamiento.cancel()
+    pool.cerrar()
+
+
+app = FastAPI(lifespan=lifespan)
+
+def _saturado(e):
+    return JSONResponse({"ok": False, "error": str(e)}, status_code=503, headers={"Retry-After": str(e.retry_after)})
+
+def _admitir():
+    # lote y documentos: sus imágenes cuentan en pool.pendientes; lleno => 503 antes de empezar
+    if pool.saturado():
+        raise PoolSaturado(pool.retry_after())
 
 @app.post("/corregir_omr")
-async def corregir_omr(imagen: UploadFile = File(...)):
+async def corregir_omr(
+    imagen: UploadFile = File(...),
+    debug: str = Form(None),
+    debug_escala: str = Form(None),
+    debug_calidad: str = Form(None),
+    timings: str = Form(None),
+    detector: str = Form(None),
+):
     try:
         binario = await imagen.read()
 
         if not binario:
             return JSONResponse({"ok": False, "error": "Imagen vacía"}, status_code=400)
 
-        resultado = procesar_omr(binario)
+        try:
+            opciones = opciones_debug(debug, debug_escala, debug_calidad)
+            detector = elegir_detector(detector)
+        except ValueError as e:
+            return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+        if opciones or detector or not cache_resultados.activa:
+            resultado = await pool.procesar(binario, opciones, detector)
+        else:
+            # reintentos / doble envío: misma foto => mismo resultado, una sola vez
+            resultado = await cache_resultados.calcular_async(
+                hash_binario(binario), lambda: pool.procesar(binario)
+            )
+        resultado = publicar_metricas(publicar_debug(resultado, opciones), pedir_timings(timings))
         return JSONResponse(resultado)
 
+    except PoolSaturado as e:
+        return _saturado(e)
     except Exception as e:
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
+@app.post("/corregir_omr_lote")
+async def corregir_omr_lote(
+    imagenes: List[UploadFile] = File(...),
+    debug: str = Form(None),
+    debug_escala: str = Form(None),
+    debug_calidad: str = Form(None),
+    timings: str = Form(None),
+    detector: str = Form(None),
+):
+    try:
+        try:
+            opciones = opciones_debug(debug, debug_escala, debug_calidad)
+            detector = elegir_detector(detector)
+        except ValueError as e:
+            return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+        _admitir()
+        archivos = [(f.filename, await f.read()) for f in imagenes]
+
+        # el lote reparte en procesos; esperamos fuera del event loop
+        resultado = await run_in_threadpool(procesar_lote, archivos, opciones, pedir_timings(timings),
+                                            detector)
+        return JSONResponse(resultado, status_code=200 if resultado["ok"] else 400)
+
+    except PoolSaturado as e:
+        return _saturado(e)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+def _guardar_documento(fichero):
+    # a disco: los workers leen cada página del fichero
+    fd, ruta = tempfile.mkstemp(prefix="omr_doc_")
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(fichero, f)
+    return ruta
+
+@app.post("/corregir_omr_documento")
+async def corregir_omr_documento(
+    documento: UploadFile = File(...),
+    debug: str = Form(None),
+    debug_escala: str = Form(None),
+    debug_calidad: str = Form(None),
+    timings: str = Form(None),
+    detector: str = Form(None),
+):
+    try:
+        opciones = opciones_debug(debug, debug_escala, debug_calidad)
+        detector = elegir_detector(detector)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    try:
+        _admitir()
+    except PoolSaturado as e:
+        return _saturado(e)
+
+    ruta = await run_in_threadpool(_guardar_documento, documento.file)
+    try:
+        tipo, paginas = await run_in_threadpool(abrir_documento, ruta)
+    except ValueError as e:
+        os.remove(ruta)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+    # generador síncrono: Starlette lo itera en el threadpool, línea a línea
+    resultados = procesar_documento(ruta, tipo, paginas, opciones, pedir_timings(timings), detector)
+    # BackgroundTask: se borra aunque el stream no llegue a empezar (cliente que se va)
+    return StreamingResponse(ndjson(resultados), media_type="application/x-ndjson",
+                             background=BackgroundTask(borrar_documento, ruta))
+
+@app.post("/trabajos", status_code=202)
+async def crear_trabajo(
+    imagenes: List[UploadFile] = File(...),
+    prioridad: str = Form(None),
+    callback: str = Form(None),
+    debug: str = Form(None),
+    debug_escala: str = Form(None),
+    debug_calidad: str = Form(None),
+    timings: str = Form(None),
+    detector: str = Form(None),
+):
+    try:
+        opciones = opciones_debug(debug, debug_escala, debug_calidad)
+        detector = elegir_detector(detector)
+        archivos = [(f.filename, await f.read()) for f in imagenes]
+        # escribe el spool y la base de datos: fuera del event loop
+        return await run_in_threadpool(enviar_trabajo, archivos, prioridad, callback, opciones,
+                                       pedir_timings(timings), detector)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+
+@app.get("/trabajos/{id_trabajo}")
+async def ver_trabajo(id_trabajo: str, resultados: str = None):
+    res = await run_in_threadpool(cola_trabajos.consultar, id_trabajo,
+                                  (resultados or "").strip().lower() not in ("0", "false", "no"))
+    if res is None:
+        return JSONResponse({"ok": False, "error": "Trabajo no encontrado"}, status_code=404)
+    return res
+
+@app.get("/debug/{id_resultado}/{tipo}")
+async def ver_debug(id_resultado: str, tipo: str):
+    jpg = almacen_debug.obtener(id_resultado, tipo)
+    if jpg is None:
+        return JSONResponse({"ok": False, "error": "Debug no encontrado (caducado o id incorrecto)"}, status_code=404)
+    return Response(jpg, media_type="image/jpeg")
+
+@app.get("/metrics")
+async def ver_metricas():
+    return Response(metricas.exponer(), media_type=metricas.CONTENT_TYPE)
+
+@app.get("/listo")
+async def ver_listo():
+    estado = estado_arranque()
+    return JSONResponse(estado, status_code=200 if estado["listo"] else 503)
+
 @app.get("/")
 async def root():
     return {"ok": True, "mensaje": "Servidor OMR activo"}
@@ -0,0 +1,224 @@
+"""
+Métricas del pipeline OMR en formato texto de Prometheus (sin dependencias).
+
+- Histogramas: duración por etapa, intentos QR, círculos detectados, filas reconstruidas,
+  filas repetidas a resolución completa (modo rápido).
+- Contadores: hojas por resultado, vía y decodificador que leyeron el QR, uso de la rejilla cacheada,
+  rechazos del filtro de calidad, desenlace del pase rápido.
+
+Los workers NO escriben aquí: cada resultado trae res["_metricas"] y el proceso
+que sirve HTTP lo registra (registrar_hoja), así el pool de procesos también cuenta.
+
+Con varios procesos HTTP (gunicorn) cada uno tiene sus series: con OMR_METRICAS_DIR
+(servir.py lo fija) cada proceso vuelca las suyas a <dir>/<pid>.json tras cada cambio
+y /metrics suma las de todos, así cualquier worker que atienda el scrape da lo mismo.
+"""
+import json
+import os
+import threading
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_INTENTOS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+BUCKETS_CIRCULOS = (20, 60, 100, 120, 140, 200, 400)
+BUCKETS_FILAS = (0, 1, 2, 5, 10, 30)
+
+DIRECTORIO = os.environ.get("OMR_METRICAS_DIR", "")  # vacío = sólo este proceso
+_local = threading.local()  # profundidad de _agrupar() en este hilo
+_lock_volcado = threading.Lock()
+if DIRECTORIO:
+    os.makedirs(DIRECTORIO, exist_ok=True)
+
+
+def _etiquetas(nombres, valores, extra=None):
+    pares = list(zip(nombres, valores))
+    if extra:
+        pares.append(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}"
+
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, buckets, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.buckets = tuple(buckets)
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}  # valores etiquetas -> [conteos por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        with self._lock:
+            serie = self._series.setdefault(etiquetas, [0] * len(self.buckets) + [0.0, 0])
+            for i, b in enumerate(self.buckets):
+                if valor <= b:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+        _cambio()
+
+    def estado(self):
+        with self._lock:
+            return [[list(k), list(v)] for k, v in self._series.items()]
+
+    def exponer(self, otros=()):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for estado in otros:
+            for etiquetas, valores in estado:
+                serie = series.setdefault(tuple(etiquetas), [0] * len(self.buckets) + [0.0, 0])
+                for i, v in enumerate(valores):
+                    serie[i] += v
+        for etiquetas, serie in sorted(series.items()):
+            for b, n in zip(self.buckets, serie):
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, ('le', _num(b)))} {n}")
+            lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, ('le', '+Inf'))} {serie[-1]}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, etiquetas)} {_num(serie[-2])}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, etiquetas)} {serie[-1]}")
+        return lineas
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, *etiquetas, n=1):
+        with self._lock:
+            self._series[etiquetas] = self._series.get(etiquetas, 0) + n
+        _cambio()
+
+    def estado(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._series.items()]
+
+    def exponer(self, otros=()):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for estado in otros:
+            for etiquetas, n in estado:
+                series[tuple(etiquetas)] = series.get(tuple(etiquetas), 0) + n
+        for etiquetas, n in sorted(series.items()):
+            lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {n}")
+        return lineas
+
+
+ETAPA_SEGUNDOS = Histograma("omr_etapa_segundos", "Duración de cada etapa del pipeline OMR por hoja",
+                            BUCKETS_SEGUNDOS, ("etapa",))
+QR_INTENTOS = Histograma("omr_qr_intentos", "Decodificaciones QR intentadas por hoja", BUCKETS_INTENTOS)
+CIRCULOS = Histograma("omr_circulos_detectados", "Círculos encontrados en la zona OMR por cada detector",
+                      BUCKETS_CIRCULOS, ("detector",))
+FILAS_RECONSTRUIDAS = Histograma("omr_filas_reconstruidas", "Filas que agrupar_filas tuvo que reconstruir",
+                                 BUCKETS_FILAS)
+FILAS_ESCALADAS = Histograma("omr_filas_escaladas", "Filas dudosas del pase rápido repetidas a resolución completa",
+                             BUCKETS_FILAS)
+HOJAS = Contador("omr_hojas_total", "Hojas procesadas por resultado", ("resultado",))
+QR_VIA = Contador("omr_qr_lectura_total", "Hojas por vía que leyó el QR (marcas, foto, a4, ninguna)", ("via",))
+QR_DECODIFICADOR = Contador("omr_qr_decodificador_total", "Hojas por backend que decodificó el QR (qr_omr)",
+                            ("decodificador",))
+REJILLA = Contador("omr_rejilla_total", "Uso de la rejilla cacheada por examen (cache, detectada, descartada)",
+                   ("resultado",))
+CACHE = Contador("omr_cache_total", "Caché de resultados por hash (hit, miss, agrupada)", ("resultado",))
+RAPIDO = Contador("omr_rapido_total", "Hojas del modo rápido (limpia, filas, hoja = repetida entera)",
+                  ("resultado",))
+CALIDAD = Contador("omr_calidad_rechazos_total", "Fotos rechazadas por el filtro de calidad, por motivo", ("motivo",))
+
+TODAS = [ETAPA_SEGUNDOS, QR_INTENTOS, CIRCULOS, FILAS_RECONSTRUIDAS, FILAS_ESCALADAS, HOJAS, QR_VIA,
+         QR_DECODIFICADOR, REJILLA, CACHE, RAPIDO, CALIDAD]
+
+
+def _cambio():
+    if DIRECTORIO and not getattr(_local, "agrupando", 0):
+        _volcar()
+
+
+def _volcar():
+    """
+    Escribe las series de este proceso en <DIRECTORIO>/<pid>.json (reemplazo atómico).
+    """
+    estado = {m.nombre: m.estado() for m in TODAS}
+    ruta = os.path.join(DIRECTORIO, f"{os.getpid()}.json")
+    with _lock_volcado:
+        with open(ruta + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(estado, f)
+        os.replace(ruta + ".tmp", ruta)
+
+
+def _otros_procesos():
+    """
+    Series volcadas por los demás procesos (también los ya muertos: los contadores no bajan).
+    """
+    propio = f"{os.getpid()}.json"
+    estados = []
+    for nombre in os.listdir(DIRECTORIO):
+        if not nombre.endswith(".json") or nombre == propio:
+            continue
+        try:
+            with open(os.path.join(DIRECTORIO, nombre), encoding="utf-8") as f:
+                estados.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # a medias o borrado: sale en el siguiente scrape
+    return estados
+
+
+def registrar_hoja(ok, medidas):
+    """
+    Registra las medidas de UNA hoja (el dict de omr.cronometrar()).
+    """
+    _local.agrupando = getattr(_local, "agrupando", 0) + 1  # un solo volcado por hoja
+    try:
+        _registrar_hoja(ok, medidas)
+    finally:
+        _local.agrupando -= 1
+    _cambio()
+
+
+def _registrar_hoja(ok, medidas):
+    HOJAS.incrementar("ok" if ok else "error")
+    if not medidas:
+        return
+    for nombre, segundos in medidas.get("tiempos", {}).items():
+        ETAPA_SEGUNDOS.observar(segundos, nombre)
+
+    datos = medidas.get("datos", {})
+    if "qr_intentos" in datos:
+        QR_INTENTOS.observar(datos["qr_intentos"])
+    if "circulos" in datos:
+        CIRCULOS.observar(datos["circulos"], datos.get("detector", ""))
+    if "filas_reconstruidas" in datos:
+        FILAS_RECONSTRUIDAS.observar(datos["filas_reconstruidas"])
+    if "filas_escaladas" in datos:
+        FILAS_ESCALADAS.observar(datos["filas_escaladas"])
+    if "qr_via" in datos:
+        QR_VIA.incrementar(datos["qr_via"])
+    if "qr_decodificador" in datos:
+        QR_DECODIFICADOR.incrementar(datos["qr_decodificador"])
+    if "rejilla" in datos:
+        REJILLA.incrementar(datos["rejilla"])
+    if "rapido" in datos:
+        RAPIDO.incrementar(datos["rapido"])
+    if "calidad" in datos:
+        CALIDAD.incrementar(datos["calidad"])
+
+
+def exponer():
+    """
+    Texto para GET /metrics (Content-Type: text/plain; version=0.0.4).
+    """
+    otros = _otros_procesos() if DIRECTORIO else []
+    lineas = []
+    for m in TODAS:
+        lineas.extend(m.exponer([e.get(m.nombre, []) for e in otros]))
+    return "\n".join(lineas) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
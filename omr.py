@@ -1,11 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import cv2
 import numpy as np
 import base64
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
 import os
 import re
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import documento_omr
+import metricas
+import qr_omr
+from cache_omr import cache_resultados, fijar_huella, hash_binario
+from trabajos_omr import TRABAJOS_WORKERS, ColaTrabajos, validar_callback
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
 
 # ============================================================
 # CONFIG ✅ (Ajustada a tu hoja)
@@ -32,6 +54,103 @@ UMBRAL_DOBLE_ABS = 0.038      # y además supera un mínimo absoluto
 # ROI interior para evitar contar borde impreso
 INNER_PAD = 0.30  # 0.25–0.35 suele ir bien
 
+# Detección de burbujas: "hough" (HoughCircles sobre el gris) o "componentes"
+# (componentes conexas del plano de tinta). Se puede pedir por request (detector=...).
+DETECTOR_CIRCULOS = os.environ.get("OMR_DETECTOR", "hough")
+RADIO_MIN, RADIO_MAX = 16, 45  # radio de burbuja en px A4
+COMPONENTE_ASPECTO = 1.35      # ancho/alto máx. de una burbuja (componentes)
+
+# Enderezar SÓLO las zonas que se leen (OMR en gris + esquina QR si hace falta)
+# en vez de la hoja A4 entera en color. 0 = warp completo como antes.
+WARP_ROI = os.environ.get("OMR_WARP_ROI", "1") != "0"
+QR_ZONA_FALLBACK_A4 = (1700, 1700)  # esquina A4 para la cascada QR de último recurso
+
+# Modo rápido en dos niveles: la zona OMR se lee primero a OMR_RAPIDO_ESCALA de la
+# resolución (binarizar y detectar cuestan ~4 veces menos a 0.5) y sólo las filas con
+# margen < RAPIDO_MARGEN se vuelven a puntuar a resolución completa; la hoja entera si
+# el pase rápido no es fiable. 0 = desactivado. Con debug siempre resolución completa.
+RAPIDO_ESCALA = float(os.environ.get("OMR_RAPIDO_ESCALA", "0"))
+# densidades del pase reducido frente a las de resolución completa: hasta ~0.035 de
+# diferencia cerca de UMBRAL_VACIO en hojas sintéticas (bench_omr.py)
+RAPIDO_MARGEN = float(os.environ.get("OMR_RAPIDO_MARGEN", "0.04"))
+RAPIDO_MAX_DUDOSAS = 0.25  # fracción de filas dudosas a partir de la cual se repite la hoja
+TIRA_PAD = 40              # px A4 alrededor de una fila al enderezarla sola
+HOUGH_PASO = 6             # la rejilla del acumulador de HoughCircles (dp=1.2) se repite cada 6 px
+MARGEN_TINTA = 32          # px alrededor de la zona que alcanzan blur + umbral adaptativo + morfología
+
+# Hilos internos de OpenCV en ESTE proceso (0 = los de OpenCV: todos los núcleos).
+# servir.py lo fija para repartir los núcleos entre procesos y no sobresuscribir.
+CV_HILOS = int(os.environ.get("OMR_CV_HILOS", "0"))
+if CV_HILOS > 0:
+    cv2.setNumThreads(CV_HILOS)
+
+
+def nucleos():
+    try:
+        return len(os.sched_getaffinity(0))  # respeta cpuset / límites del contenedor
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def hilos_cv_pool(procesos):
+    """
+    Hilos de OpenCV para cada proceso de un pool de `procesos`: el presupuesto
+    de este proceso (CV_HILOS o todos los núcleos) repartido entre ellos.
+    """
+    return max(1, (CV_HILOS or nucleos()) // max(1, procesos))
+
+
+def iniciar_proceso_pool(hilos_cv, calentar_al_iniciar=False):
+    # initializer de los ProcessPoolExecutor (calentar_al_iniciar: calentar() antes de la primera tarea)
+    cv2.setNumThreads(hilos_cv)
+    if calentar_al_iniciar:
+        calentar()
+
+
+def contexto_procesos():
+    """
+    Contexto de multiprocessing de los pools de OMR: forkserver si existe.
+    Los pools se crean bajo demanda desde procesos con hilos (gthread de
+    gunicorn, cola de trabajos, uvicorn) y un fork ahí hereda cerrojos tomados.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["omr"])  # cada proceso nace con omr/OpenCV importados
+    return ctx
+
+
+# Filtro de calidad barato (sobre una miniatura) ANTES del pipeline caro:
+# una foto que no puede salir bien se rechaza en ms con el motivo. 0 = desactivado.
+CALIDAD = os.environ.get("OMR_CALIDAD", "1") != "0"
+CALIDAD_LADO = 1024                 # lado mayor de la miniatura
+CALIDAD_NITIDEZ_MIN = float(os.environ.get("OMR_CALIDAD_NITIDEZ_MIN", "15"))  # varianza del Laplaciano
+CALIDAD_BRILLO_MIN = 40             # gris medio
+CALIDAD_QUEMADA_MAX = 0.85          # fracción de píxeles saturados (con poco contraste)
+CALIDAD_CONTRASTE_MIN = 50          # percentil 99 - percentil 1
+CALIDAD_PAPEL_SIN_MARCAS = 0.80     # sin marcas sólo sigue si la hoja llena la imagen (escáner)
+CALIDAD_HOJA_MIN_PX = 600           # lado mayor de la hoja (entre marcas) en la foto
+
+# Ingesta: la foto se decodifica directamente a la escala más pequeña (1/2, 1/4, 1/8)
+# que aún da ~DPI_OBJETIVO en A4, y en gris si no se pide debug (el color sólo se dibuja).
+DPI_OBJETIVO = int(os.environ.get("OMR_DPI_OBJETIVO", "300"))       # 300 dpi = A4 de 2480x3508
+INGESTA_GRIS = os.environ.get("OMR_INGESTA_GRIS", "1") != "0"
+SUBIDA_MAX_BYTES = int(float(os.environ.get("OMR_SUBIDA_MAX_MB", "40")) * 1024 * 1024)
+IMAGEN_MAX_MPX = float(os.environ.get("OMR_IMAGEN_MAX_MPX", "120"))  # megapíxeles
+
+# Presupuesto de memoria por hoja (aprox.): limita la ampliación de la cascada QR
+# y la resolución a la que se decodifica la foto.
+MEMORIA_MB = float(os.environ.get("OMR_MEMORIA_MB", "256"))
+MEMORIA_BYTES = MEMORIA_MB * 1024 * 1024
+QR_PLANOS_POR_PASO = 6      # imagen ampliada + CLAHE + otsu + adapt + variante + detector
+IMAGEN_FRACCION_MEMORIA = 0.25  # la foto decodificada no pasa de esta parte del presupuesto
+
+# Imágenes de debug: SÓLO si el cliente las pide (?debug=1 / ?debug=inline)
+DEBUG_ESCALA = float(os.environ.get("OMR_DEBUG_ESCALA", "0.5"))
+DEBUG_CALIDAD = int(os.environ.get("OMR_DEBUG_CALIDAD", "70"))
+DEBUG_MAX_RESULTADOS = int(os.environ.get("OMR_DEBUG_MAX_RESULTADOS", "200"))
+DEBUG_DIR = os.environ.get("OMR_DEBUG_DIR", "")  # vacío = sólo memoria
+
 # ============================================================
 # UTIL
 # ============================================================
@@ -42,7 +161,22 @@ def b64jpg(img_bgr, quality=85):
     return base64.b64encode(buff).decode("utf-8")
 
 
+def jpg_debug(img_bgr, escala=DEBUG_ESCALA, calidad=DEBUG_CALIDAD):
+    """
+    JPEG (bytes) reducido para debug. Se reduce ANTES de codificar.
+    """
+    if img_bgr is None:
+        return None
+    if escala and escala != 1.0:
+        img_bgr = cv2.resize(img_bgr, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA)
+    ok, buff = cv2.imencode(".jpg", img_bgr, [int(cv2.IMWRITE_JPEG_QUALITY), int(calidad)])
+    return buff.tobytes() if ok else None
+
+
 def _safe_crop(img, x0, y0, x1, y1):
+    """
+    Recorte recortado a los bordes. Es una VISTA (sin copia): no escribir en él.
+    """
     h, w = img.shape[:2]
     x0 = max(0, min(w, int(x0)))
     x1 = max(0, min(w, int(x1)))
@@ -50,26 +184,279 @@ def _safe_crop(img, x0, y0, x1, y1):
     y1 = max(0, min(h, int(y1)))
     if x1 <= x0 or y1 <= y0:
         return None
-    return img[y0:y1, x0:x1].copy()
+    return img[y0:y1, x0:x1]
+
+
+# ------------------------------------------------------------
+# Cronómetro por etapas + contadores (benchmark / métricas)
+# ------------------------------------------------------------
+ETAPAS = ["decodificar", "calidad", "marcas", "qr", "normalizar", "binarizar",
+          "hough", "agrupar", "rejilla", "puntuar", "escalar", "debug"]
+
+_cronometro = threading.local()
+
+
+@contextmanager
+def etapa(nombre):
+    """
+    Suma el tiempo del bloque a `nombre` en el cronómetro activo (si no hay, no mide).
+    """
+    medidas = getattr(_cronometro, "medidas", None)
+    if medidas is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tiempos = medidas["tiempos"]
+        tiempos[nombre] = tiempos.get(nombre, 0.0) + time.perf_counter() - t0
+
+
+def anotar(clave, valor):
+    # dato suelto de la hoja (p.ej. vía por la que se leyó el QR)
+    medidas = getattr(_cronometro, "medidas", None)
+    if medidas is not None:
+        medidas["datos"][clave] = valor
+
+
+def contar(clave, n=1):
+    medidas = getattr(_cronometro, "medidas", None)
+    if medidas is not None:
+        medidas["datos"][clave] = medidas["datos"].get(clave, 0) + n
+
+
+@contextmanager
+def cronometrar():
+    """
+    with cronometrar() as m: ...
+      m["tiempos"] = {etapa: segundos, "total": segundos}, m["datos"] = {clave: valor}
+    Anidado comparte las medidas del cronómetro de fuera (sólo el de fuera mide "total").
+    """
+    medidas = getattr(_cronometro, "medidas", None)
+    if medidas is not None:
+        yield medidas
+        return
+
+    _cronometro.medidas = medidas = {"tiempos": {}, "datos": {}}
+    t0 = time.perf_counter()
+    try:
+        yield medidas
+    finally:
+        medidas["tiempos"]["total"] = time.perf_counter() - t0
+        _cronometro.medidas = None
+
+
+class ContextoHoja:
+    """
+    Una imagen BGR (o gris) + sus planos derivados (gris, CLAHE, blur, binarizada...).
+    Cada plano se calcula bajo demanda y como mucho UNA vez; el pipeline pasa
+    el contexto de etapa en etapa en lugar de la imagen.
+
+    Si la imagen es sólo un trozo de la hoja A4, `origen` es su esquina (x, y)
+    en coords A4 y `pagina` una función que endereza la hoja entera (debug).
+    `escala`: px de esta imagen por px A4 (< 1 en el pase rápido).
+    `teselas`: (columnas, filas) de teselas CLAHE de la hoja entera que cubre
+    el trozo (ver _zona_omr); `util`: rectángulo (x0, y0, x1, y1) en px de esta
+    imagen fuera del cual no se binariza (la tinta ahí vale 0).
+    """
+
+    def __init__(self, img_bgr, origen=(0, 0), pagina=None, escala=1.0, teselas=None, util=None):
+        self.bgr = img_bgr
+        self.origen = origen
+        self._pagina = pagina
+        self.escala = escala
+        self.teselas = teselas
+        self.util = util
+        self._planos = {}
+
+    def recorte(self, img, x0, y0, x1, y1):
+        """
+        _safe_crop en coords A4 de `img` (esta imagen o un plano suyo).
+        Redondea sobre la rejilla de px de la hoja entera a esta escala.
+        """
+        s = self.escala
+        ox, oy = int(round(self.origen[0] * s)), int(round(self.origen[1] * s))
+        return _safe_crop(img, int(round(x0 * s)) - ox, int(round(y0 * s)) - oy,
+                          int(round(x1 * s)) - ox, int(round(y1 * s)) - oy)
+
+    def pagina_bgr(self):
+        """
+        Hoja A4 completa en color (sólo para dibujar el debug).
+        """
+        return self._pagina() if self._pagina is not None else self.bgr
+
+    def lienzo_debug(self):
+        """
+        Hoja A4 en color sobre la que se puede dibujar: sólo se copia si es
+        la propia imagen del contexto (enderezada bajo demanda ya es nueva).
+        """
+        return self._pagina() if self._pagina is not None else self.bgr.copy()
+
+    def plano(self, nombre):
+        if nombre not in self._planos:
+            self._planos[nombre] = _RECETAS_PLANOS[nombre](self)
+        return self._planos[nombre]
+
+    @property
+    def gris(self):
+        return self.plano("gris")
+
+
+def contexto(img):
+    """
+    Acepta imagen BGR o ContextoHoja (las funciones públicas admiten ambos).
+    """
+    return img if isinstance(img, ContextoHoja) else ContextoHoja(img)
+
+
+def _miniatura(gray, lado):
+    escala = lado / float(max(gray.shape[:2]))
+    if escala >= 1.0:
+        return gray
+    return cv2.resize(gray, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA)
+
+
+# Objetos de OpenCV de vida larga (CLAHE, detectores QR): uno por hilo, porque
+# no son thread-safe, y reutilizados hoja tras hoja en vez de crearlos en cada llamada.
+_objetos_hilo = threading.local()
+KERNEL_3 = np.ones((3, 3), np.uint8)  # tinta
+KERNEL_5 = np.ones((5, 5), np.uint8)  # marcas
+
+
+def _clahe(gray, clip, teselas=(8, 8)):
+    cache = _objetos_hilo.__dict__.setdefault("clahe", {})
+    clahe = cache.get((clip, teselas))
+    if clahe is None:
+        clahe = cache[(clip, teselas)] = cv2.createCLAHE(clipLimit=clip, tileGridSize=teselas)
+    return clahe.apply(gray)
+
+
+def tesela_clahe_a4(escala=1.0):
+    """
+    (ancho, alto) en px de una tesela CLAHE 8 x 8 sobre la hoja A4 entera a
+    `escala`, como la calcula OpenCV (si no es divisible, amplía la imagen
+    hasta el siguiente múltiplo de 8 en los dos lados).
+    """
+    w, h = int(round(A4_W * escala)), int(round(A4_H * escala))
+    if w % 8 or h % 8:
+        w, h = w + 8 - w % 8, h + 8 - h % 8
+    return w // 8, h // 8
+
+
+def _clahe_tinta(h):
+    # un trozo de la hoja se ecualiza con las MISMAS teselas que la hoja entera:
+    # se completa hasta teselas enteras como haría OpenCV en el borde de la página
+    if h.teselas is None:
+        return _clahe(h.gris, 2.2)
+    gris = h.gris
+    (nx, ny), (tw, th) = h.teselas, tesela_clahe_a4(h.escala)
+    abajo, derecha = ny * th - gris.shape[0], nx * tw - gris.shape[1]
+    if abajo or derecha:
+        gris = cv2.copyMakeBorder(gris, 0, abajo, 0, derecha, cv2.BORDER_REFLECT_101)
+    return _clahe(gris, 2.2, (nx, ny))[:h.gris.shape[0], :h.gris.shape[1]]
+
+
+def _tinta(h):
+    ecualizada = h.plano("clahe_tinta")
+    if h.util is None:
+        return _binarizar_desde_clahe(ecualizada, h.escala)
+    x0, y0, x1, y1 = h.util
+    tinta = np.zeros_like(ecualizada)
+    tinta[y0:y1, x0:x1] = _binarizar_desde_clahe(ecualizada[y0:y1, x0:x1], h.escala)
+    return tinta
+
+
+def _decodificador_qr():
+    dec = getattr(_objetos_hilo, "qr", None)
+    if dec is None:
+        dec = _objetos_hilo.qr = qr_omr.DecodificadorQR()
+    return dec
+
+
+_RECETAS_PLANOS = {
+    "gris": lambda h: h.bgr if h.bgr.ndim == 2 else cv2.cvtColor(h.bgr, cv2.COLOR_BGR2GRAY),
+    "piramide": lambda h: _reducir_para_marcas(h.gris),
+    "miniatura": lambda h: _miniatura(h.plano("piramide")[0], CALIDAD_LADO),
+    # QR
+    "clahe_qr": lambda h: _clahe(h.gris, 2.8),
+    "otsu_qr": lambda h: cv2.threshold(h.plano("clahe_qr"), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+    "adapt_qr": lambda h: cv2.adaptiveThreshold(h.plano("clahe_qr"), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                                cv2.THRESH_BINARY, 31, 7),
+    # tinta (burbujas)
+    "clahe_tinta": _clahe_tinta,
+    "tinta": _tinta,
+}
 
 
 # ============================================================
 # 1) NORMALIZAR A4 con marcas negras (robusto)
 # ============================================================
-def normalizar_a4_con_marcas(img_bgr):
+# Las marcas se buscan en un nivel reducido de la pirámide (coste independiente
+# de los megapíxeles de la cámara) y se refinan en ventanas a resolución completa.
+MARCAS_LADO_MAX = int(os.environ.get("OMR_MARCAS_LADO_MAX", "1400"))
+MARCA_AREA_MIN = 2200       # px² de una marca con la hoja a MARCA_AREA_REF px de alto
+MARCA_AREA_REF = 3508.0
+
+
+def _reducir_para_marcas(gray):
     """
-    Detecta 4 marcas negras de esquina y aplica perspectiva a A4.
-    Si falla, hace resize a A4.
+    pyrDown hasta que el lado mayor sea <= MARCAS_LADO_MAX.
+    Devuelve (gris_reducido, escala) con escala = reducido / original.
+    """
+    g, escala = gray, 1.0
+    while max(g.shape[:2]) > MARCAS_LADO_MAX:
+        g = cv2.pyrDown(g)
+        escala = g.shape[1] / float(gray.shape[1])
+    return g, escala
+
+
+def _refinar_marca(gray, cx, cy, semilado):
+    """
+    Centro sub-píxel de la marca en una ventana a resolución completa
+    alrededor de (cx, cy). Si no la encuentra devuelve (cx, cy).
     """
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape[:2]
+    x0, y0 = max(0, int(cx - semilado)), max(0, int(cy - semilado))
+    x1, y1 = min(w, int(cx + semilado) + 1), min(h, int(cy + semilado) + 1)
+    if x1 - x0 < 5 or y1 - y0 < 5:
+        return cx, cy
+
+    ventana = cv2.GaussianBlur(gray[y0:y1, x0:x1], (5, 5), 0)
+    _, th = cv2.threshold(ventana, 75, 255, cv2.THRESH_BINARY_INV)
+    n, _, stats, centros = cv2.connectedComponentsWithStats(th)
+    if n < 2:
+        return cx, cy
+
+    # la componente grande más cercana al centro previsto
+    area_min = 0.25 * (semilado / 1.6) ** 2
+    mejor, mejor_d = None, None
+    for i in range(1, n):
+        if stats[i, cv2.CC_STAT_AREA] < area_min:
+            continue
+        d = (centros[i][0] + x0 - cx) ** 2 + (centros[i][1] + y0 - cy) ** 2
+        if mejor_d is None or d < mejor_d:
+            mejor, mejor_d = i, d
+    if mejor is None:
+        return cx, cy
+    return float(centros[mejor][0] + x0), float(centros[mejor][1] + y0)
+
+
+def localizar_marcas(img_bgr):
+    """
+    Detecta las 4 marcas negras de esquina (img_bgr: imagen o ContextoHoja).
+    Devuelve np.float32 (4, 2) en orden tl, tr, br, bl (coords de la foto) o None.
+    """
+    hoja = contexto(img_bgr)
+    gray, escala = hoja.plano("piramide")
     blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    area_min = MARCA_AREA_MIN * (max(gray.shape[:2]) / MARCA_AREA_REF) ** 2
 
     # negro -> blanco
     _, th = cv2.threshold(blur, 75, 255, cv2.THRESH_BINARY_INV)
 
-    kernel = np.ones((5, 5), np.uint8)
-    th = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel, iterations=1)
-    th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, kernel, iterations=2)
+    th = cv2.morphologyEx(th, cv2.MORPH_OPEN, KERNEL_5, iterations=1)
+    th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, KERNEL_5, iterations=2)
 
     cnts, _ = cv2.findContours(th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -77,7 +464,7 @@ def normalizar_a4_con_marcas(img_bgr):
     candidates = []
     for c in cnts:
         area = cv2.contourArea(c)
-        if area < 2200:
+        if area < area_min:
             continue
         x, y, bw, bh = cv2.boundingRect(c)
         if bw <= 0 or bh <= 0:
@@ -86,10 +473,10 @@ def normalizar_a4_con_marcas(img_bgr):
         if 0.70 < aspect < 1.30:
             cx = x + bw / 2.0
             cy = y + bh / 2.0
-            candidates.append((cx, cy, area))
+            candidates.append((cx, cy, area, max(bw, bh)))
 
     if len(candidates) < 4:
-        return cv2.resize(img_bgr, (A4_W, A4_H))
+        return None
 
     # prioridad por área (marcas grandes)
     candidates.sort(key=lambda t: t[2], reverse=True)
@@ -103,6 +490,7 @@ def normalizar_a4_con_marcas(img_bgr):
     }
 
     chosen = {}
+    lados = {}
     used = set()
     for name, t in targets.items():
         best_i, best_d = None, None
@@ -115,124 +503,321 @@ def normalizar_a4_con_marcas(img_bgr):
                 best_i = i
         if best_i is not None:
             chosen[name] = pts[best_i]
+            lados[name] = candidates[best_i][3]
             used.add(best_i)
 
     if len(chosen) < 4:
-        return cv2.resize(img_bgr, (A4_W, A4_H))
+        return None
+
+    # de vuelta a resolución completa, afinando cada marca en su ventana
+    out = []
+    for name in ("tl", "tr", "br", "bl"):
+        cx, cy = chosen[name] / escala
+        if escala < 1.0:
+            cx, cy = _refinar_marca(hoja.gris, cx, cy, 0.8 * lados[name] / escala + 4)
+        out.append((cx, cy))
+    return np.array(out, dtype=np.float32)
+
 
-    src = np.array([chosen["tl"], chosen["tr"], chosen["br"], chosen["bl"]], dtype=np.float32)
+def homografia_a4(marcas, rot=0):
+    """
+    Homografía foto -> A4. `rot` (0/90/180/270) = giro horario de la hoja en la foto:
+    con 90 la esquina tl de la hoja es la marca tr de la foto, etc.
+    """
+    src = np.roll(marcas, -(rot // 90), axis=0)
     dst = np.array([[0, 0], [A4_W, 0], [A4_W, A4_H], [0, A4_H]], dtype=np.float32)
+    return cv2.getPerspectiveTransform(src, dst)
+
+
+def warp_a4(img_bgr, marcas, rot=0):
+    """
+    Aplica perspectiva a A4 con unas marcas ya localizadas.
+    Si no hay marcas, hace resize a A4.
+    """
+    if marcas is None:
+        return cv2.resize(img_bgr, (A4_W, A4_H))
+    return cv2.warpPerspective(img_bgr, homografia_a4(marcas, rot), (A4_W, A4_H))
 
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img_bgr, M, (A4_W, A4_H))
-    return warped
+
+def warp_zona_a4(img, marcas, rot, x0, y0, x1, y1, escala=1.0):
+    """
+    Como warp_a4 pero SÓLO el rectángulo A4 [x0:x1, y0:y1]: misma homografía
+    trasladada al origen de la zona. Sin marcas equivale al resize a A4.
+    Con `escala` < 1 la zona sale ya reducida (pase rápido).
+    """
+    if marcas is None:
+        h, w = img.shape[:2]
+        fx, fy = A4_W / float(w), A4_H / float(h)
+        # mismo muestreo que cv2.resize (centros de píxel)
+        M = np.array([[fx, 0, 0.5 * fx - 0.5], [0, fy, 0.5 * fy - 0.5], [0, 0, 1]], dtype=np.float64)
+    else:
+        M = homografia_a4(marcas, rot)
+    T = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64)
+    if escala == 1.0:
+        return cv2.warpPerspective(img, T @ M, (int(x1 - x0), int(y1 - y0)))
+    S = np.diag([escala, escala, 1.0])
+    return cv2.warpPerspective(img, S @ T @ M, (int(round((x1 - x0) * escala)), int(round((y1 - y0) * escala))))
+
+
+def normalizar_a4_con_marcas(img_bgr):
+    """
+    Detecta 4 marcas negras de esquina y aplica perspectiva a A4.
+    Si falla, hace resize a A4.
+    """
+    return warp_a4(img_bgr, localizar_marcas(img_bgr))
 
 
 # ============================================================
 # 2) QR ROBUSTO (MUCHOS INTENTOS)
 # ============================================================
-def _try_decode(det, img_bgr):
-    # multi si está disponible
-    try:
-        ok, decoded_info, points, _ = det.detectAndDecodeMulti(img_bgr)
-        if ok and decoded_info:
-            for s in decoded_info:
-                s = (s or "").strip()
-                if s:
-                    return s
-    except Exception:
-        pass
+_SHARPEN_K = np.array([[0, -1, 0],
+                       [-1, 5, -1],
+                       [0, -1, 0]], dtype=np.float32)
 
-    s, _, _ = det.detectAndDecode(img_bgr)
-    s = (s or "").strip()
-    return s if s else None
+VARIANTES_QR = ["orig", "clahe", "sharpen", "otsu", "otsu_inv", "adapt", "adapt_inv"]
 
 
-def _variants(img_bgr):
-    out = [img_bgr]
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-
-    # CLAHE
-    clahe = cv2.createCLAHE(clipLimit=2.8, tileGridSize=(8, 8))
-    g1 = clahe.apply(gray)
-    out.append(cv2.cvtColor(g1, cv2.COLOR_GRAY2BGR))
-
-    # Sharpen
-    k = np.array([[0, -1, 0],
-                  [-1, 5, -1],
-                  [0, -1, 0]], dtype=np.float32)
-    sh = cv2.filter2D(g1, -1, k)
-    out.append(cv2.cvtColor(sh, cv2.COLOR_GRAY2BGR))
-
-    # Otsu
-    _, otsu = cv2.threshold(g1, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    out.append(cv2.cvtColor(otsu, cv2.COLOR_GRAY2BGR))
-    out.append(cv2.cvtColor(255 - otsu, cv2.COLOR_GRAY2BGR))
-
-    # Adaptive
-    ad = cv2.adaptiveThreshold(g1, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                               cv2.THRESH_BINARY, 31, 7)
-    out.append(cv2.cvtColor(ad, cv2.COLOR_GRAY2BGR))
-    out.append(cv2.cvtColor(255 - ad, cv2.COLOR_GRAY2BGR))
+def _variante(hoja, nombre):
+    """
+    Genera UNA variante para el detector QR (bajo demanda), de un canal:
+    el detector pasa a gris de todas formas, así no se triplica la memoria.
+    `hoja` (ContextoHoja) guarda gray/CLAHE/otsu/adapt de esa imagen para no repetirlos.
+    """
+    if nombre == "orig":
+        return hoja.bgr
+
+    if nombre == "clahe":
+        out = hoja.plano("clahe_qr")
+    elif nombre == "sharpen":
+        out = cv2.filter2D(hoja.plano("clahe_qr"), -1, _SHARPEN_K)
+    elif nombre in ("otsu", "otsu_inv"):
+        out = hoja.plano("otsu_qr")
+        out = out if nombre == "otsu" else cv2.bitwise_not(out)
+    elif nombre in ("adapt", "adapt_inv"):
+        out = hoja.plano("adapt_qr")
+        out = out if nombre == "adapt" else cv2.bitwise_not(out)
+    else:
+        raise ValueError(f"Variante QR desconocida: {nombre}")
 
     return out
 
 
-def leer_qr_robusto(img_bgr):
+def _variants(img_bgr):
+    # generador: una variante viva cada vez
+    hoja = contexto(img_bgr)
+    for n in VARIANTES_QR:
+        yield _variante(hoja, n)
+
+
+# ------------------------------------------------------------
+# Cascada QR planificada (barato primero + presupuesto de tiempo)
+# ------------------------------------------------------------
+# Segundos máximos que un request puede gastar buscando el QR
+QR_PRESUPUESTO_S = float(os.environ.get("OMR_QR_PRESUPUESTO_S", "4.0"))
+
+# Zonas: (x1, y1) del recorte arriba-izquierda; None = imagen completa
+QR_ZONAS = {
+    "roi": (1400, 1400),
+    "roi_big": (1700, 1700),
+    "full": None,
+}
+QR_ESCALAS = [1.0, 1.8, 2.6, 3.4, 4.0]
+QR_ROTACIONES = {
+    0: None,
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def _plan_qr_base():
+    """
+    Orden por defecto de pasos (zona, escala, rotacion, variante).
+    Primero lo barato (ROI sin escalar), después imagen completa, y al final
+    los ROI escalados/rotados que son los más caros.
+    """
+    plan = []
+    for v in VARIANTES_QR:
+        plan.append(("roi", 1.0, 0, v))
+    for v in VARIANTES_QR:
+        plan.append(("full", 1.0, 0, v))
+    for sc in QR_ESCALAS[1:]:
+        for v in VARIANTES_QR:
+            plan.append(("roi", sc, 0, v))
+    for sc in QR_ESCALAS:
+        for rot in (90, 180, 270):
+            for v in VARIANTES_QR:
+                plan.append(("roi", sc, rot, v))
+    for rot in (90, 180, 270):
+        for v in VARIANTES_QR:
+            plan.append(("full", 1.0, rot, v))
+    for v in VARIANTES_QR:
+        plan.append(("roi_big", 1.0, 0, v))
+    return plan
+
+
+_QR_PLAN_BASE = _plan_qr_base()
+_QR_EXITOS = Counter()
+_QR_LOCK = threading.Lock()
+
+
+def plan_qr():
     """
-    Devuelve (texto_qr or None, debug_qr_base64)
+    Plan actual: los pasos que más veces han leído el QR van delante
+    (orden estable: a igualdad de éxitos se respeta el plan base).
     """
-    det = cv2.QRCodeDetector()
+    with _QR_LOCK:
+        exitos = dict(_QR_EXITOS)
+    if not exitos:
+        return list(_QR_PLAN_BASE)
+    return sorted(_QR_PLAN_BASE, key=lambda p: -exitos.get(p, 0))
 
-    # 0) Intento completo con variantes y rotaciones
-    rotations = [
-        ("0", img_bgr),
-        ("90", cv2.rotate(img_bgr, cv2.ROTATE_90_CLOCKWISE)),
-        ("180", cv2.rotate(img_bgr, cv2.ROTATE_180)),
-        ("270", cv2.rotate(img_bgr, cv2.ROTATE_90_COUNTERCLOCKWISE)),
-    ]
-    for _, im in rotations:
-        for v in _variants(im):
-            s = _try_decode(det, v)
-            if s:
-                return s, None
-
-    # 1) ROI fijo arriba izquierda
-    # (en tu hoja el QR SIEMPRE está ahí)
-    qr_roi = _safe_crop(img_bgr, 0, 0, 1400, 1400)
-    debug_qr = b64jpg(qr_roi, 90) if qr_roi is not None else None
-    if qr_roi is None:
-        return None, None
-
-    scales = [1.0, 1.8, 2.6, 3.4, 4.0]
-    for sc in scales:
-        roi = qr_roi
-        if sc != 1.0:
-            roi = cv2.resize(roi, None, fx=sc, fy=sc, interpolation=cv2.INTER_CUBIC)
-
-        # rotaciones del ROI
-        rots = [
-            roi,
-            cv2.rotate(roi, cv2.ROTATE_90_CLOCKWISE),
-            cv2.rotate(roi, cv2.ROTATE_180),
-            cv2.rotate(roi, cv2.ROTATE_90_COUNTERCLOCKWISE),
-        ]
-
-        for r in rots:
-            for v in _variants(r):
-                s = _try_decode(det, v)
-                if s:
-                    return s, debug_qr
-
-    # 2) ROI más grande (por si el QR está más desplazado)
-    big = _safe_crop(img_bgr, 0, 0, 1700, 1700)
-    if big is not None:
-        for v in _variants(big):
-            s = _try_decode(det, v)
+
+def _registrar_exito_qr(paso):
+    with _QR_LOCK:
+        _QR_EXITOS[paso] += 1
+
+
+def escala_qr_maxima(ancho, alto):
+    """
+    Mayor ampliación de un recorte QR que cabe en MEMORIA_MB: la imagen
+    ampliada y sus planos (CLAHE, otsu, adapt, variantes) son ~QR_PLANOS_POR_PASO
+    copias de un canal.
+    """
+    return (MEMORIA_BYTES / float(QR_PLANOS_POR_PASO * max(1, ancho * alto))) ** 0.5
+
+
+def _imagen_paso(hoja, zona, escala, rot):
+    # en gris: la cascada sólo usa un canal y la ampliación x4 pesa 16 veces más
+    lim = QR_ZONAS[zona]
+    gris = hoja.gris
+    im = gris if lim is None else _safe_crop(gris, 0, 0, lim[0], lim[1])
+    if im is None:
+        return None
+    if escala > escala_qr_maxima(im.shape[1], im.shape[0]):
+        return None  # no cabe en el presupuesto de memoria
+    if escala != 1.0:
+        im = cv2.resize(im, None, fx=escala, fy=escala, interpolation=cv2.INTER_CUBIC)
+    if QR_ROTACIONES[rot] is not None:
+        im = cv2.rotate(im, QR_ROTACIONES[rot])
+    return im
+
+
+def leer_qr_cascada(img_bgr, deadline=None):
+    """
+    Recorre plan_qr() hasta leer el QR o agotar el `deadline` (time.monotonic()).
+    img_bgr: imagen o ContextoHoja (el paso "full" sin escalar reutiliza sus planos).
+    Siempre hace al menos un intento.
+    Devuelve (texto_qr or None, paso_exitoso or None, intentos)
+    """
+    if deadline is None:
+        deadline = time.monotonic() + QR_PRESUPUESTO_S
+
+    dec = _decodificador_qr()
+    hoja = contexto(img_bgr)
+
+    # sólo guardamos la última imagen base (las de 4x pesan mucho)
+    clave_actual, base = None, None
+    intentos = 0
+
+    for paso in plan_qr():
+        if intentos and time.monotonic() >= deadline:
+            break
+
+        zona, escala, rot, variante = paso
+        clave = (zona, escala, rot)
+        if clave != clave_actual:
+            clave_actual = clave
+            if clave == ("full", 1.0, 0):
+                base = hoja
+            else:
+                base = im = None  # soltar la anterior antes de crear la siguiente
+                im = _imagen_paso(hoja, zona, escala, rot)
+                base = ContextoHoja(im) if im is not None else None
+        if base is None:
+            continue
+
+        intentos += 1
+        s = dec(_variante(base, variante))
+        if s:
+            _registrar_exito_qr(paso)
+            contar("qr_intentos", intentos)
+            anotar("qr_decodificador", dec.ultimo)
+            return s, paso, intentos
+
+    contar("qr_intentos", intentos)
+    return None, None, intentos
+
+
+def leer_qr_robusto(img_bgr, deadline=None, debug=False):
+    """
+    Devuelve (texto_qr or None, zona_qr_bgr or None)
+    La zona (para debug) sólo se recorta si `debug`.
+    """
+    hoja = contexto(img_bgr)
+    s, paso, _ = leer_qr_cascada(hoja, deadline)
+
+    # debug del ROI fijo arriba izquierda (en tu hoja el QR SIEMPRE está ahí)
+    if not debug or (s and paso[0] == "full"):
+        return s, None
+    return s, _safe_crop(hoja.bgr, 0, 0, 1400, 1400)
+
+
+# ------------------------------------------------------------
+# QR dirigido por las marcas de esquina (una sola pasada)
+# ------------------------------------------------------------
+# Zona del QR en coords A4 (arriba izquierda de la hoja)
+QR_ZONA_A4 = (1400, 1400)
+QR_VARIANTES_DIRIGIDAS = ["orig", "clahe", "otsu", "adapt"]
+
+
+def orientaciones_probables(marcas):
+    """
+    Giros de hoja ordenados por probabilidad según la forma del cuadrilátero:
+    A4 vertical => 0/180; apaisado en la foto => 90/270.
+    """
+    tl, tr, br, bl = marcas
+    ancho = (np.linalg.norm(tr - tl) + np.linalg.norm(br - bl)) / 2.0
+    alto = (np.linalg.norm(bl - tl) + np.linalg.norm(br - tr)) / 2.0
+    if ancho > alto:
+        return [90, 270, 0, 180]
+    return [0, 180, 90, 270]
+
+
+def leer_qr_por_marcas(img_bgr, marcas, deadline=None):
+    """
+    Predice dónde está el QR con la geometría de las marcas: para cada giro
+    probable endereza SOLO la zona QR de la hoja y prueba a decodificarla.
+    Devuelve (texto_qr or None, rot, zona_qr_bgr or None)
+    """
+    if deadline is None:
+        deadline = time.monotonic() + QR_PRESUPUESTO_S
+
+    dec = _decodificador_qr()
+    img_bgr = contexto(img_bgr).bgr
+    rots = orientaciones_probables(marcas)
+    zonas = {}
+    intentos = 0
+
+    for variante in QR_VARIANTES_DIRIGIDAS:
+        for rot in rots:
+            if intentos and time.monotonic() >= deadline:
+                contar("qr_intentos", intentos)
+                return None, rots[0], None
+            if rot not in zonas:
+                M = homografia_a4(marcas, rot)
+                zonas[rot] = ContextoHoja(cv2.warpPerspective(img_bgr, M, QR_ZONA_A4))
+            zona = zonas[rot]
+
+            intentos += 1
+            s = dec(_variante(zona, variante))
             if s:
-                return s, debug_qr
+                contar("qr_intentos", intentos)
+                anotar("qr_decodificador", dec.ultimo)
+                return s, rot, zona.bgr
 
-    return None, debug_qr
+    contar("qr_intentos", intentos)
+    return None, rots[0], None
 
 
 def parsear_codigo_qr(codigo):
@@ -278,23 +863,24 @@ def parsear_codigo_qr(codigo):
 # 3) BINARIZACIÓN PRO (móvil/escáner)
 # ============================================================
 def binarizar_tinta_pro(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    # img_bgr: imagen o ContextoHoja (entonces queda cacheada como plano "tinta")
+    return contexto(img_bgr).plano("tinta")
 
-    clahe = cv2.createCLAHE(clipLimit=2.2, tileGridSize=(8, 8))
-    gray = clahe.apply(gray)
 
-    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+def _binarizar_desde_clahe(gray, escala=1.0):
+    # escala < 1 (pase rápido): ventanas en proporción para ver la misma tinta
+    gray = cv2.GaussianBlur(gray, (5, 5) if escala > 0.75 else (3, 3), 0)
 
     th = cv2.adaptiveThreshold(
         gray, 255,
         cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
         cv2.THRESH_BINARY_INV,
-        31, 10
+        max(3, int(31 * escala) | 1), 10
     )
 
-    kernel = np.ones((3, 3), np.uint8)
-    th = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel, iterations=1)
-    th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, kernel, iterations=2)
+    if escala > 0.75:  # reducida, un trazo de relleno mide 2-3 px: la apertura lo borraría
+        th = cv2.morphologyEx(th, cv2.MORPH_OPEN, KERNEL_3, iterations=1)
+    th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, KERNEL_3, iterations=2 if escala > 0.75 else 1)
     return th
 
 
@@ -312,22 +898,25 @@ def filas_a_leer(num_preguntas, pagina):
 # ============================================================
 # 5) DETECCIÓN REAL DE CÍRCULOS + AGRUPACIÓN (SIN REJILLA FIJA)
 # ============================================================
-def detectar_circulos(zona_gray):
+def detectar_circulos(zona_gray, escala=1.0):
     """
-    Devuelve lista de círculos (x, y, r) en coordenadas de la zona.
+    HoughCircles. Devuelve lista de círculos (x, y, r) en coordenadas de la zona.
+    `escala`: px de la zona por px A4 (los tamaños de la plantilla se escalan).
     """
-    g = cv2.medianBlur(zona_gray, 5)
+    g = cv2.medianBlur(zona_gray, 5 if escala > 0.75 else 3)
 
     # HoughCircles: ajustado a tus círculos
     circles = cv2.HoughCircles(
         g,
         cv2.HOUGH_GRADIENT,
         dp=1.2,
-        minDist=38,
+        # reducida, el acumulador (dp) es más grueso respecto a la burbuja: minDist
+        # y votos bajan con la raíz de la escala (lineal daba falsos entre filas)
+        minDist=38 * escala ** 0.5,
         param1=120,
-        param2=30,
-        minRadius=16,
-        maxRadius=45
+        param2=30 * escala ** 0.5,
+        minRadius=int(RADIO_MIN * escala),
+        maxRadius=int(np.ceil(RADIO_MAX * escala))
     )
 
     if circles is None:
@@ -344,6 +933,49 @@ def detectar_circulos(zona_gray):
     return out
 
 
+def detectar_circulos_componentes(zona_bin, escala=1.0):
+    """
+    Componentes conexas del plano de tinta (ya binarizado): cada burbuja impresa
+    es un anillo y cada burbuja rellena una mancha de su tamaño. Sin blur ni Hough
+    y no pierde las rellenas con el borde tapado de tinta.
+    Devuelve lista de círculos (x, y, r) en coordenadas de la zona.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(zona_bin, connectivity=8)
+    x, y, w, h = (stats[1:, i] for i in range(4))  # 0 = fondo
+    rmin, rmax = RADIO_MIN * escala, RADIO_MAX * escala
+    ok = (
+        (w >= 2 * rmin) & (h >= 2 * rmin) & (w <= 2 * rmax) & (h <= 2 * rmax)
+        & (w <= COMPONENTE_ASPECTO * h) & (h <= COMPONENTE_ASPECTO * w)
+    )
+    if not ok.any():
+        return []
+
+    x, y, w, h = x[ok], y[ok], w[ok], h[ok]
+    # todas las burbujas miden lo mismo: el radio típico aguanta trazos que se salen
+    r = int(round(np.median(w + h) / 4.0))
+    return [(int(cx), int(cy), r) for cx, cy in zip(x + w // 2, y + h // 2)]
+
+
+DETECTORES = {
+    "hough": lambda zona_gray, zona_bin, escala=1.0: detectar_circulos(zona_gray, escala),
+    "componentes": lambda zona_gray, zona_bin, escala=1.0: detectar_circulos_componentes(zona_bin, escala),
+}
+if DETECTOR_CIRCULOS not in DETECTORES:
+    raise ValueError(f"OMR_DETECTOR debe ser uno de {sorted(DETECTORES)}")
+
+
+def elegir_detector(nombre):
+    """
+    Detector pedido por el cliente: None (= DETECTOR_CIRCULOS) o un nombre de DETECTORES.
+    """
+    nombre = (nombre or "").strip().lower()
+    if not nombre:
+        return None
+    if nombre not in DETECTORES:
+        raise ValueError(f"detector debe ser uno de {sorted(DETECTORES)}")
+    return nombre
+
+
 def agrupar_filas(circulos, filas_esperadas):
     """
     Agrupa círculos por filas usando distancias en Y, de forma más tolerante.
@@ -448,52 +1080,82 @@ def cluster_columnas_x(circulos):
     return centers
 
 
-def score_circulo(mask_bin, cx, cy, r):
+_PLANTILLAS_DISCO = {}
+
+
+def _plantilla_disco(rr, rad):
     """
-    Calcula densidad de tinta dentro del círculo (en la máscara binaria).
+    Offsets (dy, dx) del disco interior de radio `rad` dentro de la ventana
+    [-rr, rr) de score_circulo. Se calcula una vez por radio.
     """
-    h, w = mask_bin.shape[:2]
+    clave = (rr, rad)
+    if clave not in _PLANTILLAS_DISCO:
+        d = np.arange(-rr, rr)
+        dy, dx = np.meshgrid(d, d, indexing="ij")
+        dentro = (dx ** 2 + dy ** 2) <= rad ** 2
+        _PLANTILLAS_DISCO[clave] = (dy[dentro], dx[dentro])
+    return _PLANTILLAS_DISCO[clave]
 
-    pad = int(r * INNER_PAD)
-    rr = max(8, int(r * 0.72))
 
-    x0 = max(0, cx - rr)
-    x1 = min(w, cx + rr)
-    y0 = max(0, cy - rr)
-    y1 = min(h, cy + rr)
+def score_circulos(mask_bin, circulos):
+    """
+    Densidad de tinta dentro de cada círculo (x, y, r), todos de una vez.
+    Mismo resultado que score_circulo uno a uno: los círculos se agrupan por
+    radio y cada grupo se muestrea con una plantilla de disco precalculada.
+    """
+    c = np.asarray(circulos, dtype=np.int64).reshape(-1, 3)
+    out = np.zeros(len(c), dtype=np.float64)
+    if not len(c):
+        return out
 
-    roi = mask_bin[y0:y1, x0:x1]
-    if roi.size == 0:
-        return 0.0
+    h, w = mask_bin.shape[:2]
+    pad = (c[:, 2] * INNER_PAD).astype(np.int64)
+    rr = np.maximum(8, (c[:, 2] * 0.72).astype(np.int64))
+    rad = np.maximum(6, rr - pad)
+
+    for k_rr, k_rad in set(zip(rr.tolist(), rad.tolist())):
+        sel = np.nonzero((rr == k_rr) & (rad == k_rad))[0]
+        dy, dx = _plantilla_disco(k_rr, k_rad)
+        ys = c[sel, 1, None] + dy[None, :]
+        xs = c[sel, 0, None] + dx[None, :]
+        valido = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+        tinta = (mask_bin[np.clip(ys, 0, h - 1), np.clip(xs, 0, w - 1)] != 0) & valido
+        n = valido.sum(axis=1)
+        out[sel] = np.where(n > 0, tinta.sum(axis=1) / np.maximum(n, 1), 0.0)
+    return out
 
-    # máscara circular interior
-    hh, ww = roi.shape[:2]
-    yy, xx = np.ogrid[:hh, :ww]
-    cxx = cx - x0
-    cyy = cy - y0
-    rad = max(6, rr - pad)
-    circle_mask = ((xx - cxx) ** 2 + (yy - cyy) ** 2) <= (rad ** 2)
 
-    inside = roi[circle_mask]
-    if inside.size == 0:
-        return 0.0
+def _a_escala(circulos, escala):
+    # círculos (x, y, r) de coords A4 a los px de un plano reducido
+    c = np.asarray(circulos, dtype=np.int64)
+    return c if escala == 1.0 else np.round(c * escala).astype(np.int64)
 
-    return float(cv2.countNonZero(inside)) / float(inside.size)
 
-def detectar_respuestas_por_circulos(img_a4, th_bin, filas, debug=True):
+def score_circulo(mask_bin, cx, cy, r):
     """
-    Detecta respuestas usando círculos reales.
-    Devuelve: respuestas_lista, debug_a4
+    Calcula densidad de tinta dentro del círculo (en la máscara binaria).
     """
-    debug_a4 = img_a4.copy() if debug else None
+    return float(score_circulos(mask_bin, [(cx, cy, r)])[0])
 
-    zona_color = _safe_crop(img_a4, OMR_REGION["x0"], OMR_REGION["y0"], OMR_REGION["x1"], OMR_REGION["y1"])
-    zona_bin = _safe_crop(th_bin, OMR_REGION["x0"], OMR_REGION["y0"], OMR_REGION["x1"], OMR_REGION["y1"])
+def detectar_respuestas_por_circulos(img_a4, th_bin, filas, debug=True, detector=None):
+    """
+    Detecta respuestas usando círculos reales (img_a4: imagen o ContextoHoja;
+    th_bin cubre la misma zona que img_a4). `detector`: clave de DETECTORES
+    (None = DETECTOR_CIRCULOS).
+    Devuelve: respuestas_lista, debug_a4, rejilla, puntuaciones
+    rejilla: por fila {letra: (x, y, r)} en coords de la zona OMR (ver LAYOUTS)
+    puntuaciones: por fila {letra: densidad de tinta} ({} si la fila no tiene círculos)
+    """
+    hoja = contexto(img_a4)
+    escala = hoja.escala
+    debug_a4 = hoja.lienzo_debug() if debug else None
 
-    if zona_color is None or zona_bin is None:
-        return [], debug_a4
+    # gris de la hoja ya calculado (un recorte del gris == gris del recorte)
+    zona_gray = hoja.recorte(hoja.gris, OMR_REGION["x0"], OMR_REGION["y0"], OMR_REGION["x1"], OMR_REGION["y1"])
+    zona_bin = hoja.recorte(th_bin, OMR_REGION["x0"], OMR_REGION["y0"], OMR_REGION["x1"], OMR_REGION["y1"])
 
-    zona_gray = cv2.cvtColor(zona_color, cv2.COLOR_BGR2GRAY)
+    if zona_gray is None or zona_bin is None:
+        return [], debug_a4, [], []
 
     # Rectángulo azul de la zona OMR
     if debug_a4 is not None:
@@ -505,7 +1167,14 @@ def detectar_respuestas_por_circulos(img_a4, th_bin, filas, debug=True):
             3
         )
 
-    circles = detectar_circulos(zona_gray)
+    detector = detector or DETECTOR_CIRCULOS
+    with etapa("hough"):  # etapa de detección, sea cual sea el detector
+        circles = DETECTORES[detector](zona_gray, zona_bin, escala)
+    if escala != 1.0:
+        # a coords A4: agrupar y la rejilla cacheada trabajan siempre en px A4
+        circles = [(int(round(x / escala)), int(round(y / escala)), int(round(r / escala))) for x, y, r in circles]
+    anotar("circulos", len(circles))
+    anotar("detector", detector)
 
     # Todos los círculos detectados en ROJO
     if debug_a4 is not None:
@@ -519,154 +1188,636 @@ def detectar_respuestas_por_circulos(img_a4, th_bin, filas, debug=True):
             )
 
     if len(circles) < 20:
-        return [], debug_a4
+        return [], debug_a4, [], []
 
-    filas_groups = agrupar_filas(circles, filas)
-    if len(filas_groups) < filas:
-        filas_groups += [[] for _ in range(filas - len(filas_groups))]
+    with etapa("agrupar"):
+        filas_groups = agrupar_filas(circles, filas)
+        if len(filas_groups) < filas:
+            filas_groups += [[] for _ in range(filas - len(filas_groups))]
 
-    col_centers = cluster_columnas_x(circles)
+        col_centers = cluster_columnas_x(circles)
+    anotar("filas_reconstruidas", sum(1 for f in filas_groups[:filas] if not f))
     if not col_centers or len(col_centers) != 4:
-        return [], debug_a4
+        return [], debug_a4, [], []
 
-    respuestas = []
+    c = np.array(circles, dtype=np.int64)
+    cx, cy = c[:, 0], c[:, 1]
+    centros = np.array(col_centers, dtype=np.float64)
 
+    # Y esperada para rescatar filas vacías (igual para todas: se calcula una vez)
+    ys_detectadas = [np.mean(cy[fila]) for fila in filas_groups if fila]
+    if ys_detectadas:
+        y_base = min(ys_detectadas)
+        gaps = [ys_detectadas[i + 1] - ys_detectadas[i] for i in range(len(ys_detectadas) - 1)]
+        gaps = [g for g in gaps if g > 5]
+        paso = np.median(gaps) if gaps else 55.0
+
+    # Círculo más cercano a cada centro de columna, fila a fila
+    filas_idxs = []
+    elegidos_idx = []
     for row_i in range(filas):
         idxs = filas_groups[row_i]
 
         # Si la fila viene vacía, buscar círculos cercanos a la Y esperada
-        if not idxs:
-            ys_detectadas = []
-            for fila in filas_groups:
-                if fila:
-                    ys_detectadas.append(np.mean([circles[i][1] for i in fila]))
-
-            if ys_detectadas:
-                y_base = min(ys_detectadas)
-                if len(ys_detectadas) >= 2:
-                    gaps = [ys_detectadas[i + 1] - ys_detectadas[i] for i in range(len(ys_detectadas) - 1)]
-                    gaps = [g for g in gaps if g > 5]
-                    paso = np.median(gaps) if gaps else 55.0
-                else:
-                    paso = 55.0
-
-                y_esperada = y_base + row_i * paso
-                idxs = [i for i, c in enumerate(circles) if abs(c[1] - y_esperada) <= max(18, paso * 0.35)]
-
-        if not idxs:
+        if not idxs and ys_detectadas:
+            y_esperada = y_base + row_i * paso
+            idxs = np.nonzero(np.abs(cy - y_esperada) <= max(18, paso * 0.35))[0]
+
+        idxs = np.asarray(idxs, dtype=np.int64)
+        filas_idxs.append(idxs)
+        if idxs.size:
+            cerca = np.argmin(np.abs(cx[idxs, None] - centros[None, :]), axis=0)
+            elegidos_idx.append(idxs[cerca])
+
+    # TODAS las burbujas de la hoja puntuadas de una vez
+    if elegidos_idx:
+        with etapa("puntuar"):
+            todas = np.concatenate(elegidos_idx)
+            puntuacion = score_circulos(zona_bin, _a_escala(c[todas], escala)).reshape(-1, len(OPCIONES))
+
+    respuestas = []
+    rejilla = []
+    puntuaciones = []
+    k = 0
+    for row_i, idxs in enumerate(filas_idxs):
+        if not idxs.size:
             respuestas.append("")
+            rejilla.append({})
+            puntuaciones.append({})
             continue
 
-        scores = {c: 0.0 for c in OPCIONES}
-        elegidos = {}
+        elegidos = {l: tuple(int(v) for v in circles[i]) for l, i in zip(OPCIONES, elegidos_idx[k])}
+        scores = {l: float(v) for l, v in zip(OPCIONES, puntuacion[k])}
+        k += 1
 
-        # Elegir el círculo más cercano a cada centro de columna
-        for ci, letter in enumerate(OPCIONES):
-            target_x = col_centers[ci]
+        resp = decidir_respuesta(scores)
+        respuestas.append(resp)
+        rejilla.append(elegidos)
+        puntuaciones.append(scores)
 
-            best = None
-            best_dx = None
+        if debug_a4 is not None:
+            y_mean = int(np.mean(cy[idxs]))
+            _dibujar_fila(debug_a4, row_i, elegidos, resp, y_mean)
 
-            for idx in idxs:
-                x, y, r = circles[idx]
-                dx = abs(x - target_x)
-                if best_dx is None or dx < best_dx:
-                    best_dx = dx
-                    best = (x, y, r)
+    return respuestas, debug_a4, rejilla, puntuaciones
 
-            if best is None:
-                scores[letter] = 0.0
-                continue
 
-            x, y, r = best
-            elegidos[letter] = (x, y, r)
-            scores[letter] = score_circulo(zona_bin, x, y, r)
+def decidir_respuesta(scores):
+    """
+    scores: {letra: densidad}. Devuelve letra, "" (blanco) o "X" (doble).
+    """
+    orden = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    best_letter, best_val = orden[0]
+    second_val = orden[1][1]
 
-        orden = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
-        best_letter, best_val = orden[0]
-        second_val = orden[1][1]
+    if best_val < UMBRAL_VACIO:
+        return ""
+    if (second_val > UMBRAL_DOBLE_ABS) and (second_val > best_val * UMBRAL_DOBLE_RATIO):
+        return "X"
+    return best_letter
 
-        if best_val < UMBRAL_VACIO:
-            resp = ""
-        elif (second_val > UMBRAL_DOBLE_ABS) and (second_val > best_val * UMBRAL_DOBLE_RATIO):
-            resp = "X"
-        else:
-            resp = best_letter
 
+def margen_respuesta(scores):
+    """
+    Confianza de decidir_respuesta: cuánto tendría que cambiar una densidad
+    para que la decisión fuera otra (0 = justo en un umbral; 0 sin puntuaciones).
+    """
+    if not scores:
+        return 0.0
+    orden = sorted(scores.values(), reverse=True)
+    best_val, second_val = orden[0], orden[1]
+    if best_val < UMBRAL_VACIO:
+        return UMBRAL_VACIO - best_val
+
+    d_abs = second_val - UMBRAL_DOBLE_ABS
+    d_ratio = second_val - best_val * UMBRAL_DOBLE_RATIO
+    if d_abs > 0 and d_ratio > 0:
+        m_doble = min(d_abs, d_ratio)      # deja de ser doble si cae cualquiera
+    else:
+        m_doble = max(-d_abs, -d_ratio)    # para ser doble tienen que pasar los dos
+    return min(best_val - UMBRAL_VACIO, m_doble)
+
+
+def filas_dudosas(respuestas, rejilla, puntuaciones, filas):
+    """
+    Filas del pase rápido a repetir a resolución completa, o None si hay que
+    repetir la hoja entera (pase fallido, una fila sin sus 4 círculos o demasiadas dudas).
+    Dudosa: margen < RAPIDO_MARGEN o dos burbujas con tinta (doble o tachón: un
+    relleno rayado pierde densidad al reducir y la proporción ya no vale).
+    """
+    if not respuestas or not all(fila_confiable(f) for f in rejilla[:filas]):
+        return None
+    dudosas = [i for i, p in enumerate(puntuaciones)
+               if margen_respuesta(p) < RAPIDO_MARGEN or sorted(p.values())[-2] > UMBRAL_DOBLE_ABS]
+    if len(dudosas) > RAPIDO_MAX_DUDOSAS * filas:
+        return None
+    return dudosas
+
+
+def reforzar_filas(respuestas, puntuaciones, rejilla, dudosas, tira, detector=None):
+    """
+    Vuelve a puntuar las filas `dudosas` a resolución completa (en su sitio).
+    tira(y0, y1): ContextoHoja a resolución completa con la zona OMR entre esas
+    dos Y A4 (ver _zona_omr), sólo la banda de la fila. Los círculos se vuelven a detectar en
+    la banda: centro y radio del pase rápido son demasiado gruesos para una duda.
+    """
+    for i in dudosas:
+        c = np.array([rejilla[i][l] for l in OPCIONES], dtype=np.int64)
+        radio = int(c[:, 2].max())
+        # la banda empieza a un múltiplo de HOUGH_PASO de la zona: mismo acumulador
+        # de Hough que a resolución completa => los mismos círculos
+        y0 = OMR_REGION["y0"] + (int(c[:, 1].min()) - radio - TIRA_PAD) // HOUGH_PASO * HOUGH_PASO
+        y1 = OMR_REGION["y0"] + int(c[:, 1].max()) + radio + TIRA_PAD
+        banda = tira(y0, y1)
+        c = c + (0, OMR_REGION["y0"] - y0, 0)
+        # gris y tinta de la banda (misma ecualización que la zona entera)
+        gris = banda.recorte(banda.gris, OMR_REGION["x0"], y0, OMR_REGION["x1"], y1)
+        tinta = banda.recorte(binarizar_tinta_pro(banda), OMR_REGION["x0"], y0, OMR_REGION["x1"], y1)
+        with etapa("hough"):
+            detectados = DETECTORES[detector or DETECTOR_CIRCULOS](gris, tinta)
+        if detectados:
+            d = np.array(detectados, dtype=np.int64)
+            dist = np.linalg.norm(c[:, None, :2] - d[None, :, :2], axis=2)
+            cerca = dist.argmin(axis=1)
+            ok = dist[np.arange(len(c)), cerca] <= RADIO_MIN
+            c[ok] = d[cerca[ok]]
+        puntuacion = score_circulos(tinta, c)
+        scores = {l: float(v) for l, v in zip(OPCIONES, puntuacion)}
+        respuestas[i] = decidir_respuesta(scores)
+        puntuaciones[i] = scores
+
+
+def _dibujar_fila(debug_a4, row_i, elegidos, resp, y_mean):
+    # Círculos usados para esa fila en VERDE
+    for letter in OPCIONES:
+        if letter not in elegidos:
+            continue
+        x, y, r = elegidos[letter]
+        cx = OMR_REGION["x0"] + x
+        cy = OMR_REGION["y0"] + y
+        cv2.circle(debug_a4, (cx, cy), r, (0, 255, 0), 2)
+
+    # Respuesta final en AMARILLO
+    if resp in elegidos and resp != "X":
+        x, y, r = elegidos[resp]
+        cx = OMR_REGION["x0"] + x
+        cy = OMR_REGION["y0"] + y
+        cv2.circle(debug_a4, (cx, cy), r + 2, (0, 255, 255), 3)
+
+    # Etiqueta de texto
+    yy = OMR_REGION["y0"] + y_mean
+    cv2.putText(
+        debug_a4,
+        f"{row_i+1}:{resp or '-'}",
+        (OMR_REGION["x0"] - 170, yy + 10),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.55,
+        (0, 0, 255) if resp == "X" else (0, 0, 0),
+        2
+    )
+
+
+# ============================================================
+# 5b) REJILLA CACHEADA POR EXAMEN (sin HoughCircles en hojas repetidas)
+# ============================================================
+# Todas las hojas de un examen comparten plantilla: la rejilla de la primera
+# hoja fiable se reutiliza (clave: id_examen, num_preguntas, pagina, detector).
+LAYOUT_MAX_EXAMENES = int(os.environ.get("OMR_LAYOUT_MAX_EXAMENES", "256"))  # 0 = desactivado
+LAYOUT_AJUSTE_PX = int(os.environ.get("OMR_LAYOUT_AJUSTE_PX", "12"))         # desplazamiento máx. buscado
+LAYOUT_MIN_AJUSTE = float(os.environ.get("OMR_LAYOUT_MIN_AJUSTE", "0.60"))   # contorno impreso visible
+
+_LAYOUTS = OrderedDict()
+_LAYOUTS_LOCK = threading.Lock()
+
+# puntos del contorno de cada burbuja para el test de ajuste
+_AJUSTE_ANGULOS = np.linspace(0.0, 2.0 * np.pi, 32, endpoint=False)
+_AJUSTE_RADIOS = np.array([0.85, 1.0, 1.15])
+
+
+def rejilla_confiable(rejilla, filas):
+    """
+    Sólo se cachea una rejilla completa: todas las filas con 4 círculos
+    distintos, ordenados en X y alineados en Y.
+    """
+    return len(rejilla) == filas and all(fila_confiable(fila) for fila in rejilla)
+
+
+def fila_confiable(fila):
+    # 4 círculos distintos, ordenados en X y alineados en Y
+    if len(fila) != len(OPCIONES):
+        return False
+    pts = [fila[l] for l in OPCIONES]
+    xs = [p[0] for p in pts]
+    if any(xs[i + 1] - xs[i] < pts[i][2] for i in range(len(xs) - 1)):
+        return False
+    y_med = np.mean([p[1] for p in pts])
+    return not any(abs(p[1] - y_med) > p[2] for p in pts)
+
+
+def obtener_rejilla(clave):
+    with _LAYOUTS_LOCK:
+        rejilla = _LAYOUTS.get(clave)
+        if rejilla is not None:
+            _LAYOUTS.move_to_end(clave)
+        return rejilla
+
+
+def guardar_rejilla(clave, rejilla):
+    if LAYOUT_MAX_EXAMENES <= 0:
+        return
+    with _LAYOUTS_LOCK:
+        _LAYOUTS[clave] = rejilla
+        _LAYOUTS.move_to_end(clave)
+        while len(_LAYOUTS) > LAYOUT_MAX_EXAMENES:
+            _LAYOUTS.popitem(last=False)
+
+
+def olvidar_rejilla(clave):
+    with _LAYOUTS_LOCK:
+        _LAYOUTS.pop(clave, None)
+
+
+def alinear_rejilla(zona_bin, rejilla, escala=1.0):
+    """
+    Busca el desplazamiento (dx, dy) que mejor encaja los contornos impresos de
+    la rejilla con la tinta de la hoja (grueso cada 3 px y luego fino a 1 px).
+    Devuelve (dx, dy, ajuste); ajuste = fracción del contorno que cae en tinta.
+    Con `escala` (zona reducida) busca en px de la zona y devuelve dx, dy en px A4.
+    """
+    c = np.array([fila[l] for fila in rejilla for l in OPCIONES], dtype=np.float32) * escala
+    rr = c[:, 2, None, None] * _AJUSTE_RADIOS[None, :, None]
+    px = c[:, 0, None, None] + rr * np.cos(_AJUSTE_ANGULOS)[None, None, :]
+    py = c[:, 1, None, None] + rr * np.sin(_AJUSTE_ANGULOS)[None, None, :]
+    px = np.round(px).astype(np.int32)
+    py = np.round(py).astype(np.int32)
+    h, w = zona_bin.shape[:2]
+
+    def ajuste(dx, dy):
+        xs = np.clip(px + dx, 0, w - 1)
+        ys = np.clip(py + dy, 0, h - 1)
+        tinta = zona_bin[ys, xs] > 0           # (burbujas, radios, ángulos)
+        return float(tinta.any(axis=1).mean())
+
+    def mejor(candidatos):
+        return max(((ajuste(dx, dy), dx, dy) for dx, dy in candidatos), key=lambda t: t[0])
+
+    lim = max(3, int(round(LAYOUT_AJUSTE_PX * escala)))
+    rango = range(-lim, lim + 1, 3)
+    a, dx0, dy0 = mejor((dx, dy) for dx in rango for dy in rango)
+    a, dx, dy = mejor((dx0 + i, dy0 + j) for i in (-1, 0, 1) for j in (-1, 0, 1))
+    if escala != 1.0:
+        dx, dy = int(round(dx / escala)), int(round(dy / escala))
+    return dx, dy, a
+
+
+def detectar_respuestas_por_rejilla(img_a4, th_bin, rejilla, debug=True):
+    """
+    Lee las burbujas directamente en las posiciones de una rejilla cacheada.
+    Devuelve: respuestas_lista, debug_a4, rejilla desplazada, puntuaciones
+    — o (None, None, None, None) si la rejilla no encaja.
+    """
+    hoja = contexto(img_a4)
+    zona_bin = hoja.recorte(th_bin, OMR_REGION["x0"], OMR_REGION["y0"], OMR_REGION["x1"], OMR_REGION["y1"])
+    if zona_bin is None:
+        return None, None, None, None
+
+    with etapa("rejilla"):
+        dx, dy, ajuste = alinear_rejilla(zona_bin, rejilla, hoja.escala)
+    if ajuste < LAYOUT_MIN_AJUSTE:
+        return None, None, None, None
+
+    debug_a4 = hoja.lienzo_debug() if debug else None
+    if debug_a4 is not None:
+        cv2.rectangle(
+            debug_a4,
+            (OMR_REGION["x0"], OMR_REGION["y0"]),
+            (OMR_REGION["x1"], OMR_REGION["y1"]),
+            (255, 0, 0),
+            3
+        )
+
+    c = np.array([fila[l] for fila in rejilla for l in OPCIONES], dtype=np.int64) + (dx, dy, 0)
+    with etapa("puntuar"):
+        puntuacion = score_circulos(zona_bin, _a_escala(c, hoja.escala)).reshape(-1, len(OPCIONES))
+
+    respuestas = []
+    usada = []
+    puntuaciones = []
+    for row_i, fila in enumerate(rejilla):
+        elegidos = {l: (x + dx, y + dy, r) for l, (x, y, r) in fila.items()}
+        scores = {l: float(v) for l, v in zip(OPCIONES, puntuacion[row_i])}
+        resp = decidir_respuesta(scores)
         respuestas.append(resp)
+        usada.append(elegidos)
+        puntuaciones.append(scores)
 
         if debug_a4 is not None:
-            # Círculos usados para esa fila en VERDE
-            for letter in OPCIONES:
-                if letter not in elegidos:
-                    continue
-                x, y, r = elegidos[letter]
-                cx = OMR_REGION["x0"] + x
-                cy = OMR_REGION["y0"] + y
-                cv2.circle(debug_a4, (cx, cy), r, (0, 255, 0), 2)
-
-            # Respuesta final en AMARILLO
-            if resp in elegidos and resp != "X":
-                x, y, r = elegidos[resp]
-                cx = OMR_REGION["x0"] + x
-                cy = OMR_REGION["y0"] + y
-                cv2.circle(debug_a4, (cx, cy), r + 2, (0, 255, 255), 3)
-
-            # Etiqueta de texto
-            if idxs:
-                y_mean = int(np.mean([circles[i][1] for i in idxs]))
-                yy = OMR_REGION["y0"] + y_mean
-                cv2.putText(
-                    debug_a4,
-                    f"{row_i+1}:{resp or '-'}",
-                    (OMR_REGION["x0"] - 170, yy + 10),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.55,
-                    (0, 0, 255) if resp == "X" else (0, 0, 0),
-                    2
-                )
-
-    return respuestas, debug_a4
+            y_mean = int(np.mean([p[1] for p in elegidos.values()]))
+            _dibujar_fila(debug_a4, row_i, elegidos, resp, y_mean)
+
+    return respuestas, debug_a4, usada, puntuaciones
+
+
+# ============================================================
+# FILTRO DE CALIDAD (miniatura, milisegundos)
+# ============================================================
+MENSAJES_CALIDAD = {
+    "borrosa": "Foto borrosa: enfoca la hoja y repite la foto",
+    "oscura": "Foto demasiado oscura: busca más luz",
+    "sobreexpuesta": "Foto quemada (demasiada luz o un reflejo): evita el flash directo",
+    "sin_contraste": "Foto sin contraste: no se distingue la tinta del papel",
+    "sin_marcas": "No se ven las 4 marcas de las esquinas: encuadra la hoja entera",
+    "lejos": "La hoja sale muy pequeña: acerca la cámara",
+}
+
+
+def medir_calidad(foto):
+    """
+    Medidas baratas de la miniatura de la foto (ContextoHoja).
+    """
+    mini = foto.plano("miniatura")
+    p1, p99 = np.percentile(mini, (1, 99))
+    _, papel = cv2.threshold(mini, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return {
+        "nitidez": round(float(cv2.Laplacian(mini, cv2.CV_32F).var()), 1),
+        "brillo": round(float(mini.mean()), 1),
+        "contraste": round(float(p99 - p1), 1),
+        "quemada": round(float(np.count_nonzero(mini >= 250)) / mini.size, 3),
+        "papel": round(float(np.count_nonzero(papel)) / papel.size, 3),
+    }
+
+
+def motivo_calidad(calidad):
+    """
+    Motivo (clave de MENSAJES_CALIDAD) si la foto NO puede salir bien; si no, None.
+    """
+    if calidad["brillo"] < CALIDAD_BRILLO_MIN:
+        return "oscura"
+    if calidad["contraste"] < CALIDAD_CONTRASTE_MIN:
+        # papel saturado sin más es un escaneo limpio; quemada si además se come la tinta
+        return "sobreexpuesta" if calidad["quemada"] > CALIDAD_QUEMADA_MAX else "sin_contraste"
+    if calidad["nitidez"] < CALIDAD_NITIDEZ_MIN:
+        return "borrosa"
+    return None
+
+
+def motivo_encuadre(calidad, marcas):
+    """
+    Igual que motivo_calidad() pero con las marcas ya buscadas: hoja cortada o muy lejos.
+    """
+    if marcas is None:
+        # sin marcas sólo hay opción si es un escaneo (la hoja ocupa toda la imagen)
+        return None if calidad["papel"] >= CALIDAD_PAPEL_SIN_MARCAS else "sin_marcas"
+    lados = np.linalg.norm(marcas - np.roll(marcas, -1, axis=0), axis=1)  # tl-tr, tr-br, br-bl, bl-tl
+    calidad["hoja_px"] = int(max(lados[0] + lados[2], lados[1] + lados[3]) / 2.0)
+    return "lejos" if calidad["hoja_px"] < CALIDAD_HOJA_MIN_PX else None
+
+
+def _rechazo_calidad(motivo, calidad, debug, img):
+    anotar("calidad", motivo)
+    return _con_debug({
+        "ok": False,
+        "error": MENSAJES_CALIDAD[motivo],
+        "motivo_calidad": motivo,
+        "calidad": calidad
+    }, debug, None, img)
+
 
 # ============================================================
 # PIPELINE PRINCIPAL ✅
 # ============================================================
-def procesar_omr(binario):
-    npimg = np.frombuffer(binario, np.uint8)
-    img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
-    if img is None:
-        return {"ok": False, "error": "Imagen inválida"}
+class ImagenRechazada(ValueError):
+    # la subida no se decodifica (demasiado grande); el mensaje va al cliente
+    pass
 
-    # 0) QR ANTES de normalizar (muchas veces se lee mejor)
-    codigo0, debug_qr0 = leer_qr_robusto(img)
-    parsed0 = parsear_codigo_qr(codigo0) if codigo0 else None
 
-    # 1) normalizar por marcas
-    img_a4 = normalizar_a4_con_marcas(img)
+_FLAGS_REDUCIDO = {
+    (1, False): cv2.IMREAD_COLOR, (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4, (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+    (1, True): cv2.IMREAD_GRAYSCALE, (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4, (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def dimensiones_imagen(binario):
+    """
+    (ancho, alto) leyendo SÓLO la cabecera (JPEG / PNG). None si no se sabe.
+    """
+    if binario[:8] == b"\x89PNG\r\n\x1a\n" and len(binario) >= 24:
+        return struct.unpack(">II", binario[16:24])
 
-    # 2) QR DESPUÉS de normalizar si no se pudo antes
-    codigo, debug_qr = codigo0, debug_qr0
-    parsed = parsed0
+    if binario[:2] != b"\xff\xd8":
+        return None
+    # JPEG: saltar segmentos hasta el SOF (la miniatura EXIF va dentro de APP1 y se salta entera)
+    i, n = 2, len(binario)
+    while i + 9 <= n:
+        if binario[i] != 0xFF:
+            return None
+        marcador = binario[i + 1]
+        if marcador == 0xFF:
+            i += 1
+            continue
+        if marcador == 0x01 or 0xD0 <= marcador <= 0xD8:
+            i += 2
+            continue
+        if 0xC0 <= marcador <= 0xCF and marcador not in (0xC4, 0xC8, 0xCC):
+            alto, ancho = struct.unpack(">HH", binario[i + 5:i + 9])
+            return ancho, alto
+        i += 2 + struct.unpack(">H", binario[i + 2:i + 4])[0]
+    return None
+
+
+def factor_reduccion(ancho, alto, canales=3):
+    """
+    Mayor reducción de decodificación (1, 2, 4, 8) con la que el lado mayor
+    aún llega al alto de un A4 a DPI_OBJETIVO; más si no cabe en la parte de
+    MEMORIA_MB reservada a la foto.
+    """
+    objetivo = A4_H * DPI_OBJETIVO / 300.0
+    lado = max(ancho, alto)
+    k = 1
+    for k_ in (8, 4, 2):
+        if lado / k_ >= objetivo:
+            k = k_
+            break
+    while k < 8 and ancho * alto * canales / float(k * k) > MEMORIA_BYTES * IMAGEN_FRACCION_MEMORIA:
+        k *= 2
+    return k
+
+
+def decodificar_imagen(binario, gris=False):
+    """
+    Imagen (BGR, o gris si `gris`) ya a la escala útil. None si no es una imagen.
+    ImagenRechazada si está vacía o supera los límites de tamaño (se comprueba ANTES de decodificar).
+    """
+    if not binario:
+        raise ImagenRechazada("Imagen vacía")  # cv2.imdecode falla con una aserción
+    if len(binario) > SUBIDA_MAX_BYTES:
+        raise ImagenRechazada(f"Imagen demasiado grande (máx {SUBIDA_MAX_BYTES // (1024 * 1024)} MB)")
+
+    dims = dimensiones_imagen(binario)
+    k = 1
+    if dims is not None:
+        if dims[0] * dims[1] > IMAGEN_MAX_MPX * 1e6:
+            raise ImagenRechazada(f"Imagen de demasiados píxeles (máx {IMAGEN_MAX_MPX:g} Mpx)")
+        k = factor_reduccion(dims[0], dims[1], 1 if gris else 3)
+    anotar("reduccion", k)
+
+    img = cv2.imdecode(np.frombuffer(binario, np.uint8), _FLAGS_REDUCIDO[(k, gris)])
+    if img is not None and dims is None and img.shape[0] * img.shape[1] > IMAGEN_MAX_MPX * 1e6:
+        # formato sin cabecera conocida: sólo se puede mirar después
+        raise ImagenRechazada(f"Imagen de demasiados píxeles (máx {IMAGEN_MAX_MPX:g} Mpx)")
+    return img
+
+
+def ingesta_en_gris(debug):
+    # sin debug nada usa el color: gris ocupa 1/3 y decodifica más rápido
+    return INGESTA_GRIS and not debug
+
+
+def procesar_omr(binario, debug=None, detector=None):
+    with cronometrar() as medidas:
+        try:
+            with etapa("decodificar"):
+                img = decodificar_imagen(binario, ingesta_en_gris(debug))
+        except ImagenRechazada as e:
+            res = {"ok": False, "error": str(e)}
+        else:
+            if img is None:
+                res = {"ok": False, "error": "Imagen inválida"}
+            else:
+                res = procesar_omr_img(img, debug, detector)
+    res["_metricas"] = medidas
+    return res
+
+
+def _version_pipeline():
+    """
+    Hash del código que produce el resultado (omr + qr) y de la versión de OpenCV.
+    """
+    h = hashlib.sha256(cv2.__version__.encode())
+    for modulo in (__file__, qr_omr.__file__):
+        with open(modulo, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+fijar_huella(_version_pipeline(), DETECTOR_CIRCULOS, WARP_ROI, RAPIDO_ESCALA, RAPIDO_MARGEN,
+             CALIDAD, CALIDAD_NITIDEZ_MIN, DPI_OBJETIVO, INGESTA_GRIS, IMAGEN_MAX_MPX, MEMORIA_MB,
+             MARCAS_LADO_MAX, LAYOUT_MAX_EXAMENES, LAYOUT_AJUSTE_PX, LAYOUT_MIN_AJUSTE,
+             qr_omr.QR_CADENA)
+
+
+def procesar_omr_cacheado(binario, debug=None, detector=None):
+    """
+    procesar_omr con caché por hash del fichero (reintentos / doble envío).
+    Con debug (las imágenes no se guardan en caché) o con otro detector siempre se calcula.
+    """
+    if debug or detector or not cache_resultados.activa:
+        return procesar_omr(binario, debug, detector)
+    return cache_resultados.calcular(hash_binario(binario), lambda: procesar_omr(binario))
+
+
+def _con_debug(res, debug, zona_qr=None, debug_a4=None):
+    """
+    Si se pidió debug, adjunta los JPEG reducidos (bytes) en res["_debug"].
+    El servidor decide luego si van inline o al almacén (publicar_debug).
+    """
+    if debug:
+        with etapa("debug"):
+            jpgs = {
+                "qr": jpg_debug(zona_qr, debug["escala"], debug["calidad"]),
+                "hoja": jpg_debug(debug_a4, debug["escala"], debug["calidad"]),
+            }
+        res["_debug"] = {k: v for k, v in jpgs.items() if v is not None}
+    return res
+
+
+def procesar_omr_img(img, debug=None, detector=None):
+    """
+    Pipeline completo sobre una imagen BGR ya decodificada.
+    `debug`: None (sin imágenes) o dict de opciones_debug().
+    `detector`: None (= DETECTOR_CIRCULOS) o clave de DETECTORES.
+    Tiempos y contadores de la hoja van en res["_metricas"] (ver publicar_metricas).
+    """
+    with cronometrar() as medidas:
+        res = _procesar_omr_img(img, debug, detector)
+    res["_metricas"] = medidas
+    return res
+
+
+def _procesar_omr_img(img, debug, detector):
+    # presupuesto de tiempo QR para TODO el request
+    qr_deadline = time.monotonic() + QR_PRESUPUESTO_S
+
+    # planos derivados (gris, CLAHE, binarizada...) compartidos por todas las etapas
+    foto = ContextoHoja(img)
+
+    # antes de nada, calidad en la miniatura: borrosa / oscura / quemada => fuera en ms
+    calidad = None
+    if CALIDAD:
+        with etapa("calidad"):
+            calidad = medir_calidad(foto)
+            motivo = motivo_calidad(calidad)
+        if motivo:
+            return _rechazo_calidad(motivo, calidad, debug, img)
+
+    # 0) marcas de esquina: dan posición y giro de la hoja
+    with etapa("marcas"):
+        marcas = localizar_marcas(foto)
+
+    if CALIDAD:
+        motivo = motivo_encuadre(calidad, marcas)
+        if motivo:
+            return _rechazo_calidad(motivo, calidad, debug, img)
+
+    # 1) QR dirigido: sólo la zona donde DEBE estar según las marcas
+    codigo, zona_qr, parsed, rot = None, None, None, 0
+    if marcas is not None:
+        with etapa("qr"):
+            codigo, rot, zona_qr = leer_qr_por_marcas(img, marcas, qr_deadline)
+        parsed = parsear_codigo_qr(codigo) if codigo else None
+        anotar("qr_via", "marcas")
+
+    # 2) último recurso: cascada completa sobre la foto original
     if not parsed:
-        codigo, debug_qr = leer_qr_robusto(img_a4)
+        with etapa("qr"):
+            codigo, zona_qr = leer_qr_robusto(foto, qr_deadline, bool(debug))
         parsed = parsear_codigo_qr(codigo) if codigo else None
+        anotar("qr_via", "foto")
+
+    # 3) normalizar (con el giro que nos ha dado el QR)
+    rapido = bool(RAPIDO_ESCALA) and WARP_ROI and not debug
+    with etapa("normalizar"):
+        if WARP_ROI:
+            # sólo la zona OMR, en gris; la hoja en color sólo si se dibuja debug
+            hoja = _zona_omr(foto, img, marcas, rot, RAPIDO_ESCALA if rapido else 1.0)
+        else:
+            hoja = ContextoHoja(warp_a4(img, marcas, rot))
 
+    # 4) y si aún no hay QR, cascada sobre la hoja normalizada (su esquina QR)
     if not parsed:
-        return {
+        with etapa("qr"):
+            esquina = hoja
+            if WARP_ROI:
+                esquina = ContextoHoja(warp_zona_a4(img, marcas, rot, 0, 0, *QR_ZONA_FALLBACK_A4))
+            codigo, zona_qr = leer_qr_robusto(esquina, qr_deadline, bool(debug))
+        parsed = parsear_codigo_qr(codigo) if codigo else None
+        anotar("qr_via", "a4")
+
+    if not parsed:
+        anotar("qr_via", "ninguna")
+        return _con_debug({
             "ok": False,
-            "error": "QR no detectado",
-            "debug_qr": debug_qr
-        }
+            "error": "QR no detectado"
+        }, debug, zona_qr)
 
     id_examen, id_alumno, fecha, num_preguntas, pagina = parsed
 
-    # 3) binarización
-    th = binarizar_tinta_pro(img_a4)
-
-    # 4) filas a leer en esta página
+    # 5) filas a leer en esta página
     filas, offset = filas_a_leer(num_preguntas, pagina)
     if filas <= 0:
-        return {
+        return _con_debug({
             "ok": False,
             "error": "Esta página no tiene preguntas según el QR",
             "codigo": codigo,
@@ -674,14 +1825,31 @@ def procesar_omr(binario):
             "id_alumno": id_alumno,
             "fecha": fecha,
             "num_preguntas": num_preguntas,
-            "pagina": pagina,
-            "debug_qr": debug_qr
-        }
+            "pagina": pagina
+        }, debug, zona_qr)
+
+    # 6) respuestas (binarizar + rejilla cacheada o detección de círculos)
+    # el detector va en la clave: con detector=componentes no vale la rejilla de Hough
+    clave = (id_examen, num_preguntas, pagina, detector or DETECTOR_CIRCULOS)
+    respuestas_lista, debug_a4, rejilla, puntuaciones = _leer_respuestas(hoja, filas, clave, debug, detector)
+
+    # 7) pase rápido: sólo lo dudoso otra vez a resolución completa
+    if rapido:
+        dudosas = filas_dudosas(respuestas_lista, rejilla, puntuaciones, filas)
+        if dudosas is None:
+            anotar("rapido", "hoja")
+            with etapa("normalizar"):
+                hoja = _zona_omr(foto, img, marcas, rot)
+            respuestas_lista, debug_a4, rejilla, puntuaciones = _leer_respuestas(hoja, filas, clave, debug, detector)
+        else:
+            anotar("rapido", "filas" if dudosas else "limpia")
+            anotar("filas_escaladas", len(dudosas))
+            with etapa("escalar"):
+                reforzar_filas(respuestas_lista, puntuaciones, rejilla, dudosas,
+                               lambda y0, y1: _zona_omr(foto, img, marcas, rot, y0=y0, y1=y1), detector)
 
-    # 5) respuestas por detección REAL de círculos
-    respuestas_lista, debug_a4 = detectar_respuestas_por_circulos(img_a4, th, filas, debug=True)
     if not respuestas_lista:
-        return {
+        return _con_debug({
             "ok": False,
             "error": "No se pudieron detectar burbujas (círculos) en la zona OMR",
             "codigo": codigo,
@@ -689,17 +1857,17 @@ def procesar_omr(binario):
             "id_alumno": id_alumno,
             "fecha": fecha,
             "num_preguntas": num_preguntas,
-            "pagina": pagina,
-            "debug_qr": debug_qr,
-            "debug_image": b64jpg(debug_a4, 85) if debug_a4 is not None else None
-        }
+            "pagina": pagina
+        }, debug, zona_qr, debug_a4)
 
-    # 6) dict global (1..60)
+    # 8) dict global (1..60)
     respuestas = {}
-    for i, r in enumerate(respuestas_lista, start=1):
+    confianza = {}
+    for i, (r, p) in enumerate(zip(respuestas_lista, puntuaciones), start=1):
         respuestas[str(offset + i)] = r
+        confianza[str(offset + i)] = round(margen_respuesta(p), 3)
 
-    return {
+    return _con_debug({
         "ok": True,
         "codigo": codigo,
         "id_examen": id_examen,
@@ -708,29 +1876,733 @@ def procesar_omr(binario):
         "num_preguntas": num_preguntas,
         "pagina": pagina,
         "respuestas": respuestas,
-        "debug_qr": debug_qr,
-        "debug_image": b64jpg(debug_a4, 85) if debug_a4 is not None else None
+        "margenes": confianza
+    }, debug, zona_qr, debug_a4)
+
+
+def _zona_omr(foto, img, marcas, rot, escala=1.0, y0=None, y1=None):
+    """
+    Zona OMR enderezada en gris (ContextoHoja en coords A4). Con y0/y1 sólo esa
+    banda de filas; `escala` < 1 para el pase rápido.
+    Se endereza el bloque de teselas CLAHE de la hoja entera que alcanza a la
+    zona (con su MARGEN_TINTA), así la tinta sale igual que con warp_a4; sólo
+    se binariza la zona.
+    """
+    r = OMR_REGION
+    y0 = r["y0"] if y0 is None else y0
+    y1 = r["y1"] if y1 is None else y1
+    ancho, alto = int(round(A4_W * escala)), int(round(A4_H * escala))
+    tw, th = tesela_clahe_a4(escala)
+    # zona + margen en px de la hoja a esta escala
+    u0 = max(0, int(round(r["x0"] * escala)) - MARGEN_TINTA)
+    v0 = max(0, int(round(y0 * escala)) - MARGEN_TINTA)
+    u1 = min(ancho, int(round(r["x1"] * escala)) + MARGEN_TINTA)
+    v1 = min(alto, int(round(y1 * escala)) + MARGEN_TINTA)
+    # teselas cuya LUT interviene (CLAHE interpola entre los centros vecinos)
+    i0, j0 = max(0, int(np.floor(u0 / tw - 0.5))), max(0, int(np.floor(v0 / th - 0.5)))
+    i1, j1 = min(7, int(np.floor((u1 - 1) / tw - 0.5)) + 1), min(7, int(np.floor((v1 - 1) / th - 0.5)) + 1)
+    U0, V0 = i0 * tw, j0 * th
+    U1, V1 = min(ancho, (i1 + 1) * tw), min(alto, (j1 + 1) * th)
+    return ContextoHoja(
+        warp_zona_a4(foto.gris, marcas, rot, U0 / escala, V0 / escala, U1 / escala, V1 / escala, escala),
+        origen=(U0 / escala, V0 / escala),
+        pagina=lambda: warp_a4(img, marcas, rot),
+        escala=escala,
+        teselas=(i1 - i0 + 1, j1 - j0 + 1),
+        util=(u0 - U0, v0 - V0, u1 - U0, v1 - V0)
+    )
+
+
+def _leer_respuestas(hoja, filas, clave, debug, detector):
+    """
+    Binariza la zona y lee las filas: rejilla cacheada del examen si encaja;
+    si no, detección REAL de círculos (y se cachea su rejilla si es fiable y
+    viene de resolución completa: la del pase rápido es más gruesa).
+    Devuelve (respuestas, debug_a4, rejilla usada, puntuaciones por fila).
+    """
+    with etapa("binarizar"):
+        th = binarizar_tinta_pro(hoja)
+
+    respuestas, debug_a4, usada, puntuaciones = None, None, None, None
+    rejilla = obtener_rejilla(clave)
+    anotar("rejilla", "detectada" if rejilla is None else "cache")
+    if rejilla is not None:
+        respuestas, debug_a4, usada, puntuaciones = detectar_respuestas_por_rejilla(hoja, th, rejilla,
+                                                                                    debug=bool(debug))
+        if respuestas is None:
+            anotar("rejilla", "descartada")
+            if hoja.escala == 1.0:  # en el pase rápido no se vuelve a guardar: no tirarla por un fallo reducido
+                olvidar_rejilla(clave)
+
+    if respuestas is None:
+        respuestas, debug_a4, usada, puntuaciones = detectar_respuestas_por_circulos(hoja, th, filas, bool(debug),
+                                                                                     detector)
+        if respuestas and hoja.escala == 1.0 and rejilla_confiable(usada, filas):
+            guardar_rejilla(clave, usada)
+    return respuestas, debug_a4, usada, puntuaciones
+
+
+# ============================================================
+# DEBUG BAJO DEMANDA (almacén LRU + descarga por id)
+# ============================================================
+MODOS_DEBUG = ("id", "inline")
+
+
+def opciones_debug(modo, escala=None, calidad=None):
+    """
+    Traduce los parámetros del request a opciones de debug (o None = sin debug).
+      modo: "0"/"" => nada, "1"/"id" => guardar y devolver URL, "inline" => base64
+    Lanza ValueError si algún valor no es válido.
+    """
+    modo = (modo or "").strip().lower()
+    if modo in ("", "0", "false", "no"):
+        return None
+    if modo in ("1", "true", "si", "sí"):
+        modo = "id"
+    if modo not in MODOS_DEBUG:
+        raise ValueError(f"debug desconocido: {modo} (usa 0, 1, id o inline)")
+
+    escala = DEBUG_ESCALA if escala in (None, "") else float(escala)
+    calidad = DEBUG_CALIDAD if calidad in (None, "") else int(calidad)
+    if not 0.05 <= escala <= 1.0:
+        raise ValueError("debug_escala debe estar entre 0.05 y 1.0")
+    if not 10 <= calidad <= 95:
+        raise ValueError("debug_calidad debe estar entre 10 y 95")
+    return {"modo": modo, "escala": escala, "calidad": calidad}
+
+
+class AlmacenDebug:
+    """
+    Guarda los JPEG de debug de los últimos N resultados (LRU).
+    Con `directorio` los escribe a disco y en memoria sólo queda el índice.
+    """
+
+    def __init__(self, max_resultados=DEBUG_MAX_RESULTADOS, directorio=DEBUG_DIR):
+        self.max_resultados = max_resultados
+        self.directorio = directorio
+        self._items = OrderedDict()  # id -> {tipo: bytes | ruta}
+        self._lock = threading.Lock()
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+
+    def guardar(self, jpgs):
+        id_resultado = uuid.uuid4().hex
+        if self.directorio:
+            rutas = {}
+            for tipo, jpg in jpgs.items():
+                rutas[tipo] = os.path.join(self.directorio, f"{id_resultado}_{tipo}.jpg")
+                with open(rutas[tipo], "wb") as f:
+                    f.write(jpg)
+            jpgs = rutas
+
+        with self._lock:
+            self._items[id_resultado] = jpgs
+            fuera = []
+            while len(self._items) > self.max_resultados:
+                fuera.append(self._items.popitem(last=False)[1])
+
+        for item in fuera:
+            self._borrar(item)
+        return id_resultado
+
+    def obtener(self, id_resultado, tipo):
+        with self._lock:
+            item = self._items.get(id_resultado)
+            if item is not None:
+                self._items.move_to_end(id_resultado)
+            valor = item.get(tipo) if item is not None else None
+
+        if not self.directorio:
+            return valor
+        if valor is None:
+            # puede venir de otro worker que comparte el directorio
+            if not re.fullmatch(r"[0-9a-f]{32}", id_resultado) or not re.fullmatch(r"\w+", tipo):
+                return None
+            valor = os.path.join(self.directorio, f"{id_resultado}_{tipo}.jpg")
+        try:
+            with open(valor, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _borrar(self, item):
+        if not self.directorio:
+            return
+        for ruta in item.values():
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+almacen_debug = AlmacenDebug()
+
+
+def publicar_debug(res, debug, prefijo_url="/debug"):
+    """
+    Saca los JPEG de res["_debug"] y los deja como el cliente los pidió:
+    inline => debug_qr / debug_image en base64; id => id_resultado + URLs.
+    """
+    jpgs = res.pop("_debug", None)
+    if not debug or not jpgs:
+        return res
+
+    if debug["modo"] == "inline":
+        nombres = {"qr": "debug_qr", "hoja": "debug_image"}
+        for tipo, jpg in jpgs.items():
+            res[nombres[tipo]] = base64.b64encode(jpg).decode("utf-8")
+        return res
+
+    id_resultado = almacen_debug.guardar(jpgs)
+    res["id_resultado"] = id_resultado
+    res["debug_urls"] = {tipo: f"{prefijo_url}/{id_resultado}/{tipo}" for tipo in jpgs}
+    return res
+
+
+def publicar_metricas(res, timings=False):
+    """
+    Saca res["_metricas"] y lo suma a /metrics (en el proceso que sirve HTTP).
+    Con `timings` deja además los ms por etapa en res["timings"].
+    """
+    medidas = res.pop("_metricas", None)
+    metricas.registrar_hoja(res.get("ok"), medidas)
+    if timings and medidas:
+        res["timings"] = {k: round(v * 1000.0, 1) for k, v in medidas["tiempos"].items()}
+    return res
+
+
+def pedir_timings(valor):
+    return (valor or "").strip().lower() in ("1", "true", "si", "sí")
+
+
+# ============================================================
+# LOTE (una clase entera en un solo upload)
+# ============================================================
+# procesos del pool de lote de ESTE proceso (servir.py lo reparte entre los workers)
+LOTE_WORKERS = int(os.environ.get("OMR_LOTE_WORKERS", "0")) or nucleos()
+LOTE_MAX_IMAGENES = int(os.environ.get("OMR_LOTE_MAX_IMAGENES", "200"))
+LOTE_EN_VUELO = int(os.environ.get("OMR_LOTE_EN_VUELO", "0")) or 2 * LOTE_WORKERS  # imágenes a la vez en el pool
+ZIP_MAX_BYTES = int(float(os.environ.get("OMR_ZIP_MAX_MB", "1024")) * 1024 * 1024)  # descomprimido, por petición
+EXTENSIONES_IMAGEN = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+_pool_lote = None
+_pool_lote_lock = threading.Lock()
+_pool_compartido = None
+
+
+def _get_pool_lote():
+    global _pool_lote
+    if _pool_compartido is not None:
+        return _pool_compartido.executor
+    with _pool_lote_lock:
+        if _pool_lote is None:
+            _pool_lote = ProcessPoolExecutor(max_workers=LOTE_WORKERS, mp_context=contexto_procesos(),
+                                             initializer=iniciar_proceso_pool,
+                                             initargs=(hilos_cv_pool(LOTE_WORKERS),))
+        return _pool_lote
+
+
+def _reiniciar_pool_lote(roto):
+    # un worker muerto (OOM...) deja el executor roto para siempre: se crea otro
+    global _pool_lote
+    if _pool_compartido is not None:
+        _pool_compartido.reiniciar(roto)
+        return
+    with _pool_lote_lock:
+        if _pool_lote is roto:
+            _pool_lote = None
+    roto.shutdown(wait=False, cancel_futures=True)
+
+
+def _enviar_al_pool(fn, *args):
+    """
+    pool.submit en el pool de lote. Si está roto (murió un worker en una
+    petición anterior) se recrea y se reintenta una vez. Con el PoolOMR
+    compartido cuenta en su admisión y espera si está lleno (pool.enviar).
+    """
+    if _pool_compartido is not None:
+        return _pool_compartido.enviar(fn, *args)
+    pool = _get_pool_lote()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _reiniciar_pool_lote(pool)
+        return _get_pool_lote().submit(fn, *args)
+
+
+def _en_pool(fn, tareas, en_vuelo_max):
+    """
+    Generador: fn(*args) de cada (etiqueta, args) en el pool de lote, como mucho
+    en_vuelo_max a la vez (no se llena el pool con una sola petición).
+    Devuelve (etiqueta, futuro) según van acabando; al cerrarlo cancela el resto.
+    """
+    tareas = iter(tareas)
+    en_vuelo = {}
+    try:
+        while True:
+            for etiqueta, args in tareas:
+                en_vuelo[_enviar_al_pool(fn, *args)] = etiqueta
+                if len(en_vuelo) >= en_vuelo_max:
+                    break
+            if not en_vuelo:
+                return
+            listos, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for fut in listos:
+                yield en_vuelo.pop(fut), fut
+    finally:
+        for fut in en_vuelo:
+            fut.cancel()
+
+
+def usar_pool_lote(pool):
+    """
+    Lote, documentos y trabajos usan los procesos de `pool` (el PoolOMR en
+    FastAPI: pool.enviar, que cuenta en pool.pendientes) en vez de crear su
+    propio pool: un solo presupuesto de procesos y una sola admisión.
+    """
+    global _pool_compartido
+    _pool_compartido = pool
+
+
+def expandir_archivos(archivos, max_imagenes=None):
+    """
+    archivos: lista de (nombre, bytes). Los ZIP se expanden en sus imágenes
+    (en el orden del ZIP). Devuelve lista de (nombre, bytes).
+    ValueError si un ZIP no se puede leer o se pasa de max_imagenes
+    (LOTE_MAX_IMAGENES) / ZIP_MAX_BYTES: los límites se miran con lo que
+    declara el ZIP ANTES de descomprimir nada (bombas ZIP).
+    """
+    max_imagenes = LOTE_MAX_IMAGENES if max_imagenes is None else max_imagenes
+    out, descomprimido = [], 0
+    for nombre, binario in archivos:
+        if binario[:4] != b"PK\x03\x04":
+            out.append((nombre, binario))
+            continue
+        try:
+            with zipfile.ZipFile(io.BytesIO(binario)) as zf:
+                infos = [info for info in zf.infolist()
+                         if not info.is_dir() and info.filename.lower().endswith(EXTENSIONES_IMAGEN)]
+                if len(out) + len(infos) > max_imagenes:
+                    raise ValueError(f"Demasiadas imágenes (máx {max_imagenes})")
+                for info in infos:
+                    if info.file_size > SUBIDA_MAX_BYTES:
+                        raise ValueError(f"{info.filename}: imagen demasiado grande "
+                                         f"(máx {SUBIDA_MAX_BYTES // (1024 * 1024)} MB)")
+                    descomprimido += info.file_size
+                if descomprimido > ZIP_MAX_BYTES:
+                    raise ValueError(f"ZIP demasiado grande descomprimido (máx {ZIP_MAX_BYTES // (1024 * 1024)} MB)")
+                # zipfile no devuelve más de file_size bytes por entrada
+                out.extend((info.filename, zf.read(info)) for info in infos)
+        except ValueError:
+            raise
+        except Exception as e:  # BadZipFile, CRC, compresión no soportada, cifrado...
+            raise ValueError(f"ZIP ilegible ({nombre}): {e}")
+    if len(out) > max_imagenes:
+        raise ValueError(f"Demasiadas imágenes (máx {max_imagenes})")
+    return out
+
+
+def _procesar_item(binario, debug=None, detector=None):
+    # un error en una foto NO debe tumbar el lote
+    if not binario:
+        return {"ok": False, "error": "Imagen vacía"}
+    try:
+        return procesar_omr(binario, debug, detector)
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+
+def procesar_lote(archivos, debug=None, timings=False, detector=None):
+    """
+    Procesa (nombre, bytes) en paralelo (pool de procesos = núcleos; como
+    mucho LOTE_EN_VUELO a la vez). Devuelve el JSON del lote con un resultado por imagen EN ORDEN de entrada.
+    """
+    try:
+        archivos = expandir_archivos(archivos)
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}
+    if not archivos:
+        return {"ok": False, "error": "No hay imágenes en el lote"}
+
+    usar_cache = cache_resultados.activa and not debug and not detector
+
+    # la misma foto dos veces (o ya corregida antes) sólo se calcula una vez
+    listos, iguales, por_hash, claves, calcular = {}, {}, {}, [], []
+    for i, (_, binario) in enumerate(archivos):
+        clave = hash_binario(binario) if usar_cache and binario else None
+        claves.append(clave)
+        previo = cache_resultados.obtener(clave) if clave else None
+        if previo is not None:
+            metricas.CACHE.incrementar("hit")
+            listos[i] = {**previo, "cache": True}
+        elif clave in por_hash:
+            metricas.CACHE.incrementar("agrupada")
+            iguales[i] = por_hash[clave]
+        else:
+            if clave:
+                metricas.CACHE.incrementar("miss")
+                por_hash[clave] = i
+            calcular.append((i, (binario, debug, detector)))
+
+    fallidos = set()
+    for i, fut in _en_pool(_procesar_item, calcular, LOTE_EN_VUELO):
+        try:
+            listos[i] = fut.result()
+        except Exception as e:  # p.ej. el worker murió (el siguiente envío recrea el pool)
+            listos[i] = {"ok": False, "error": str(e)}
+            fallidos.add(i)
+            continue
+        if claves[i]:
+            cache_resultados.guardar(claves[i], listos[i])
+
+    resultados = []
+    for i, (nombre, _) in enumerate(archivos):
+        if i in iguales:
+            j = iguales[i]
+            res = dict(listos[j])
+            if j not in fallidos:
+                res = {k: v for k, v in res.items() if k not in ("_debug", "_metricas")}
+                res["cache"] = True
+        else:
+            res = dict(listos[i])
+        res = publicar_metricas(publicar_debug(res, debug), timings)
+        resultados.append({"indice": i, "nombre": nombre, **res})
+
+    return {
+        "ok": True,
+        "total": len(resultados),
+        "correctas": sum(1 for r in resultados if r.get("ok")),
+        "resultados": resultados,
     }
 
 
+# ============================================================
+# DOCUMENTOS MULTIPÁGINA (PDF / TIFF del escáner) -> NDJSON
+# ============================================================
+DOC_MAX_PAGINAS = int(os.environ.get("OMR_DOC_MAX_PAGINAS", "500"))
+DOC_EN_VUELO = int(os.environ.get("OMR_DOC_EN_VUELO", "0")) or 2 * LOTE_WORKERS  # páginas a la vez en el pool
+
+
+def abrir_documento(ruta):
+    """
+    (tipo, paginas) del documento en `ruta`. ValueError si no se puede corregir.
+    """
+    with open(ruta, "rb") as f:
+        tipo = documento_omr.tipo_documento(f.read(8))
+    if tipo is None:
+        raise ValueError("Documento no soportado (PDF o TIFF)")
+    try:
+        paginas = documento_omr.contar_paginas(ruta, tipo)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Documento ilegible: {e}")
+    if paginas <= 0:
+        raise ValueError("Documento sin páginas")
+    if paginas > DOC_MAX_PAGINAS:
+        raise ValueError(f"Demasiadas páginas (máx {DOC_MAX_PAGINAS})")
+    return tipo, paginas
+
+
+def _procesar_pagina(ruta, tipo, i, debug=None, detector=None):
+    # se ejecuta en el worker: la página se lee aquí, no viaja por pickle
+    try:
+        with cronometrar() as medidas:
+            with etapa("decodificar"):
+                img = documento_omr.leer_pagina(ruta, tipo, i)
+            if img is None:
+                res = {"ok": False, "error": "Página ilegible"}
+            else:
+                res = procesar_omr_img(img, debug, detector)
+        res["_metricas"] = medidas
+        return res
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+
+def procesar_documento(ruta, tipo, paginas, debug=None, timings=False, detector=None):
+    """
+    Generador: corrige las páginas en el pool de procesos (como mucho DOC_EN_VUELO
+    a la vez) y devuelve cada resultado EN CUANTO ESTÁ LISTO (orden de llegada;
+    "indice" = página del documento desde 0). Acaba con una línea {"fin": true, ...}.
+    Borra `ruta` al terminar (o si el cliente corta la conexión). Si la iteración
+    ni siquiera empieza, esto no se ejecuta: el endpoint registra también
+    borrar_documento(ruta) al cerrar la respuesta.
+    """
+    correctas = 0
+    hechas = _en_pool(_procesar_pagina, ((i, (ruta, tipo, i, debug, detector)) for i in range(paginas)),
+                      DOC_EN_VUELO)
+    try:
+        for i, fut in hechas:
+            try:
+                res = fut.result()
+            except Exception as e:  # p.ej. el worker murió
+                res = {"ok": False, "error": str(e)}
+            res = publicar_metricas(publicar_debug(res, debug), timings)
+            correctas += 1 if res.get("ok") else 0
+            yield {"indice": i, **res}
+
+        yield {"fin": True, "ok": True, "total": paginas, "correctas": correctas}
+    finally:
+        hechas.close()  # cancela las páginas que no han empezado antes de borrar el fichero
+        borrar_documento(ruta)
+
+
+def borrar_documento(ruta):
+    # idempotente: lo llaman el generador y el cierre de la respuesta
+    try:
+        os.remove(ruta)
+    except OSError:
+        pass
+
+
+def ndjson(resultados):
+    for res in resultados:
+        yield json.dumps(res, ensure_ascii=False) + "\n"
+
+
+# ============================================================
+# TRABAJOS ASÍNCRONOS (enviar y consultar después)
+# ============================================================
+TRABAJOS_MAX_IMAGENES = int(os.environ.get("OMR_TRABAJOS_MAX_IMAGENES", "2000"))
+
+
+def _procesar_en_cola(binario, opciones):
+    # hilo de la cola: la hoja se corrige en el pool de procesos del lote
+    debug, detector = opciones.get("debug"), opciones.get("detector")
+    if debug or detector or not cache_resultados.activa or not binario:
+        res = _enviar_al_pool(_procesar_item, binario, debug, detector).result()
+    else:
+        res = cache_resultados.calcular(hash_binario(binario),
+                                        lambda: _enviar_al_pool(_procesar_item, binario).result())
+    return publicar_metricas(publicar_debug(res, debug), opciones.get("timings"))
+
+
+cola_trabajos = ColaTrabajos(_procesar_en_cola, workers=TRABAJOS_WORKERS or nucleos())
+
+
+def enviar_trabajo(archivos, prioridad=None, callback=None, debug=None, timings=False, detector=None):
+    """
+    Encola (nombre, bytes) (ZIP incluidos). Devuelve el JSON de respuesta; ValueError si no vale.
+    """
+    try:
+        prioridad = int(prioridad or 0)
+    except ValueError:
+        raise ValueError("prioridad debe ser un entero")
+    if callback:
+        validar_callback(callback)  # aquí ya da 400; al avisar se vuelve a comprobar
+
+    archivos = expandir_archivos(archivos, TRABAJOS_MAX_IMAGENES)
+    if not archivos:
+        raise ValueError("No hay imágenes en el trabajo")
+
+    id_trabajo = cola_trabajos.enviar(archivos, prioridad, callback or None,
+                                      {"debug": debug, "timings": timings, "detector": detector})
+    return {"ok": True, "id_trabajo": id_trabajo, "total": len(archivos), "url": f"/trabajos/{id_trabajo}"}
+
+
+def _sin_resultados(valor):
+    return (valor or "").strip().lower() in ("0", "false", "no")
+
+
+# ============================================================
+# ARRANQUE (escala a cero: la primera petición no paga la inicialización)
+# ============================================================
+CALENTAR = os.environ.get("OMR_CALENTAR", "1") != "0"
+ARRANQUE = float(os.environ.get("OMR_ARRANQUE", "0")) or time.time()  # servir.py lo fija al empezar
+ID_CALENTAMIENTO = 0  # id_examen reservado para la hoja sintética (no lo deja en la caché de rejillas)
+
+_arranque = {"listo": False, "calentamiento_ok": None, "calentamiento_ms": None, "segundos_hasta_listo": None}
+_arranque_lock = threading.Lock()
+_hilo_calentamiento = None
+_hilo_calentamiento_lock = threading.Lock()
+
+
+def _hoja_calentamiento():
+    import sintetico  # importa omr: aquí y no arriba
+
+    # foto "fácil" (sin ruido ni luz irregular, que tardan más en generarse que en corregirse)
+    binario, _ = sintetico.hoja_aleatoria(np.random.default_rng(0), num_preguntas=MAX_FILAS_POR_HOJA, pagina=1,
+                                          id_examen=ID_CALENTAMIENTO, perspectiva=0.01, angulo=1.0,
+                                          ruido=0, luz=0)
+    try:
+        return bool(procesar_omr(binario).get("ok"))  # sin caché ni métricas: no cuenta como hoja
+    finally:
+        with _LAYOUTS_LOCK:
+            for clave in [c for c in _LAYOUTS if c[0] == ID_CALENTAMIENTO]:
+                del _LAYOUTS[clave]
+
+
+def marcar_listo(segundos, ok):
+    """
+    Fija el estado de /listo (una vez por proceso) y deja en el log el tiempo hasta listo.
+    """
+    if _arranque["listo"]:
+        return
+    _arranque.update(listo=True, calentamiento_ok=ok, calentamiento_ms=round(segundos * 1000.0, 1),
+                     segundos_hasta_listo=round(time.time() - ARRANQUE, 3))
+    log.info("OMR listo en %.2f s desde el arranque (calentamiento %.0f ms, ok=%s)",
+             _arranque["segundos_hasta_listo"], _arranque["calentamiento_ms"], ok)
+
+
+def calentar():
+    """
+    Corrige una hoja sintética (sintetico.py) en ESTE proceso: inicialización de
+    OpenCV, detectores QR y primeras reservas de Hough/k-means antes de la primera
+    petición real. Idempotente; con OMR_CALENTAR=0 sólo marca listo. Devuelve estado_arranque().
+    """
+    with _arranque_lock:
+        if not _arranque["listo"]:
+            t0 = time.perf_counter()
+            try:
+                ok = _hoja_calentamiento() if CALENTAR else None
+            except Exception as e:  # se sirve igual, sólo que la primera hoja paga el arranque
+                log.warning("OMR: calentamiento fallido: %s", e)
+                ok = False
+            marcar_listo(time.perf_counter() - t0, ok)
+    return estado_arranque()
+
+
+def arrancar_calentamiento():
+    """
+    calentar() en un hilo: el servidor ya acepta conexiones y /listo da 503 hasta que acabe.
+    """
+    global _hilo_calentamiento
+    with _hilo_calentamiento_lock:
+        if _hilo_calentamiento is None:
+            _hilo_calentamiento = threading.Thread(target=calentar, name="omr-calentamiento", daemon=True)
+            _hilo_calentamiento.start()
+
+
+def estado_arranque():
+    return dict(_arranque)
+
+
 # ============================================================
 # ENDPOINTS
 # ============================================================
+def _debug_request():
+    v = request.values
+    return opciones_debug(v.get("debug"), v.get("debug_escala"), v.get("debug_calidad"))
+
+
+def _detector_request():
+    return elegir_detector(request.values.get("detector"))
+
+
 @app.route("/corregir_omr", methods=["POST"])
 def corregir_omr():
     if "imagen" not in request.files:
         return jsonify({"ok": False, "error": "Falta imagen"}), 400
+    try:
+        debug = _debug_request()
+        detector = _detector_request()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
     binario = request.files["imagen"].read()
-    res = procesar_omr(binario)
+    if not binario:
+        return jsonify({"ok": False, "error": "Imagen vacía"}), 400  # como main.py
+    res = publicar_debug(procesar_omr_cacheado(binario, debug, detector), debug)
+    res = publicar_metricas(res, pedir_timings(request.values.get("timings")))
+    return jsonify(res)
+
+
+@app.route("/corregir_omr_lote", methods=["POST"])
+def corregir_omr_lote():
+    files = request.files.getlist("imagenes")
+    if not files:
+        return jsonify({"ok": False, "error": "Faltan imagenes"}), 400
+    try:
+        debug = _debug_request()
+        detector = _detector_request()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    res = procesar_lote([(f.filename, f.read()) for f in files], debug,
+                        pedir_timings(request.values.get("timings")), detector)
+    return jsonify(res), (200 if res["ok"] else 400)
+
+
+@app.route("/corregir_omr_documento", methods=["POST"])
+def corregir_omr_documento():
+    if "documento" not in request.files:
+        return jsonify({"ok": False, "error": "Falta documento"}), 400
+    try:
+        debug = _debug_request()
+        detector = _detector_request()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    # a disco: los workers leen cada página del fichero
+    fd, ruta = tempfile.mkstemp(prefix="omr_doc_")
+    os.close(fd)
+    try:
+        request.files["documento"].save(ruta)
+        tipo, paginas = abrir_documento(ruta)
+    except ValueError as e:
+        os.remove(ruta)
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    resultados = procesar_documento(ruta, tipo, paginas, debug, pedir_timings(request.values.get("timings")),
+                                    detector)
+    respuesta = Response(ndjson(resultados), mimetype="application/x-ndjson")
+    respuesta.call_on_close(lambda: borrar_documento(ruta))  # aunque el stream no llegue a empezar
+    return respuesta
+
+
+@app.route("/trabajos", methods=["POST"])
+def crear_trabajo():
+    files = request.files.getlist("imagenes")
+    if not files:
+        return jsonify({"ok": False, "error": "Faltan imagenes"}), 400
+    v = request.values
+    try:
+        res = enviar_trabajo([(f.filename, f.read()) for f in files], v.get("prioridad"), v.get("callback"),
+                             _debug_request(), pedir_timings(v.get("timings")), _detector_request())
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify(res), 202
+
+
+@app.route("/trabajos/<id_trabajo>")
+def ver_trabajo(id_trabajo):
+    res = cola_trabajos.consultar(id_trabajo, not _sin_resultados(request.values.get("resultados")))
+    if res is None:
+        return jsonify({"ok": False, "error": "Trabajo no encontrado"}), 404
     return jsonify(res)
 
 
+@app.route("/debug/<id_resultado>/<tipo>")
+def ver_debug(id_resultado, tipo):
+    jpg = almacen_debug.obtener(id_resultado, tipo)
+    if jpg is None:
+        return jsonify({"ok": False, "error": "Debug no encontrado (caducado o id incorrecto)"}), 404
+    return Response(jpg, mimetype="image/jpeg")
+
+
+@app.route("/metrics")
+def ver_metricas():
+    return Response(metricas.exponer(), content_type=metricas.CONTENT_TYPE)
+
+
+@app.route("/listo")
+def ver_listo():
+    estado = estado_arranque()
+    if not estado["listo"]:
+        arrancar_calentamiento()  # p. ej. `gunicorn omr:app` sin servir.py: lo arranca la sonda
+    return jsonify(estado), (200 if estado["listo"] else 503)
+
+
 @app.route("/")
 def home():
-    return "Servidor OMR ✅ (/corregir_omr)"
+    return ("Servidor OMR ✅ (/corregir_omr, /corregir_omr_lote, /corregir_omr_documento, /trabajos, "
+            "/debug/<id>/<tipo>, /metrics, /listo)")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cola_trabajos.arrancar()  # retoma los trabajos que quedaron a medias
+    arrancar_calentamiento()
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,197 @@
+"""
+Pool de procesos para el servidor FastAPI.
+
+- El trabajo OMR (CPU) sale del event loop => el resto de conexiones siguen vivas.
+- La imagen decodificada viaja al worker por memoria compartida (sin pickle).
+- Cola acotada: si está llena se rechaza al momento (503 + Retry-After).
+"""
+import asyncio
+import math
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from omr import (ImagenRechazada, contexto_procesos, decodificar_imagen, estado_arranque, hilos_cv_pool,
+                 ingesta_en_gris, iniciar_proceso_pool, nucleos, procesar_omr_img)
+
+OMR_WORKERS = int(os.environ.get("OMR_WORKERS", "0")) or nucleos()
+# imágenes admitidas a la vez (en proceso + esperando worker), también las de lote / documento / trabajos
+OMR_MAX_PENDIENTES = int(os.environ.get("OMR_MAX_PENDIENTES", "0")) or OMR_WORKERS * 4
+CALENTAR_ESPERA_S = 300  # máx. esperando a que todos los workers hayan calentado
+
+_barrera = None  # en cada worker: la de su PoolOMR (ver calentar)
+
+
+class PoolSaturado(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Servidor saturado, reintenta más tarde")
+        self.retry_after = retry_after
+
+
+def _enganchar_shm(nombre):
+    """
+    Engancha un segmento creado por el padre sin que el worker pase a ser su dueño.
+    Antes de 3.13 enganchar lo registra en el resource_tracker: si el worker tiene
+    tracker propio (fork sin tracker en el padre) lo borraría al morir el worker;
+    con el tracker heredado del padre el registro es el mismo y no se toca.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=nombre, track=False)
+    propio = resource_tracker._resource_tracker._fd is None
+    shm = shared_memory.SharedMemory(name=nombre)
+    if propio:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _procesar_shm(nombre, shape, dtype, debug=None, detector=None):
+    """
+    Se ejecuta en el worker: engancha la memoria compartida y procesa.
+    """
+    shm = _enganchar_shm(nombre)
+    try:
+        img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        res = procesar_omr_img(img, debug, detector)
+        del img  # no dejar vistas vivas sobre el buffer antes de cerrar
+        return res
+    finally:
+        shm.close()
+
+
+def _iniciar_worker(hilos_cv, barrera):
+    # initializer: cada proceso calienta (omr.calentar) antes de su primera tarea
+    global _barrera
+    _barrera = barrera
+    iniciar_proceso_pool(hilos_cv, calentar_al_iniciar=True)
+
+
+def _worker_caliente():
+    # cada tarea retiene su proceso hasta que todos tienen una: una por worker
+    _barrera.wait(CALENTAR_ESPERA_S)
+    return estado_arranque()
+
+
+class PoolOMR:
+    def __init__(self, workers=OMR_WORKERS, max_pendientes=OMR_MAX_PENDIENTES):
+        self.workers = workers
+        self.max_pendientes = max_pendientes
+        self.pendientes = 0
+        self.seg_por_hoja = 1.0  # media móvil, para estimar Retry-After
+        self._lock = threading.Lock()
+        self._hueco = threading.Condition()  # protege `pendientes`; avisa al liberar
+        self._ctx = contexto_procesos()
+        self._barrera = self._ctx.Barrier(workers)
+        self.executor = self._crear()
+
+    def _crear(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._ctx, initializer=_iniciar_worker,
+                                   initargs=(hilos_cv_pool(self.workers), self._barrera))
+
+    def reiniciar(self, roto):
+        """
+        Un worker murió (OOM...) y `roto` ya no acepta trabajo: se crea otro
+        executor (una sola vez aunque lo pidan varias peticiones a la vez).
+        """
+        with self._lock:
+            if self.executor is roto:
+                self.executor = self._crear()
+        roto.shutdown(wait=False, cancel_futures=True)
+
+    def _reservar(self, esperar=False):
+        with self._hueco:
+            while self.pendientes >= self.max_pendientes:
+                if not esperar:
+                    return False
+                self._hueco.wait()
+            self.pendientes += 1
+            return True
+
+    def _liberar(self):
+        with self._hueco:
+            self.pendientes -= 1
+            self._hueco.notify()
+
+    def saturado(self):
+        return self.pendientes >= self.max_pendientes
+
+    def enviar(self, fn, *args):
+        """
+        Lote, documentos y trabajos (omr.usar_pool_lote): fn(*args) en el pool
+        contando en `pendientes`. Lleno: ESPERA a que haya hueco (la petición
+        ya pasó la admisión del endpoint, que da 503 si está saturado).
+        """
+        self._reservar(esperar=True)
+        executor = self.executor
+        try:
+            try:
+                fut = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self.reiniciar(executor)
+                fut = self.executor.submit(fn, *args)
+        except BaseException:
+            self._liberar()
+            raise
+        fut.add_done_callback(lambda _: self._liberar())
+        return fut
+
+    def retry_after(self):
+        espera = self.seg_por_hoja * self.pendientes / float(self.workers)
+        return max(1, int(math.ceil(espera)))
+
+    async def procesar(self, binario, debug=None, detector=None):
+        if not self._reservar():
+            raise PoolSaturado(self.retry_after())
+
+        loop = asyncio.get_running_loop()
+        shm = None
+        try:
+            # imdecode suelta el GIL: hilo, no proceso
+            t_dec = loop.time()
+            try:
+                img = await loop.run_in_executor(None, decodificar_imagen, binario, ingesta_en_gris(debug))
+            except ImagenRechazada as e:
+                return {"ok": False, "error": str(e)}
+            t_dec = loop.time() - t_dec
+            if img is None:
+                return {"ok": False, "error": "Imagen inválida"}
+
+            shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+            np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+            shape, dtype = img.shape, img.dtype.str
+            del img
+
+            t0 = loop.time()
+            executor = self.executor
+            try:
+                res = await loop.run_in_executor(executor, _procesar_shm, shm.name, shape, dtype, debug, detector)
+            except BrokenProcessPool as e:
+                self.reiniciar(executor)
+                return {"ok": False, "error": str(e)}
+            self.seg_por_hoja = 0.8 * self.seg_por_hoja + 0.2 * (loop.time() - t0)
+            if "_metricas" in res:
+                # la decodificación se hizo aquí, fuera del worker
+                res["_metricas"]["tiempos"]["decodificar"] = t_dec
+                res["_metricas"]["tiempos"]["total"] += t_dec
+            return res
+        finally:
+            self._liberar()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    async def calentar(self):
+        """
+        Espera a que TODOS los procesos hayan calentado (cada uno en su
+        initializer). Devuelve el estado_arranque() de cada worker.
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(self.executor, _worker_caliente)
+                                      for _ in range(self.workers)])
+
+    def cerrar(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,115 @@
+"""
+Decodificadores QR intercambiables (registro por nombre).
+
+- clasico: cv2.QRCodeDetector.
+- aruco:   cv2.QRCodeDetectorAruco (OpenCV >= 4.8), suele ir mejor con fotos de móvil.
+- zbar:    pyzbar (opcional, necesita libzbar).
+- zxing:   zxing-cpp (opcional).
+
+Cada intento de la cascada prueba el principal y, si no lee nada, el de respaldo
+sobre la misma imagen: OMR_QR_DECODIFICADOR / OMR_QR_RESPALDO ("" = sin respaldo).
+"""
+import os
+
+import cv2
+
+try:
+    from pyzbar import pyzbar
+except ImportError:  # sin pyzbar no hay backend zbar
+    pyzbar = None
+
+try:
+    import zxingcpp
+except ImportError:  # sin zxing-cpp no hay backend zxing
+    zxingcpp = None
+
+
+def _clasico():
+    det = cv2.QRCodeDetector()
+
+    def decodificar(img):
+        s, _, _ = det.detectAndDecode(img)
+        return s
+
+    return decodificar
+
+
+def _aruco():
+    det = cv2.QRCodeDetectorAruco()
+
+    def decodificar(img):
+        s, _, _ = det.detectAndDecode(img)
+        return s
+
+    return decodificar
+
+
+def _zbar():
+    def decodificar(img):
+        for r in pyzbar.decode(img, symbols=[pyzbar.ZBarSymbol.QRCODE]):
+            return r.data.decode("utf-8", "replace")
+        return None
+
+    return decodificar
+
+
+def _zxing():
+    def decodificar(img):
+        for r in zxingcpp.read_barcodes(img, formats=zxingcpp.BarcodeFormat.QRCode):
+            return r.text
+        return None
+
+    return decodificar
+
+
+# nombre -> fábrica de decodificar(img_gris_o_bgr) -> texto o None.
+# Una fábrica por hilo/cascada: los detectores de OpenCV no son thread-safe.
+DECODIFICADORES = {"clasico": _clasico}
+if hasattr(cv2, "QRCodeDetectorAruco"):
+    DECODIFICADORES["aruco"] = _aruco
+if pyzbar is not None:
+    DECODIFICADORES["zbar"] = _zbar
+if zxingcpp is not None:
+    DECODIFICADORES["zxing"] = _zxing
+
+QR_PRINCIPAL = os.environ.get("OMR_QR_DECODIFICADOR", "") or ("aruco" if "aruco" in DECODIFICADORES else "clasico")
+QR_RESPALDO = os.environ.get("OMR_QR_RESPALDO", "clasico")
+
+
+def cadena(principal=None, respaldo=None):
+    """
+    Nombres de backend a probar en orden (sin repetidos). ValueError si alguno no existe.
+    """
+    principal = principal or QR_PRINCIPAL
+    respaldo = QR_RESPALDO if respaldo is None else respaldo
+    nombres = [principal] + ([respaldo] if respaldo and respaldo != principal else [])
+    for n in nombres:
+        if n not in DECODIFICADORES:
+            raise ValueError(f"Decodificador QR no disponible: {n} (hay {', '.join(sorted(DECODIFICADORES))})")
+    return nombres
+
+
+QR_CADENA = cadena()  # falla al arrancar si la configuración no vale
+
+
+class DecodificadorQR:
+    """
+    Prueba los backends de `nombres` en orden sobre la misma imagen.
+    `ultimo` = backend que leyó el último QR.
+    """
+
+    def __init__(self, nombres=None):
+        nombres = QR_CADENA if nombres is None else nombres
+        self._backends = [(n, DECODIFICADORES[n]()) for n in nombres]
+        self.ultimo = None
+
+    def __call__(self, img):
+        for nombre, decodificar in self._backends:
+            try:
+                s = (decodificar(img) or "").strip()
+            except Exception:  # un backend que falla no corta la cadena
+                continue
+            if s:
+                self.ultimo = nombre
+                return s
+        return None
@@ -0,0 +1,156 @@
+"""
+Arranque de producción (en vez de `python omr.py`, el servidor de desarrollo de Flask).
+
+    python servir.py                          # Flask (omr.py) con gunicorn, perfil throughput
+    python servir.py --perfil latencia
+    python servir.py --app fastapi            # main.py con uvicorn + PoolOMR
+
+Reparte los núcleos entre procesos y hilos internos de OpenCV (cv2.setNumThreads),
+que por defecto usa TODOS los núcleos en CADA proceso:
+
+- throughput: un proceso por núcleo, 1 hilo OpenCV cada uno. Máximo de hojas/s
+  cuando llegan muchas subidas a la vez (clases enteras, varios profesores).
+- latencia: 2 procesos, el resto de núcleos como hilos OpenCV de cada uno.
+  Cada hoja sale antes, pero se corrigen menos por segundo.
+
+OMR_SERVIDOR_WORKERS / OMR_CV_HILOS (o --workers / --hilos-cv) fuerzan los números.
+Flask: procesos pre-forked de gunicorn con omr/OpenCV ya importados en el maestro.
+FastAPI: un proceso uvicorn (E/S asíncrona) y el PoolOMR con los procesos de OMR.
+Lotes, documentos y trabajos entran en el mismo presupuesto: en Flask el pool de
+lote de cada worker tiene su parte de los núcleos (OMR_LOTE_WORKERS); en FastAPI
+usan los procesos del PoolOMR.
+
+Estado compartido entre los workers de gunicorn (cada uno es un proceso): con más
+de uno servir.py fija por defecto un directorio común para las imágenes de debug
+(OMR_DEBUG_DIR: /debug/<id> sale en cualquier worker) y otro para las métricas
+(OMR_METRICAS_DIR: /metrics suma las de todos los workers).
+
+Arranque en frío (escala a cero): cada proceso de OMR corrige una hoja sintética
+antes que la primera petición real (omr.calentar, OMR_CALENTAR=0 lo desactiva).
+Flask: la corrige el maestro antes del fork, y todos los workers (también los que
+gunicorn relance) nacen calientes. FastAPI: cada proceso del PoolOMR en su
+initializer. GET /listo da 503 hasta que están TODOS y luego 200 con los segundos
+desde el arranque: es la sonda de readiness/startup de la plataforma.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+PERFILES = ("throughput", "latencia")
+LATENCIA_WORKERS = 2
+
+
+def nucleos():
+    # como omr.nucleos(), pero sin importar omr: OMR_CV_HILOS se fija antes
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def presupuesto(perfil, cpus, workers=0, hilos_cv=0):
+    """
+    (procesos, hilos OpenCV por proceso) para `cpus` núcleos.
+    """
+    if perfil not in PERFILES:
+        raise ValueError(f"perfil debe ser uno de {PERFILES}")
+    if not workers:
+        workers = min(LATENCIA_WORKERS, cpus) if perfil == "latencia" else cpus
+    if not hilos_cv:
+        hilos_cv = max(1, cpus // workers)
+    return workers, hilos_cv
+
+
+def lote_workers(cpus, workers):
+    """
+    Procesos del pool de lote de CADA worker de gunicorn: su parte de los núcleos.
+    """
+    return max(1, cpus // workers)
+
+
+def servir_flask(host, port, workers, hilos_cv, timeout):
+    from gunicorn.app.base import BaseApplication
+
+    import cv2
+    import omr  # precargado en el maestro: los workers lo heredan al hacer fork
+
+    # calentar aquí, antes de abrir el puerto y del fork: /listo es el mismo en
+    # todos los workers. Con 1 hilo de OpenCV: ningún hilo suyo vivo al hacer fork.
+    cv2.setNumThreads(1)
+    omr.calentar()
+
+    def post_fork(server, worker):
+        cv2.setNumThreads(hilos_cv)
+        omr.cola_trabajos.arrancar()  # sólo uno se queda con la cola (cerrojo)
+
+    class Servidor(BaseApplication):
+        def load_config(self):
+            cfg = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "worker_class": "gthread",
+                "threads": 2,  # una hoja corrigiendo + /metrics, /debug, /trabajos...
+                "preload_app": True,
+                "timeout": timeout,
+                "post_fork": post_fork,
+            }
+            for k, v in cfg.items():
+                self.cfg.set(k, v)
+
+        def load(self):
+            return omr.app
+
+    Servidor().run()
+
+
+def servir_fastapi(host, port, workers, hilos_cv):
+    import uvicorn
+
+    # PoolOMR lee OMR_WORKERS al importar main/pool_omr y reparte el presupuesto
+    # de hilos OpenCV entre sus procesos (hilos_cv_pool)
+    # (lote y documentos comparten ese mismo pool: main.lifespan -> omr.usar_pool_lote)
+    os.environ["OMR_WORKERS"] = str(workers)
+    os.environ["OMR_CV_HILOS"] = str(hilos_cv * workers)
+    import main
+
+    uvicorn.run(main.app, host=host, port=port, workers=1)
+
+
+def main():
+    os.environ.setdefault("OMR_ARRANQUE", str(time.time()))  # /listo cuenta desde aquí, no desde importar omr
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--app", choices=("flask", "fastapi"), default=os.environ.get("OMR_APP", "flask"))
+    ap.add_argument("--perfil", choices=PERFILES, default=os.environ.get("OMR_PERFIL", "throughput"))
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8080")))
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("OMR_SERVIDOR_WORKERS", "0")))
+    ap.add_argument("--hilos-cv", type=int, default=int(os.environ.get("OMR_CV_HILOS", "0")))
+    ap.add_argument("--timeout", type=int, default=120, help="segundos máx. por petición (gunicorn)")
+    a = ap.parse_args()
+
+    cpus = nucleos()
+    workers, hilos_cv = presupuesto(a.perfil, cpus, a.workers, a.hilos_cv)
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger(__name__).info("OMR %s: perfil %s, %d núcleos -> %d procesos x %d hilos OpenCV",
+                                     a.app, a.perfil, cpus, workers, hilos_cv)
+
+    if a.app == "fastapi":
+        servir_fastapi(a.host, a.port, workers, hilos_cv)
+    else:
+        # antes de importar omr: fija cv2.setNumThreads del maestro y el pool de lote
+        # de cada worker (sus núcleos, no todos: N workers x N procesos sobresuscribe)
+        os.environ["OMR_CV_HILOS"] = str(hilos_cv)
+        os.environ["OMR_LOTE_WORKERS"] = str(lote_workers(cpus, workers))
+        if workers > 1:
+            # cada worker es un proceso: debug y métricas en disco, visibles desde todos
+            if not os.environ.get("OMR_DEBUG_DIR"):
+                os.environ["OMR_DEBUG_DIR"] = tempfile.mkdtemp(prefix="omr_debug_")
+            if not os.environ.get("OMR_METRICAS_DIR"):
+                os.environ["OMR_METRICAS_DIR"] = tempfile.mkdtemp(prefix="omr_metricas_")
+        servir_flask(a.host, a.port, workers, hilos_cv, a.timeout)
+
+
+if __name__ == "__main__":
+    main()
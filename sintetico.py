@@ -0,0 +1,168 @@
+"""
+Hojas OMR sintéticas (sin escaneos reales) para benchmark y pruebas.
+
+- Plantilla A4 coherente con omr.py: marcas de esquina, QR arriba a la
+  izquierda y 30 filas x 4 burbujas dentro de OMR_REGION.
+- Respuestas conocidas, con blancos ("") y dobles ("X").
+- "Foto" con perspectiva, desenfoque, ruido, luz irregular, resolución y JPEG.
+"""
+import cv2
+import numpy as np
+
+from omr import A4_H, A4_W, MAX_FILAS_POR_HOJA, OMR_REGION, OPCIONES
+
+# Geometría de la plantilla (coords A4)
+MARCA_LADO = 80
+MARCA_MARGEN = 60
+QR_CAJA = (110, 200, 300)      # x, y, lado (fuera de la zona OMR en X)
+BURBUJA_R = 24
+FILA_Y0 = OMR_REGION["y0"] + 300
+FILA_PASO = 90
+COLUMNA_X0 = OMR_REGION["x0"] + 300
+COLUMNA_PASO = 200
+
+
+def centros_burbujas():
+    """
+    (30*4, 2) centros de todas las burbujas impresas en coords A4 del pipeline
+    (omr.homografia_a4 lleva el centro de cada marca a la esquina de la hoja).
+    """
+    c = MARCA_MARGEN + MARCA_LADO / 2.0
+    sx, sy = A4_W / (A4_W - 2 * c), A4_H / (A4_H - 2 * c)
+    return np.array([((COLUMNA_X0 + k * COLUMNA_PASO - c) * sx, (FILA_Y0 + fila * FILA_PASO - c) * sy)
+                     for fila in range(MAX_FILAS_POR_HOJA) for k in range(len(OPCIONES))])
+
+
+def codigo_qr(id_examen, id_alumno, fecha, num_preguntas, pagina=1):
+    return f"{id_examen}|{id_alumno}|{fecha}|{num_preguntas}|{pagina}"
+
+
+def respuestas_aleatorias(n, rng, p_blanco=0.1, p_doble=0.1):
+    """
+    Lista de n respuestas: letra, "" (blanco) o "X" (doble).
+    """
+    p_letra = (1.0 - p_blanco - p_doble) / len(OPCIONES)
+    valores = OPCIONES + ["", "X"]
+    pesos = [p_letra] * len(OPCIONES) + [p_blanco, p_doble]
+    return [str(v) for v in rng.choice(valores, size=n, p=pesos)]
+
+
+def _rellenar(img, x, y, rng, color):
+    # trazos de bolígrafo (rayado) en vez de un disco liso, como en una hoja real
+    for d in range(-20, 21, 10):
+        j = int(rng.integers(-2, 3))
+        cv2.line(img, (x - 22, y + d - 8 + j), (x + 22, y + d + 8 + j), color, 4)
+
+
+def generar_hoja(respuestas, codigo, rng=None):
+    """
+    Hoja A4 (BGR) limpia. `respuestas`: una por fila de ESTA página (máx 30).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    img = np.full((A4_H, A4_W, 3), 255, np.uint8)
+
+    s, m = MARCA_LADO, MARCA_MARGEN
+    for x, y in [(m, m), (A4_W - m - s, m), (A4_W - m - s, A4_H - m - s), (m, A4_H - m - s)]:
+        cv2.rectangle(img, (x, y), (x + s, y + s), (0, 0, 0), -1)
+
+    qx, qy, ql = QR_CAJA
+    qr = cv2.QRCodeEncoder.create().encode(codigo)
+    qr = cv2.resize(qr, (ql, ql), interpolation=cv2.INTER_NEAREST)
+    img[qy:qy + ql, qx:qx + ql] = cv2.cvtColor(qr, cv2.COLOR_GRAY2BGR)
+
+    tinta = [(120, 40, 20), (30, 30, 30)][int(rng.integers(0, 2))]  # azul o negro
+    for fila in range(MAX_FILAS_POR_HOJA):
+        y = FILA_Y0 + fila * FILA_PASO
+        marca = respuestas[fila] if fila < len(respuestas) else ""
+        cv2.putText(img, f"{fila + 1}.", (COLUMNA_X0 - 120, y + 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 0), 2)
+        dobles = rng.choice(len(OPCIONES), size=2, replace=False) if marca == "X" else ()
+        for k, letra in enumerate(OPCIONES):
+            x = COLUMNA_X0 + k * COLUMNA_PASO
+            cv2.circle(img, (x, y), BURBUJA_R, (0, 0, 0), 2)
+            if marca == letra or k in dobles:
+                _rellenar(img, x, y, rng, tinta)
+    return img
+
+
+def fotografiar(img, rng=None, perspectiva=0.03, angulo=3.0, desenfoque=1.0,
+                ruido=6.0, luz=0.25, escala=1.0, giro=0):
+    """
+    Simula una foto de móvil de la hoja. Todos los parámetros son máximos
+    (se muestrean al azar entre 0 y el valor); `giro` (0/90/180/270) es fijo.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    h, w = img.shape[:2]
+
+    # la hoja ocupa ~85% de la foto, sobre una mesa gris
+    margen_x, margen_y = int(w * 0.09), int(h * 0.09)
+    W, H = w + 2 * margen_x, h + 2 * margen_y
+    esquinas = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    jitter = rng.uniform(-perspectiva, perspectiva, size=(4, 2)) * [w, h]
+    destino = esquinas + [margen_x, margen_y] + jitter
+
+    a = np.deg2rad(rng.uniform(-angulo, angulo))
+    c = np.float32([W / 2.0, H / 2.0])
+    R = np.float32([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    destino = (destino - c) @ R.T + c
+
+    M = cv2.getPerspectiveTransform(esquinas, destino.astype(np.float32))
+    mesa = tuple(int(v) for v in rng.integers(150, 210, size=3))
+    foto = cv2.warpPerspective(img, M, (W, H), borderValue=mesa)
+
+    # luz irregular: gradiente lineal multiplicativo
+    if luz > 0:
+        gx, gy = rng.uniform(-luz, luz, size=2)
+        yy, xx = np.mgrid[0:H, 0:W].astype(np.float32)
+        campo = 1.0 + gx * (xx / W - 0.5) + gy * (yy / H - 0.5)
+        foto = np.clip(foto.astype(np.float32) * campo[..., None], 0, 255).astype(np.uint8)
+
+    sigma = rng.uniform(0, desenfoque)
+    if sigma > 0.2:
+        foto = cv2.GaussianBlur(foto, (0, 0), sigma)
+
+    if ruido > 0:
+        n = rng.normal(0, rng.uniform(0, ruido), size=foto.shape).astype(np.float32)
+        foto = np.clip(foto.astype(np.float32) + n, 0, 255).astype(np.uint8)
+
+    if escala != 1.0:
+        interp = cv2.INTER_AREA if escala < 1.0 else cv2.INTER_CUBIC
+        foto = cv2.resize(foto, None, fx=escala, fy=escala, interpolation=interp)
+
+    giros = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+    if giro in giros:
+        foto = cv2.rotate(foto, giros[giro])
+    return foto
+
+
+def hoja_aleatoria(rng, num_preguntas=None, pagina=None, id_examen=None, calidad_jpg=90, **foto_kw):
+    """
+    Genera una foto JPEG de una hoja con respuestas conocidas.
+    Devuelve (jpg_bytes, verdad) con verdad = {codigo, ..., respuestas: {"n": resp}}.
+    """
+    num_preguntas = int(rng.integers(10, 61)) if num_preguntas is None else num_preguntas
+    if pagina is None:
+        pagina = int(rng.integers(1, 3)) if num_preguntas > MAX_FILAS_POR_HOJA else 1
+
+    offset = 0 if pagina == 1 else MAX_FILAS_POR_HOJA
+    filas = max(0, min(MAX_FILAS_POR_HOJA, num_preguntas - offset))
+    resp = respuestas_aleatorias(filas, rng)
+
+    id_examen = int(rng.integers(1, 1000)) if id_examen is None else id_examen
+    id_alumno = int(rng.integers(1, 10000))
+    codigo = codigo_qr(id_examen, id_alumno, "2026-02-16", num_preguntas, pagina)
+
+    foto = fotografiar(generar_hoja(resp, codigo, rng), rng, **foto_kw)
+    ok, buff = cv2.imencode(".jpg", foto, [int(cv2.IMWRITE_JPEG_QUALITY), int(calidad_jpg)])
+    if not ok:
+        raise RuntimeError("No se pudo codificar la hoja sintética")
+
+    verdad = {
+        "codigo": codigo,
+        "id_examen": id_examen,
+        "id_alumno": id_alumno,
+        "num_preguntas": num_preguntas,
+        "pagina": pagina,
+        "respuestas": {str(offset + i): r for i, r in enumerate(resp, start=1)},
+    }
+    return buff.tobytes(), verdad
@@ -0,0 +1,348 @@
+"""
+Cola de trabajos OMR asíncrona (enviar ahora, consultar después).
+
+- POST devuelve un id_trabajo al momento; hilos de fondo corrigen las hojas.
+- Cola y resultados en SQLite + directorio spool: sobreviven a un reinicio
+  (lo que estaba a medias vuelve a la cola al arrancar).
+- Los trabajos terminados se borran tras OMR_TRABAJOS_TTL_S (al arrancar y
+  luego cada hora como mucho, desde los hilos de la cola).
+- Prioridad por trabajo (mayor antes; a igualdad, el más antiguo).
+- callback opcional: POST con el JSON del trabajo cuando termina. Sólo a IPs
+  públicas (nada de la red interna: SSRF), sin seguir redirecciones, y si se
+  fija OMR_CALLBACK_HOSTS (lista separada por comas) sólo a esos hosts.
+- Con varios procesos (servir.py) todos encolan y consultan, pero sólo uno
+  (el que tiene el cerrojo del directorio) corrige la cola.
+"""
+import http.client
+import ipaddress
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # sin flock (Windows): un solo proceso
+    fcntl = None
+
+TRABAJOS_DIR = os.environ.get("OMR_TRABAJOS_DIR", "omr_trabajos")
+TRABAJOS_WORKERS = int(os.environ.get("OMR_TRABAJOS_WORKERS", "0"))  # 0 = omr.nucleos()
+TRABAJOS_TTL_S = float(os.environ.get("OMR_TRABAJOS_TTL_S", str(7 * 24 * 3600)))  # se borran después
+TRABAJOS_PURGA_S = min(3600.0, TRABAJOS_TTL_S)  # cada cuánto se borran los caducados
+CALLBACK_TIMEOUT_S = float(os.environ.get("OMR_CALLBACK_TIMEOUT_S", "10"))
+CALLBACK_REINTENTOS = 3
+CALLBACK_HOSTS = {h.strip().lower() for h in os.environ.get("OMR_CALLBACK_HOSTS", "").split(",") if h.strip()}
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    estado TEXT,              -- pendiente, procesando, terminado
+    prioridad INTEGER,
+    creado REAL,
+    terminado REAL,
+    total INTEGER,
+    hechos INTEGER,
+    correctas INTEGER,
+    opciones TEXT,            -- JSON (debug, timings)
+    callback TEXT,
+    callback_estado TEXT      -- NULL = pendiente de avisar
+);
+CREATE TABLE IF NOT EXISTS items (
+    trabajo TEXT,
+    indice INTEGER,
+    nombre TEXT,
+    estado TEXT,              -- pendiente, procesando, hecho
+    resultado TEXT,
+    PRIMARY KEY (trabajo, indice)
+);
+CREATE INDEX IF NOT EXISTS items_estado ON items (estado);
+"""
+
+
+def validar_callback(url):
+    """
+    (esquema, host, puerto, ruta, ip) de la URL de un callback; ValueError si
+    no es http(s), el host no está en CALLBACK_HOSTS (si se fijó) o resuelve
+    a alguna IP que no es pública (loopback, privada, link-local...).
+    """
+    try:
+        partes = urlsplit(url or "")
+        puerto = partes.port or (443 if partes.scheme == "https" else 80)
+    except ValueError:
+        raise ValueError("callback debe ser una URL http(s)")
+    host = (partes.hostname or "").lower()
+    if partes.scheme not in ("http", "https") or not host:
+        raise ValueError("callback debe ser una URL http(s)")
+    if CALLBACK_HOSTS and host not in CALLBACK_HOSTS:
+        raise ValueError(f"callback: host no permitido ({host})")
+    try:
+        ips = [info[4][0] for info in socket.getaddrinfo(host, puerto, type=socket.SOCK_STREAM)]
+    except OSError as e:
+        raise ValueError(f"callback: no se puede resolver {host} ({e})")
+    for ip in ips:
+        if not ipaddress.ip_address(ip.split("%")[0]).is_global:
+            raise ValueError(f"callback: {host} no es una dirección pública ({ip})")
+    ruta = (partes.path or "/") + (f"?{partes.query}" if partes.query else "")
+    return partes.scheme, host, puerto, ruta, ips[0]
+
+
+class _ConexionHTTP(http.client.HTTPConnection):
+    # a la IP ya validada (no se vuelve a resolver: DNS rebinding); Host del callback
+    def __init__(self, ip, host, puerto, timeout):
+        super().__init__(host, puerto, timeout=timeout)
+        self._ip = ip
+
+    def connect(self):
+        self.sock = socket.create_connection((self._ip, self.port), self.timeout)
+
+
+class _ConexionHTTPS(http.client.HTTPSConnection):
+    # ídem, con SNI y certificado comprobados contra el host, no contra la IP
+    def __init__(self, ip, host, puerto, timeout):
+        super().__init__(host, puerto, timeout=timeout)
+        self._ip = ip
+
+    def connect(self):
+        sock = socket.create_connection((self._ip, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def _post_callback(url, cuerpo):
+    """
+    POST del JSON a `url` (validar_callback). Devuelve el status HTTP; una
+    redirección NO se sigue (sería otro destino sin validar).
+    """
+    esquema, host, puerto, ruta, ip = validar_callback(url)
+    conexion = (_ConexionHTTPS if esquema == "https" else _ConexionHTTP)(ip, host, puerto, CALLBACK_TIMEOUT_S)
+    try:
+        conexion.request("POST", ruta, body=cuerpo, headers={"Content-Type": "application/json"})
+        return conexion.getresponse().status
+    finally:
+        conexion.close()
+
+
+class ColaTrabajos:
+    def __init__(self, procesar, directorio=TRABAJOS_DIR, workers=TRABAJOS_WORKERS):
+        """
+        procesar(binario, opciones) -> dict JSON del resultado de UNA hoja.
+        """
+        self.procesar = procesar
+        self.directorio = directorio
+        self.workers = max(1, workers)
+        self._db = None
+        self._lock = threading.Lock()
+        self._hay_trabajo = threading.Condition(self._lock)
+        self._hilos = []
+        self._cerrojo = None
+        self._purgado = 0.0
+
+    # ---------------- ciclo de vida ----------------
+    def arrancar(self):
+        """
+        Abre la base de datos y, si este proceso se queda con la cola, lanza
+        los hilos (idempotente; si otro proceso la tiene, lo reintenta).
+        """
+        with self._lock:
+            if self._hilos:
+                return
+            if self._db is None:
+                os.makedirs(self.directorio, exist_ok=True)
+                self._db = sqlite3.connect(os.path.join(self.directorio, "trabajos.sqlite"),
+                                           timeout=30.0, check_same_thread=False)
+                self._db.executescript(_ESQUEMA)
+            if not self._tomar_cerrojo():
+                return
+            # lo que se estaba corrigiendo cuando se paró el servidor, otra vez a la cola
+            self._db.execute("UPDATE items SET estado = 'pendiente' WHERE estado = 'procesando'")
+            self._db.commit()
+            self._purgar()
+            pendientes_aviso = [r[0] for r in self._db.execute(
+                "SELECT id FROM trabajos WHERE estado = 'terminado' "
+                "AND callback IS NOT NULL AND callback_estado IS NULL")]
+
+            for i in range(self.workers):
+                h = threading.Thread(target=self._bucle, name=f"omr-trabajos-{i}", daemon=True)
+                h.start()
+                self._hilos.append(h)
+
+        for id_trabajo in pendientes_aviso:
+            threading.Thread(target=self._avisar, args=(id_trabajo,), daemon=True).start()
+
+    def _tomar_cerrojo(self):
+        if fcntl is None:
+            return True
+        f = open(os.path.join(self.directorio, "cola.lock"), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._cerrojo = f  # abierto mientras viva el proceso
+        return True
+
+    def _purgar(self):
+        # al arrancar y luego cada TRABAJOS_PURGA_S desde los workers (con self._lock)
+        self._purgado = time.time()
+        limite = self._purgado - TRABAJOS_TTL_S
+        viejos = [r[0] for r in self._db.execute(
+            "SELECT id FROM trabajos WHERE estado = 'terminado' AND terminado < ?", (limite,))]
+        for id_trabajo in viejos:
+            self._db.execute("DELETE FROM items WHERE trabajo = ?", (id_trabajo,))
+            self._db.execute("DELETE FROM trabajos WHERE id = ?", (id_trabajo,))
+            shutil.rmtree(self._spool(id_trabajo), ignore_errors=True)
+        self._db.commit()
+
+    def _spool(self, id_trabajo, indice=None):
+        ruta = os.path.join(self.directorio, id_trabajo)
+        return ruta if indice is None else os.path.join(ruta, f"{indice}.bin")
+
+    # ---------------- API ----------------
+    def enviar(self, archivos, prioridad=0, callback=None, opciones=None):
+        """
+        archivos: lista de (nombre, bytes). Devuelve el id del trabajo.
+        """
+        self.arrancar()
+        id_trabajo = uuid.uuid4().hex
+        os.makedirs(self._spool(id_trabajo))
+        for i, (_, binario) in enumerate(archivos):
+            with open(self._spool(id_trabajo, i), "wb") as f:
+                f.write(binario)
+
+        with self._hay_trabajo:
+            self._db.execute(
+                "INSERT INTO trabajos VALUES (?, 'pendiente', ?, ?, NULL, ?, 0, 0, ?, ?, NULL)",
+                (id_trabajo, int(prioridad), time.time(), len(archivos), json.dumps(opciones or {}), callback))
+            self._db.executemany(
+                "INSERT INTO items VALUES (?, ?, ?, 'pendiente', NULL)",
+                [(id_trabajo, i, nombre) for i, (nombre, _) in enumerate(archivos)])
+            self._db.commit()
+            self._hay_trabajo.notify_all()
+        return id_trabajo
+
+    def consultar(self, id_trabajo, con_resultados=True):
+        """
+        Estado y progreso del trabajo (y resultados ya listos, en orden). None si no existe.
+        """
+        if self._db is None:
+            self.arrancar()
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT estado, prioridad, creado, terminado, total, hechos, correctas, callback_estado "
+                "FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()
+            if fila is None:
+                return None
+            items = []
+            if con_resultados:
+                items = self._db.execute(
+                    "SELECT indice, nombre, resultado FROM items WHERE trabajo = ? AND estado = 'hecho' "
+                    "ORDER BY indice", (id_trabajo,)).fetchall()
+
+        estado, prioridad, creado, terminado, total, hechos, correctas, callback_estado = fila
+        out = {
+            "ok": True,
+            "id_trabajo": id_trabajo,
+            "estado": estado,
+            "prioridad": prioridad,
+            "creado": creado,
+            "terminado": terminado,
+            "total": total,
+            "hechos": hechos,
+            "correctas": correctas,
+            "progreso": round(hechos / float(total), 3) if total else 1.0,
+        }
+        if callback_estado is not None:
+            out["callback_estado"] = callback_estado
+        if con_resultados:
+            out["resultados"] = [{"indice": i, "nombre": n, **json.loads(r)} for i, n, r in items]
+        return out
+
+    # ---------------- workers ----------------
+    def _siguiente(self):
+        """
+        Reserva la siguiente hoja pendiente (prioridad, antigüedad, orden). Bloquea si no hay.
+        """
+        with self._hay_trabajo:
+            while True:
+                if time.time() - self._purgado >= TRABAJOS_PURGA_S:
+                    self._purgar()  # el servidor puede llevar semanas sin reiniciar
+                fila = self._db.execute(
+                    "SELECT i.trabajo, i.indice, t.opciones FROM items i JOIN trabajos t ON t.id = i.trabajo "
+                    "WHERE i.estado = 'pendiente' ORDER BY t.prioridad DESC, t.creado, i.indice LIMIT 1"
+                ).fetchone()
+                if fila is not None:
+                    break
+                self._hay_trabajo.wait(timeout=2.0)  # también llegan trabajos de otros procesos
+            id_trabajo, indice, opciones = fila
+            self._db.execute("UPDATE items SET estado = 'procesando' WHERE trabajo = ? AND indice = ?",
+                             (id_trabajo, indice))
+            self._db.execute("UPDATE trabajos SET estado = 'procesando' WHERE id = ? AND estado = 'pendiente'",
+                             (id_trabajo,))
+            self._db.commit()
+        return id_trabajo, indice, json.loads(opciones)
+
+    def _terminar_item(self, id_trabajo, indice, res):
+        """
+        Guarda el resultado; True si era la última hoja del trabajo.
+        """
+        with self._lock:
+            self._db.execute("UPDATE items SET estado = 'hecho', resultado = ? WHERE trabajo = ? AND indice = ?",
+                             (json.dumps(res), id_trabajo, indice))
+            self._db.execute("UPDATE trabajos SET hechos = hechos + 1, correctas = correctas + ? WHERE id = ?",
+                             (1 if res.get("ok") else 0, id_trabajo))
+            hechos, total = self._db.execute("SELECT hechos, total FROM trabajos WHERE id = ?",
+                                             (id_trabajo,)).fetchone()
+            fin = hechos >= total
+            if fin:
+                self._db.execute("UPDATE trabajos SET estado = 'terminado', terminado = ? WHERE id = ?",
+                                 (time.time(), id_trabajo))
+            self._db.commit()
+        return fin
+
+    def _bucle(self):
+        while True:
+            id_trabajo, indice, opciones = self._siguiente()
+            ruta = self._spool(id_trabajo, indice)
+            try:
+                with open(ruta, "rb") as f:
+                    binario = f.read()
+                res = self.procesar(binario, opciones)
+            except Exception as e:  # una hoja no tumba la cola
+                res = {"ok": False, "error": str(e)}
+
+            fin = self._terminar_item(id_trabajo, indice, res)
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+            if fin:
+                shutil.rmtree(self._spool(id_trabajo), ignore_errors=True)
+                self._avisar(id_trabajo)
+
+    def _avisar(self, id_trabajo):
+        with self._lock:
+            fila = self._db.execute("SELECT callback FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()
+        if not fila or not fila[0]:
+            return
+
+        cuerpo = json.dumps(self.consultar(id_trabajo)).encode("utf-8")
+        estado = "error"
+        for intento in range(CALLBACK_REINTENTOS):
+            try:
+                estado = str(_post_callback(fila[0], cuerpo))
+                break
+            except ValueError as e:  # destino no permitido: reintentar no cambia nada
+                estado = f"rechazado: {e}"
+                break
+            except Exception as e:
+                estado = f"error: {e}"
+                if intento + 1 < CALLBACK_REINTENTOS:
+                    time.sleep(2 ** intento)
+
+        with self._lock:
+            self._db.execute("UPDATE trabajos SET callback_estado = ? WHERE id = ?", (estado, id_trabajo))
+            self._db.commit()